@@ -1,21 +1,90 @@
 import dataclasses
 import json
 import os
+import tempfile
 import traceback
+from typing import Optional, Tuple
 
 import numpy as np
-from flask import render_template, request, make_response, jsonify, Flask
+from flask import render_template, request, make_response, jsonify, Flask, Response, stream_with_context
 from werkzeug.exceptions import HTTPException
 
-from tracking.image_utils import frames_iterator
-from tracking.main import track_filament
-from tracking.models import Config, ApplicationError
+from tracking.cache import ResultCache, files_digest, tracking_key
+from tracking.checkpoints import Checkpoint, CheckpointRecorder, CheckpointStore
+from tracking.image_utils import frames_count, frames_iterator, lazy_frames_iterator, prefetch_frames, FramePrefetcher
+from tracking.filaments import track_filaments
+from tracking.jobs import JobStore
+from tracking.keyframes import track_keyframes
+from tracking.metrics import MetricsRegistry, TrackingMetrics, stage, timed_frames
+from tracking.main import track_filament_frames
+from tracking.models import Config, ApplicationError, TrackingResultArrays
+from tracking.preview import track_preview
+from tracking.stacks import StackStore
 
 app = Flask(__name__, instance_relative_config=True)
 app.secret_key = os.getenv('SECRET_KEY')
 
 ALLOWED_IMAGE_TYPES = ['.tif', '.tiff', '.jpg', '.jpeg', '.png', '.raw']
 
+# Formatos en los que se puede pedir el resultado del tracking (via header Accept)
+JSON_MIMETYPE   = 'application/json'
+# Streaming: un JSON por linea por cada frame, y uno final con los errores
+NDJSON_MIMETYPE = 'application/x-ndjson'
+# Binario: arreglos de numpy (ver TrackingResultArrays.to_npz)
+NPZ_MIMETYPE    = 'application/x-npz'
+
+# Header de la respuesta con el id del checkpoint del tracking (ver /checkpoints)
+CHECKPOINT_HEADER = 'X-Checkpoint-Id'
+
+# Cantidad de frames que se decodifican por adelantado, en paralelo con el tracking (0 deshabilita)
+PREFETCH_DEPTH = int(os.getenv('PREFETCH_DEPTH', 4))
+
+# Procesos entre los que se reparten los filamentos cuando se trackean varios en el mismo pedido
+FILAMENT_WORKERS = int(os.getenv('FILAMENT_WORKERS', os.cpu_count() or 1))
+
+# Procesos entre los que se reparten los rangos de frames cuando se trackea a partir de varios keyframes
+KEYFRAME_WORKERS = int(os.getenv('KEYFRAME_WORKERS', os.cpu_count() or 1))
+
+# Tiempo máximo por defecto de una vista previa del tracking (/track?preview=true), en segundos
+PREVIEW_BUDGET = float(os.getenv('PREVIEW_BUDGET', 2))
+
+# Métricas de tiempos y contadores del tracking. El directorio tiene que ser compartido por todos los workers de gunicorn
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() != 'false'
+metrics_registry = MetricsRegistry(os.getenv('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'pipo-metrics')))
+
+# Trabajos de tracking asincrónicos. El directorio tiene que ser compartido por todos los workers de gunicorn
+jobs = JobStore(
+    root        = os.getenv('JOBS_DIR', os.path.join(tempfile.gettempdir(), 'pipo-jobs')),
+    allowed_ext = ALLOWED_IMAGE_TYPES,
+    workers     = int(os.getenv('JOB_WORKERS', 2)),
+    max_pending = int(os.getenv('JOB_MAX_PENDING', 8)),
+    ttl         = float(os.getenv('JOB_TTL', 3600)),
+    prefetch    = PREFETCH_DEPTH,
+    metrics_root = metrics_registry.root if METRICS_ENABLED else None,
+)
+
+# Cache de resultados indexado por el contenido del pedido (imagenes, puntos y configuración).
+# El directorio tiene que ser compartido por todos los workers de gunicorn. Un límite en 0 deshabilita ese nivel
+results_cache = ResultCache(
+    root         = os.getenv('RESULT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'pipo-cache')),
+    memory_limit = int(os.getenv('RESULT_CACHE_MEMORY', 256 * 2**20)),
+    disk_limit   = int(os.getenv('RESULT_CACHE_DISK', 2 * 2**30)),
+)
+
+# Stacks subidos una sola vez (/stacks) y trackeados muchas veces por su id.
+# El directorio tiene que ser compartido por todos los workers de gunicorn. Un límite en 0 lo deshabilita
+stacks = StackStore(
+    root        = os.getenv('STACK_STORE_DIR', os.path.join(tempfile.gettempdir(), 'pipo-stacks')),
+    disk_limit  = int(os.getenv('STACK_STORE_DISK', 8 * 2**30)),
+)
+
+# Estado por frame de los trackings, para retomarlos desde cualquier frame (campos resume y resume_from de /track).
+# El directorio tiene que ser compartido por todos los workers de gunicorn. Un límite en 0 lo deshabilita
+checkpoints = CheckpointStore(
+    root        = os.getenv('CHECKPOINT_DIR', os.path.join(tempfile.gettempdir(), 'pipo-checkpoints')),
+    disk_limit  = int(os.getenv('CHECKPOINT_DISK', 2**30)),
+)
+
 @app.after_request
 def add_header(response):
     response.headers["Cache-Control"] = "max-age=0, must-revalidate"
@@ -48,17 +117,422 @@ def index():
 def manual():
     return render_template('manual.html')
 
-@app.route('/track', methods=['POST'])
-def track():
-    if 'points' not in request.form or len(points := json.loads(request.form['points'], object_hook=lambda point: (point['x'], point['y']))) < 2:
+def parse_points(points) -> np.ndarray:
+    if len(points) < 2:
+        raise ApplicationError('No enough points provided for tracking. At least 2 are required.')
+    return np.array([(point['x'], point['y']) for point in points])
+
+def parse_request_points() -> np.ndarray:
+    if 'points' not in request.form:
         raise ApplicationError('No enough points provided for tracking. At least 2 are required.')
+    return parse_points(json.loads(request.form['points']))
 
+def parse_images():
     if 'images[]' not in request.files or len(images := request.files.getlist('images[]')) < 1:
         raise ApplicationError('No images provided for tracking. At least one image is required.')
+    return images
+
+def parse_tracking_request():
+    return parse_request_points(), parse_images(), Config.from_dict(request.form)
+
+def parse_frames_source(config: Config, need_digest: bool = False):
+    """
+    Frames del pedido: las imagenes subidas (images[]) o los frames de un stack guardado (campo stack, ver /stacks).
+    Retorna esa fuente, el hash de su contenido (ver files_digest; None si la cache está deshabilitada y no se pide) y la configuración.
+    Un stack guardado comparte la cache de resultados con sus archivos originales, y su decodificación es la elegida al subirlo.
+    """
+    if 'stack' not in request.form:
+        images = parse_images()
+        return images, files_digest(images) if results_cache.enabled or need_digest else None, config
+    info, frames = stacks.load(request.form['stack'])
+    return frames, bytes.fromhex(info.digest), info.tracking_config(config)
+
+def parse_keyframes():
+    """
+    Keyframes del campo keyframes: una lista de {"frame": k, "points": [{"x", "y"}, ...]}, con los puntos marcados sobre el frame k.
+    """
+    keyframes = json.loads(request.form['keyframes'])
+    if len(keyframes) < 1:
+        raise ApplicationError('No keyframes provided for tracking. At least one is required.')
+    return [(int(keyframe['frame']), parse_points(keyframe['points'])) for keyframe in keyframes]
+
+def parse_resume() -> Tuple[Optional[Checkpoint], int]:
+    """
+    Checkpoint a retomar (campo resume) y frame desde el que se retoma (campo resume_from). Sin resume, (None, 0).
+    """
+    if 'resume' not in request.form:
+        return None, 0
+    checkpoint = checkpoints.load(request.form['resume'])
+    start = int(request.form.get('resume_from', 0))
+    if not 0 <= start <= checkpoint.frames:
+        raise ApplicationError(f'Cannot resume from frame {start}. Checkpoint {checkpoint.id} has {checkpoint.frames} frames')
+    return checkpoint, start
+
+def resume_config(checkpoint: Optional[Checkpoint], start: int) -> Config:
+    # Al retomar sin ningún campo de configuración se mantiene la configuración con la que se trackeó el frame anterior
+    if checkpoint is not None and not any(f.name in request.form for f in dataclasses.fields(Config)):
+        return checkpoint.config(max(start - 1, 0))
+    return Config.from_dict(request.form)
+
+def resume_points(checkpoint: Optional[Checkpoint], start: int) -> Tuple[Optional[np.ndarray], Optional[np.ndarray], Optional[dict]]:
+    """
+    Puntos del usuario, puntos iniciales y el resto del estado inicial del tracking (argumentos de track_filament_frames).
+    Al retomar, los puntos del pedido son los corregidos sobre el frame start. Sin puntos, se parte del estado del frame anterior.
+    """
+    if checkpoint is not None and start > 0 and 'points' not in request.form:
+        return None, checkpoint.points(start - 1), {'initial_fit_params': checkpoint.fit_params(start - 1), 'initial_motion': checkpoint.motion(start - 1)}
+    return parse_request_points(), None, None
+
+def resumed_result(checkpoint: Optional[Checkpoint], start: int, result: TrackingResultArrays) -> TrackingResultArrays:
+    """
+    Resultado completo de un tracking retomado desde el frame start: los frames anteriores salen del checkpoint y el resto es result.
+    Si no se pueden unir (ver Checkpoint.result, o se retomó con otra cantidad de puntos), el resultado empieza en start (start_frame).
+    """
+    previous = checkpoint.result(start) if checkpoint is not None else None
+    if previous is None or (len(result.points) and result.points.shape[1] != previous.points.shape[1]):
+        return dataclasses.replace(result, start_frame=start)
+    if not len(result.points):
+        return dataclasses.replace(previous, errors=result.errors, metrics=result.metrics)
+    return dataclasses.replace(
+        result,
+        points          = np.concatenate((previous.points, result.points)),
+        status          = np.concatenate((previous.status, result.status)),
+        normal_lines    = np.concatenate((previous.normal_lines, result.normal_lines)) if result.normal_lines is not None else None,
+    )
+
+# Campos de la configuración que definen cómo se decodifican los frames, compartidos por todos los filamentos
+FRAME_DECODING_FIELDS = ('native_depth', 'roi_decoding')
+
+def parse_filaments(config: Config):
+    """
+    Filamentos del campo filaments: una lista de {"points": [{"x", "y"}, ...], "config": {...}}.
+    La configuración de cada filamento es opcional, y reemplaza valores de la configuración general del pedido.
+    Los frames se decodifican una sola vez para todos los filamentos, por lo que no se pueden reemplazar
+    los campos que definen la decodificación (FRAME_DECODING_FIELDS).
+    """
+    filaments = json.loads(request.form['filaments'])
+    if len(filaments) < 1:
+        raise ApplicationError('No filaments provided for tracking. At least one is required.')
+    for filament in filaments:
+        if overridden := [name for name in FRAME_DECODING_FIELDS if name in filament.get('config', {})]:
+            raise ApplicationError(f'{", ".join(overridden)} cannot be set per filament, only in the request configuration')
+    return [(parse_points(filament['points']), config.with_overrides(filament.get('config', {}))) for filament in filaments]
+
+def result_response(result: TrackingResultArrays, mimetype: str, metrics: Optional[TrackingMetrics] = None):
+    # Las métricas incluidas en el resultado no pueden contar su propia serialización
+    if metrics is not None and include_metrics():
+        result = dataclasses.replace(result, metrics=metrics.to_dict())
+
+    with stage(metrics, 'serialization'):
+        if mimetype == NPZ_MIMETYPE:
+            return Response(result.to_npz(), mimetype=NPZ_MIMETYPE)
+
+        return make_response(jsonify(result.to_dict()))
+
+@app.route('/track', methods=['POST'])
+def track():
+    if 'filaments' in request.form:
+        return track_multiple()
+    if 'keyframes' in request.form:
+        return track_from_keyframes()
+    if request.args.get('preview', 'false').lower() == 'true':
+        return track_preview_request()
+
+    checkpoint, start = parse_resume()
+    recording = checkpoint is not None or include_checkpoint()
+    source, digest, config = parse_frames_source(resume_config(checkpoint, start), need_digest=recording)
+    points, initial_points, initial_state = resume_points(checkpoint, start)
+    mimetype = request.accept_mimetypes.best_match([JSON_MIMETYPE, NDJSON_MIMETYPE, NPZ_MIMETYPE], default=JSON_MIMETYPE)
+
+    recorder = None
+    if recording:
+        if checkpoint is not None and checkpoint.digest != digest.hex():
+            raise ApplicationError(f'The frames of the request are not the ones tracked in checkpoint {checkpoint.id}')
+        recorder = CheckpointRecorder(checkpoints, digest.hex(), config, start, checkpoint)
+
+    # Un tracking retomado no se cachea. Para generar un checkpoint hace falta trackear, aunque el resultado esté en la cache
+    key = tracking_key(digest, points, config) if results_cache.enabled and checkpoint is None else None
+    metrics = request_metrics()
+    if key is not None and recorder is None and (result := results_cache.get(key, metrics)) is not None:
+        result = without_normal_lines(result)
+        record_metrics(metrics)
+        if mimetype == NDJSON_MIMETYPE:
+            return stream_cached(result)
+        return result_response(result, mimetype)
+
+    frames = frames_source(source, config, metrics, roi=True, start=start)
+    if mimetype == NDJSON_MIMETYPE:
+        # En streaming no se guarda el resultado en la cache, ya que implicaria mantener todos los frames en memoria
+        return stream_tracking(frames, points, config, metrics, initial_points, recorder, initial_state=initial_state,
+                               start_frame=start, previous=checkpoint.result(start, None) if checkpoint is not None else None)
+
+    # Siempre se calculan las rectas normales, para que el resultado cacheado sirva para cualquier pedido
+    errors = []
+    frame_results = track_filament_frames(frames, points, config, errors, metrics, initial_points, **(initial_state or {}))
+    result = TrackingResultArrays.from_frames(frame_results if recorder is None else recorder.record(frame_results), errors)
+    result = resumed_result(checkpoint, start, result)
+    log_prefetch_stats(frames)
+    if key is not None:
+        results_cache.put(key, result)
+    response = result_response(without_normal_lines(result), mimetype, metrics)
+    if recorder is not None:
+        recorder.save()
+        response.headers[CHECKPOINT_HEADER] = recorder.id
+    record_metrics(metrics)
+    return response
+
+def track_multiple():
+    """
+    Varios filamentos sobre el mismo stack: cada frame se decodifica una sola vez y los filamentos se trackean en paralelo.
+    Se retorna un resultado por filamento, en el orden en el que fueron enviados.
+    """
+    # La decodificación de los frames es compartida, por lo que usa la configuración general del pedido
+    source, digest, config = parse_frames_source(Config.from_dict(request.form))
+    filaments = parse_filaments(config)
 
+    # Solo se trackean los filamentos que no estan en la cache. Si estan todos, no se decodifica ningun frame
+    results = [None] * len(filaments)
+    keys = [None] * len(filaments)
+    metrics = request_metrics()
+    if results_cache.enabled:
+        keys = [tracking_key(digest, points, config) for points, config in filaments]
+        results = [results_cache.get(key, metrics) for key in keys]
+
+    if missing := [i for i, result in enumerate(results) if result is None]:
+        frames = frames_source(source, config, metrics)
+        tracked = track_filaments(frames, [filaments[i] for i in missing], FILAMENT_WORKERS, metrics=metrics is not None)
+        log_prefetch_stats(frames)
+        for i, result in zip(missing, tracked):
+            # Las métricas de cada filamento se suman a las del pedido, y solo se dejan en el resultado si se piden
+            if result.metrics is not None:
+                metrics.merge(TrackingMetrics.from_dict(result.metrics))
+                if not include_metrics():
+                    result = dataclasses.replace(result, metrics=None)
+            results[i] = result
+            if keys[i] is not None:
+                results_cache.put(keys[i], dataclasses.replace(result, metrics=None))
+
+    results = [without_normal_lines(result) for result in results]
+
+    with stage(metrics, 'serialization'):
+        if request.accept_mimetypes.best_match([JSON_MIMETYPE, NPZ_MIMETYPE], default=JSON_MIMETYPE) == NPZ_MIMETYPE:
+            response = Response(TrackingResultArrays.multiple_to_npz(results), mimetype=NPZ_MIMETYPE)
+        else:
+            response = make_response(jsonify({'filaments': [result.to_dict() for result in results]}))
+    record_metrics(metrics)
+    return response
+
+def track_preview_request():
+    """
+    Vista previa del tracking (ver track_preview), que responde en a lo sumo preview_budget segundos (PREVIEW_BUDGET por defecto).
+    preview_stride fija cada cuantos frames se trackea. El resultado indica el paso entre frames (frame_step).
+    Con refine=true la respuesta es NDJSON: la vista previa en el primer registro ({"preview": resultado}),
+    y luego el tracking completo, como en el streaming de /track.
+    """
+    points = parse_request_points()
+    source, _, config = parse_frames_source(Config.from_dict(request.form))
+    budget = float(request.args.get('preview_budget', PREVIEW_BUDGET))
+    stride = int(request.args['preview_stride']) if 'preview_stride' in request.args else None
+    if budget <= 0 or (stride is not None and stride < 1):
+        raise ApplicationError('preview_budget must be positive and preview_stride at least 1')
+
+    metrics = request_metrics()
+    if isinstance(source, np.ndarray):
+        frames, frames_total = iter(source), len(source)
+    else:
+        frames, frames_total = lazy_frames_iterator(source, ALLOWED_IMAGE_TYPES, native=config.native_depth), frames_count(source, ALLOWED_IMAGE_TYPES)
+    preview = without_normal_lines(track_preview(frames, frames_total, points, config, budget, stride, metrics))
+
+    if request.args.get('refine', 'false').lower() != 'true':
+        mimetype = request.accept_mimetypes.best_match([JSON_MIMETYPE, NPZ_MIMETYPE], default=JSON_MIMETYPE)
+        response = result_response(preview, mimetype, metrics)
+        record_metrics(metrics)
+        return response
+
+    # Las métricas del pedido incluyen las de la vista previa y las del tracking completo
+    return stream_tracking(frames_source(source, config, metrics, roi=True), points, config, metrics, first_record={'preview': preview.to_dict()})
+
+def track_from_keyframes():
+    """
+    Tracking a partir de puntos marcados en varios frames (keyframes): el stack se divide en rangos que se trackean en paralelo
+    (ver track_keyframes). Con backward=true, cada rango también se trackea hacia atrás desde el keyframe siguiente.
+    Los rangos necesitan leer los frames en cualquier orden, por lo que las imagenes subidas se guardan primero como stack (ver /stacks).
+    """
     config = Config.from_dict(request.form)
+    if 'stack' in request.form:
+        stack_id = request.form['stack']
+    else:
+        stack_id = stacks.create(parse_images(), ALLOWED_IMAGE_TYPES, native=config.native_depth).id
+    info, frames = stacks.load(stack_id)
+    config = info.tracking_config(config)
+    keyframes = parse_keyframes()
+
+    metrics = request_metrics()
+    backward = request.args.get('backward', 'false').lower() == 'true'
+    result = track_keyframes(frames, keyframes, config, KEYFRAME_WORKERS, backward, metrics=metrics is not None)
+    if result.metrics is not None:
+        # Las métricas de los rangos se suman a las del pedido (son tiempos de CPU, no de reloj)
+        metrics.merge(TrackingMetrics.from_dict(result.metrics))
+        result = dataclasses.replace(result, metrics=None)
+
+    mimetype = request.accept_mimetypes.best_match([JSON_MIMETYPE, NPZ_MIMETYPE], default=JSON_MIMETYPE)
+    response = result_response(without_normal_lines(result), mimetype, metrics)
+    record_metrics(metrics)
+    return response
+
+def frames_source(source, config: Config, metrics: Optional[TrackingMetrics] = None, roi: bool = False, start: int = 0):
+    # Los frames de un stack guardado ya estan decodificados (ver StackStore)
+    if isinstance(source, np.ndarray):
+        return iter(source[start:])
+
+    # Con roi los frames se decodifican dentro del tracking, en la región que se va a leer (ver LazyFrame).
+    # No se pueden decodificar por adelantado, ya que la región depende del frame anterior
+    if roi and config.roi_decoding:
+        return lazy_frames_iterator(source, ALLOWED_IMAGE_TYPES, native=config.native_depth, start=start)
+
+    frames = frames_iterator(source, ALLOWED_IMAGE_TYPES, native=config.native_depth, start=start)
+    return prefetch_frames(timed_frames(frames, metrics, 'decode'), PREFETCH_DEPTH)
+
+def log_prefetch_stats(frames):
+    if isinstance(frames, FramePrefetcher):
+        stats = frames.stats
+        app.logger.info(f'frames: {stats.frames} | decode: {stats.decode_time:.3f}s | wait: {stats.wait_time:.3f}s | total: {stats.total_time:.3f}s | overlap: {stats.overlap:.0%}')
+
+def include_normal_lines() -> bool:
+    # Las rectas normales son solo metadata, por lo que se puede pedir que no se incluyan (normal_lines=false)
+    return request.args.get('normal_lines', 'true').lower() != 'false'
+
+def include_metrics() -> bool:
+    # Las métricas del pedido se incluyen en el resultado solo si se piden (metrics=true)
+    return request.args.get('metrics', 'false').lower() == 'true'
+
+def include_checkpoint() -> bool:
+    # El estado de cada frame se guarda solo si se pide (checkpoint=true). Un tracking retomado siempre genera uno nuevo
+    return request.args.get('checkpoint', 'false').lower() == 'true'
+
+def request_metrics() -> Optional[TrackingMetrics]:
+    return TrackingMetrics() if METRICS_ENABLED or include_metrics() else None
+
+def record_metrics(metrics: Optional[TrackingMetrics]) -> None:
+    if metrics is not None and METRICS_ENABLED:
+        metrics_registry.record(metrics)
+
+def without_normal_lines(result: TrackingResultArrays) -> TrackingResultArrays:
+    # Las rectas normales se quitan al responder, y no al trackear, para que el resultado cacheado sea siempre completo
+    return result if include_normal_lines() else dataclasses.replace(result, normal_lines=None)
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics_registry.prometheus(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    # Contadores del worker que atiende el pedido. Los aciertos y fallos de todos los workers se suman en /metrics
+    return make_response(jsonify(results_cache.stats))
+
+@app.route('/stacks', methods=['POST'])
+def create_stack():
+    # La profundidad de los frames guardados se elige al subirlos (native_depth)
+    info = stacks.create(parse_images(), ALLOWED_IMAGE_TYPES, native='native_depth' in request.form)
+    return make_response(jsonify(info), 201)
+
+@app.route('/stacks/<stack_id>', methods=['GET'])
+def stack_info(stack_id):
+    return make_response(jsonify(stacks.info(stack_id)))
+
+@app.route('/stacks/<stack_id>', methods=['DELETE'])
+def delete_stack(stack_id):
+    return make_response(jsonify(stacks.delete(stack_id)))
+
+@app.route('/checkpoints/<checkpoint_id>', methods=['GET'])
+def checkpoint_info(checkpoint_id):
+    return make_response(jsonify(checkpoints.load(checkpoint_id).info()))
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    points, images, config = parse_tracking_request()
+    return make_response(jsonify(jobs.submit(images, points, config).to_dict()), 202)
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_state(job_id):
+    jobs.expire()
+    return make_response(jsonify(jobs.state(job_id).to_dict()))
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    mimetype = request.accept_mimetypes.best_match([JSON_MIMETYPE, NPZ_MIMETYPE], default=JSON_MIMETYPE)
+    return result_response(without_normal_lines(jobs.result(job_id)), mimetype)
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    return make_response(jsonify(jobs.cancel(job_id).to_dict()))
+
+def stream_tracking(frames, points: Optional[np.ndarray], config: Config, metrics: Optional[TrackingMetrics] = None,
+                    initial_points: Optional[np.ndarray] = None, recorder: Optional[CheckpointRecorder] = None,
+                    first_record: Optional[dict] = None, initial_state: Optional[dict] = None,
+                    start_frame: int = 0, previous: Optional[TrackingResultArrays] = None) -> Response:
+    """
+    Al retomar un tracking desde el frame start_frame, previous son los frames anteriores del checkpoint (ver resumed_result):
+    se envían antes que los trackeados si tienen la misma cantidad de puntos. Si no, el último registro indica start_frame.
+    """
+    def previous_lines():
+        for frame_result in previous.frames():
+            yield json.dumps(frame_result.to_dict()) + '\n'
+
+    def generate():
+        nonlocal start_frame, previous
+        if first_record is not None:
+            yield json.dumps(first_record) + '\n'
+        errors = []
+        try:
+            frame_results = track_filament_frames(frames, points, config, errors, metrics, initial_points, **(initial_state or {}))
+            for frame_result in frame_results if recorder is None else recorder.record(frame_results):
+                # La cantidad de puntos recién se conoce con el primer frame trackeado
+                if previous is not None:
+                    if len(frame_result.points) == previous.points.shape[1]:
+                        yield from previous_lines()
+                        start_frame = 0
+                    previous = None
+                with stage(metrics, 'serialization'):
+                    line = json.dumps(frame_result.to_dict()) + '\n'
+                yield line
+            if previous is not None:
+                # No se trackeó ningún frame
+                yield from previous_lines()
+                start_frame = 0
+            log_prefetch_stats(frames)
+        except ApplicationError as e:
+            traceback.print_tb(e.__traceback__)
+            errors.append(e.message)
+        except Exception as e:
+            # Los headers ya fueron enviados, por lo que el error tiene que viajar en el ultimo registro
+            traceback.print_tb(e.__traceback__)
+            errors.append(str(e))
+
+        record_metrics(metrics)
+        last = {'errors': errors}
+        if metrics is not None and include_metrics():
+            last['metrics'] = metrics.to_dict()
+        if recorder is not None:
+            # Aunque el tracking haya fallado, los frames trackeados sirven para retomarlo
+            recorder.save()
+        if start_frame:
+            last['start_frame'] = start_frame
+        yield json.dumps(last) + '\n'
+
+    # Le indicamos a nginx que no bufferee la respuesta, sino se pierde el sentido del streaming
+    headers = {'X-Accel-Buffering': 'no'}
+    if recorder is not None:
+        headers[CHECKPOINT_HEADER] = recorder.id
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE, headers=headers)
+
+def stream_cached(result: TrackingResultArrays) -> Response:
+    def generate():
+        for frame_result in result.frames():
+            yield json.dumps(frame_result.to_dict()) + '\n'
+        yield json.dumps({'errors': result.errors}) + '\n'
 
-    return make_response(jsonify(track_filament(frames_iterator(images, ALLOWED_IMAGE_TYPES), np.array(points), config)))
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE, headers={'X-Accel-Buffering': 'no'})
 
 @app.route('/health', methods=['GET'])
 def health():
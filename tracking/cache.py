@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from typing import List, Optional
+
+import numpy as np
+
+from .metrics import TrackingMetrics
+from .models import Config, TrackingResultArrays
+
+# Se incrementa cuando un cambio en el algoritmo cambia los resultados, para invalidar lo cacheado
+CACHE_VERSION = 1
+
+@dataclass
+class CacheStats:
+    memory_hits:    int = 0
+    disk_hits:      int = 0
+    misses:         int = 0
+    memory_bytes:   int = 0
+    memory_entries: int = 0
+
+def files_digest(files, chunk_size: int = 1 << 20) -> bytes:
+    """
+    Hash de los archivos subidos (nombre y contenido). Deja los archivos al principio.
+    """
+    digest = hashlib.sha256()
+    for file in files:
+        digest.update(file.filename.encode())
+        while chunk := file.read(chunk_size):
+            digest.update(chunk)
+        file.seek(0)
+        # Separador, para que no se confundan los limites entre archivos
+        digest.update(b'\0')
+    return digest.digest()
+
+def tracking_key(files_hash: bytes, points: np.ndarray, config: Config) -> str:
+    """
+    Hash de todo lo que define un resultado: los archivos (ver files_digest), los puntos iniciales y la configuración.
+    """
+    digest = hashlib.sha256(f'v{CACHE_VERSION}'.encode())
+    digest.update(files_hash)
+    digest.update(np.ascontiguousarray(points, dtype=np.float64).tobytes())
+    digest.update(json.dumps(asdict(config), sort_keys=True).encode())
+    return digest.hexdigest()
+
+def result_nbytes(result: TrackingResultArrays) -> int:
+    return result.points.nbytes + result.status.nbytes + (result.normal_lines.nbytes if result.normal_lines is not None else 0)
+
+class ResultCache:
+    """
+    Cache de resultados de tracking indexado por tracking_key.
+    Tiene 2 niveles: un LRU en memoria (por worker) y un directorio en disco compartido por todos los workers,
+    ambos limitados en tamaño. En disco el orden LRU se lleva con la fecha de modificación de los archivos.
+    """
+    def __init__(self, root: str, memory_limit: int, disk_limit: int):
+        self.root = root
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.memory: OrderedDict[str, TrackingResultArrays] = OrderedDict()
+        self.stats = CacheStats()
+        self.lock = threading.Lock()
+        if disk_limit > 0:
+            os.makedirs(root, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.memory_limit > 0 or self.disk_limit > 0
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, f'{key}.npz')
+
+    def get(self, key: str, metrics: Optional[TrackingMetrics] = None) -> Optional[TrackingResultArrays]:
+        """
+        Resultado cacheado de key, o None. La búsqueda se cuenta en stats (del worker) y en metrics, si se pasan,
+        para que se sume a las métricas de todos los workers (ver MetricsRegistry).
+        """
+        with self.lock:
+            if (result := self.memory.get(key)) is not None:
+                self.memory.move_to_end(key)
+                self.stats.memory_hits += 1
+                if metrics is not None:
+                    metrics.cache_memory_hits += 1
+                return result
+
+        if self.disk_limit > 0:
+            try:
+                with open(self.path(key), 'rb') as f:
+                    result = TrackingResultArrays.from_npz(f)
+                os.utime(self.path(key))
+            except (FileNotFoundError, ValueError, OSError):
+                # No esta, u otro worker lo esta eliminando
+                result = None
+
+            if result is not None:
+                with self.lock:
+                    self.stats.disk_hits += 1
+                if metrics is not None:
+                    metrics.cache_disk_hits += 1
+                self._put_memory(key, result)
+                return result
+
+        with self.lock:
+            self.stats.misses += 1
+        if metrics is not None:
+            metrics.cache_misses += 1
+        return None
+
+    def put(self, key: str, result: TrackingResultArrays) -> None:
+        self._put_memory(key, result)
+        if self.disk_limit > 0:
+            # Escritura atómica, ya que otro worker puede estar leyendo
+            tmp = f'{self.path(key)}.{os.getpid()}.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(result.to_npz())
+            os.replace(tmp, self.path(key))
+            self._evict_disk()
+
+    def _put_memory(self, key: str, result: TrackingResultArrays) -> None:
+        size = result_nbytes(result)
+        if size > self.memory_limit:
+            return
+        with self.lock:
+            if key in self.memory:
+                self.stats.memory_bytes -= result_nbytes(self.memory.pop(key))
+            self.memory[key] = result
+            self.stats.memory_bytes += size
+            while self.stats.memory_bytes > self.memory_limit:
+                _, evicted = self.memory.popitem(last=False)
+                self.stats.memory_bytes -= result_nbytes(evicted)
+            self.stats.memory_entries = len(self.memory)
+
+    def _evict_disk(self) -> None:
+        entries: List[os.DirEntry] = [entry for entry in os.scandir(self.root) if entry.name.endswith('.npz')]
+        files = []
+        for entry in entries:
+            try:
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+            except FileNotFoundError:
+                pass
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_limit:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,246 @@
+import io
+import json
+import os
+import uuid
+from dataclasses import dataclass, asdict
+from typing import Iterable, Iterator, List, Optional
+
+import numpy as np
+
+from .models import ApplicationError, Config, TrackingFrameArrays, TrackingResultArrays
+
+# Estado de cada frame (en el orden de CheckpointSegment): el del resultado siempre existe,
+# y el opcional solo con algunas configuraciones
+FRAME_STATE = ('points', 'status', 'normal_lines')
+OPTIONAL_STATE = ('fit_params', 'motion')
+
+def stack_state(frames_state: List[Optional[np.ndarray]]) -> Optional[np.ndarray]:
+    return np.stack(frames_state) if frames_state and all(state is not None for state in frames_state) else None
+
+@dataclass
+class CheckpointSegment:
+    """
+    Frames consecutivos trackeados en una misma corrida, con una misma configuración.
+    """
+    start_frame:    int
+    config:         Config
+    # (n_frames, n_points, 2) float64: puntos finales de cada frame, que son el estado con el que se trackea el siguiente.
+    # Se guardan en float64 (y no en float32 como en el resultado), para que retomar sin cambios de exactamente lo mismo
+    points:         np.ndarray
+    # (n_frames, n_points) uint8 y (n_frames, n_points, 2, 2) int32: el resto del resultado de cada frame,
+    # para devolver el resultado completo al retomar (ver Checkpoint.result)
+    status:         np.ndarray
+    normal_lines:   np.ndarray
+    # (n_frames, n_points, 4) parámetros del ajuste gaussiano de cada frame (ver Config.warm_start), si se usaron
+    fit_params:     Optional[np.ndarray] = None
+    # (n_frames, n_points, 2) estado del modelo de movimiento de cada frame (ver Config.motion_prediction), si se usó
+    motion:         Optional[np.ndarray] = None
+
+    @property
+    def end_frame(self) -> int:
+        return self.start_frame + len(self.points)
+
+@dataclass
+class Checkpoint:
+    """
+    Estado por frame de un tracking, para poder retomarlo desde cualquier frame (ver CheckpointRecorder).
+    Un tracking retomado con otros puntos o configuración agrega un segmento, por lo que puede tener varios.
+    """
+    id:         str
+    digest:     str     # Hash de los frames trackeados (ver files_digest)
+    segments:   List[CheckpointSegment]
+
+    @property
+    def frames(self) -> int:
+        return self.segments[-1].end_frame if self.segments else 0
+
+    def segment(self, frame: int) -> CheckpointSegment:
+        for segment in self.segments:
+            if segment.start_frame <= frame < segment.end_frame:
+                return segment
+        raise ApplicationError(f'Checkpoint {self.id} has no frame {frame}. It has {self.frames} frames')
+
+    def points(self, frame: int) -> np.ndarray:
+        segment = self.segment(frame)
+        return segment.points[frame - segment.start_frame]
+
+    def fit_params(self, frame: int) -> Optional[np.ndarray]:
+        segment = self.segment(frame)
+        return segment.fit_params[frame - segment.start_frame] if segment.fit_params is not None else None
+
+    def motion(self, frame: int) -> Optional[np.ndarray]:
+        segment = self.segment(frame)
+        return segment.motion[frame - segment.start_frame] if segment.motion is not None else None
+
+    def config(self, frame: int) -> Config:
+        return self.segment(frame).config
+
+    def result(self, end: int, points_dtype: Optional[np.dtype] = np.float32) -> Optional[TrackingResultArrays]:
+        """
+        Resultado de los frames [0, end), tal como se trackearon. Los puntos son float32 como en el resultado;
+        con points_dtype None mantienen el tipo con el que se trackearon (el que envía el streaming).
+        None si no hay frames, o si los segmentos tienen distinta cantidad de puntos (se retomó con otros puntos),
+        ya que no entran en los mismos arreglos.
+        """
+        points, status, normal_lines = [], [], []
+        for segment in self.segments:
+            if segment.start_frame >= end:
+                break
+            count = end - segment.start_frame
+            points.append(segment.points[:count] if points_dtype is None else segment.points[:count].astype(points_dtype))
+            status.append(segment.status[:count])
+            normal_lines.append(segment.normal_lines[:count])
+        if not points or len({frame_points.shape[1] for frame_points in points}) > 1:
+            return None
+        return TrackingResultArrays(np.concatenate(points), np.concatenate(status), np.concatenate(normal_lines))
+
+    def info(self) -> dict:
+        return {
+            'id':       self.id,
+            'frames':   self.frames,
+            'segments': [{'start_frame': s.start_frame, 'frames': len(s.points), 'points': s.points.shape[1], 'config': s.config} for s in self.segments],
+        }
+
+    def to_npz(self) -> bytes:
+        arrays = {'digest': np.array(self.digest)}
+        for i, segment in enumerate(self.segments):
+            arrays[f'segment_{i}_start_frame'] = np.array(segment.start_frame)
+            arrays[f'segment_{i}_config'] = np.array(json.dumps(asdict(segment.config)))
+            for name in FRAME_STATE:
+                arrays[f'segment_{i}_{name}'] = getattr(segment, name)
+            for name in OPTIONAL_STATE:
+                if getattr(segment, name) is not None:
+                    arrays[f'segment_{i}_{name}'] = getattr(segment, name)
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_npz(cls, checkpoint_id: str, file) -> 'Checkpoint':
+        with np.load(file) as data:
+            segments = []
+            while f'segment_{len(segments)}_points' in data.files:
+                prefix = f'segment_{len(segments)}_'
+                segments.append(CheckpointSegment(
+                    int(data[prefix + 'start_frame']),
+                    Config(**json.loads(data[prefix + 'config'].item())),
+                    *(data[prefix + name] for name in FRAME_STATE),
+                    *(data[prefix + name] if prefix + name in data.files else None for name in OPTIONAL_STATE),
+                ))
+            return cls(checkpoint_id, data['digest'].item(), segments)
+
+class CheckpointRecorder:
+    """
+    Acumula el estado de cada frame a medida que se trackea, y al terminar guarda el checkpoint.
+    Si se retoma un checkpoint (parent), el nuevo checkpoint mantiene sus frames anteriores a start_frame.
+    """
+    def __init__(self, store: 'CheckpointStore', digest: str, config: Config, start_frame: int = 0, parent: Optional[Checkpoint] = None):
+        self.store = store
+        self.id = store.new_id()
+        self.digest = digest
+        self.config = config
+        self.start_frame = start_frame
+        self.parent = parent
+        self.points: List[np.ndarray] = []
+        self.fit_params: List[Optional[np.ndarray]] = []
+        self.motion: List[Optional[np.ndarray]] = []
+        self.status: List[np.ndarray] = []
+        self.normal_lines: List[np.ndarray] = []
+
+    def record(self, frames: Iterable[TrackingFrameArrays]) -> Iterator[TrackingFrameArrays]:
+        for frame in frames:
+            self.points.append(frame.points)
+            self.fit_params.append(frame.fit_params)
+            self.motion.append(frame.motion)
+            self.status.append(frame.status)
+            # Mismo tipo que en el resultado (ver TrackingResultArrays.from_frames)
+            self.normal_lines.append(frame.normal_lines.astype(np.int32))
+            yield frame
+
+    def save(self) -> Checkpoint:
+        segments = []
+        for segment in self.parent.segments if self.parent is not None else ():
+            if segment.start_frame >= self.start_frame:
+                break
+            # Se recorta el segmento que contiene a start_frame
+            end = self.start_frame - segment.start_frame
+            state = (getattr(segment, name)[:end] for name in FRAME_STATE)
+            optional_state = (getattr(segment, name)[:end] if getattr(segment, name) is not None else None for name in OPTIONAL_STATE)
+            segments.append(CheckpointSegment(segment.start_frame, segment.config, *state, *optional_state))
+        if self.points:
+            state = (np.stack(getattr(self, name)) for name in FRAME_STATE)
+            optional_state = (stack_state(getattr(self, name)) for name in OPTIONAL_STATE)
+            segments.append(CheckpointSegment(self.start_frame, self.config, *state, *optional_state))
+
+        checkpoint = Checkpoint(self.id, self.digest, segments)
+        self.store.save(checkpoint)
+        return checkpoint
+
+class CheckpointStore:
+    """
+    Checkpoints de tracking, en un directorio compartido por todos los workers de gunicorn.
+    El tamaño total está limitado, y se eliminan primero los checkpoints usados hace más tiempo
+    (el orden LRU se lleva con la fecha de modificación de los archivos, como en ResultCache).
+    """
+    def __init__(self, root: str, disk_limit: int):
+        self.root = root
+        self.disk_limit = disk_limit
+        if disk_limit > 0:
+            os.makedirs(root, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.disk_limit > 0
+
+    def new_id(self) -> str:
+        if not self.enabled:
+            raise ApplicationError('Tracking checkpoints are disabled')
+        return uuid.uuid4().hex
+
+    def path(self, checkpoint_id: str) -> str:
+        # El id es siempre un uuid en hexadecimal. Lo validamos para no salir de root
+        if len(checkpoint_id) != 32 or any(c not in '0123456789abcdef' for c in checkpoint_id):
+            raise ApplicationError(f'Checkpoint {checkpoint_id} not found')
+        return os.path.join(self.root, f'{checkpoint_id}.npz')
+
+    def load(self, checkpoint_id: str) -> Checkpoint:
+        path = self.path(checkpoint_id)
+        try:
+            with open(path, 'rb') as f:
+                checkpoint = Checkpoint.from_npz(checkpoint_id, f)
+            os.utime(path)
+        except FileNotFoundError:
+            raise ApplicationError(f'Checkpoint {checkpoint_id} not found')
+        return checkpoint
+
+    def save(self, checkpoint: Checkpoint) -> None:
+        # Escritura atómica, ya que otro worker puede estar leyendo
+        path = self.path(checkpoint.id)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(checkpoint.to_npz())
+        os.replace(tmp, path)
+        self.evict(keep=path)
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        files = []
+        for entry in os.scandir(self.root):
+            if not entry.name.endswith('.npz'):
+                continue
+            try:
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+            except FileNotFoundError:
+                pass
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_limit:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
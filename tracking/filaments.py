@@ -0,0 +1,165 @@
+import multiprocessing
+import queue
+import traceback
+from typing import Iterable, List, Tuple, Optional
+
+import numpy as np
+
+from .main import track_filament_frames
+from .metrics import TrackingMetrics
+from .models import ApplicationError, Config, TrackingFrameArrays, TrackingResultArrays
+
+# Un filamento a trackear: sus puntos iniciales y su configuración
+Filament = Tuple[np.ndarray, Config]
+
+# Cada cuántos segundos se verifica que los workers sigan vivos mientras se espera por sus colas
+WORKER_POLL_INTERVAL = 1.0
+
+class FrameFeed:
+    """
+    Iterador que siempre retorna el frame actual. Permite avanzar varios trackers en paralelo sobre el mismo frame,
+    ya que track_filament_frames consume exactamente un frame por cada resultado que produce.
+    """
+    def __init__(self):
+        self.frame: Optional[np.ndarray] = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> np.ndarray:
+        return self.frame
+
+class FilamentsTracker:
+    """
+    Trackea varios filamentos a la par, frame a frame, sobre los mismos frames.
+    Con metrics, cada resultado incluye las métricas de su filamento.
+    """
+    def __init__(self, filaments: List[Filament], metrics: bool = False):
+        self.feed = FrameFeed()
+        self.errors: List[List[str]] = [[] for _ in filaments]
+        self.metrics: List[Optional[TrackingMetrics]] = [TrackingMetrics() if metrics else None for _ in filaments]
+        self.trackers = [
+            track_filament_frames(self.feed, points, config, errors, filament_metrics)
+            for (points, config), errors, filament_metrics in zip(filaments, self.errors, self.metrics)
+        ]
+        self.frames: List[List[TrackingFrameArrays]] = [[] for _ in filaments]
+
+    def push(self, frame: np.ndarray) -> None:
+        self.feed.frame = frame
+        for tracker, frames in zip(self.trackers, self.frames):
+            frames.append(next(tracker))
+
+    def results(self, include_normal_lines: bool = True) -> List[TrackingResultArrays]:
+        results = []
+        for frames, errors, metrics in zip(self.frames, self.errors, self.metrics):
+            result = TrackingResultArrays.from_frames(frames, errors, include_normal_lines)
+            result.metrics = metrics.to_dict() if metrics is not None else None
+            results.append(result)
+        return results
+
+def track_filaments(frames: Iterable[np.ndarray], filaments: List[Filament], workers: int = 1, include_normal_lines: bool = True, queue_size: int = 4,
+                    metrics: bool = False) -> List[TrackingResultArrays]:
+    """
+    Trackea varios filamentos sobre la misma secuencia de frames, decodificando cada frame una sola vez.
+    Con más de un worker, los filamentos se reparten entre procesos y cada frame se les envía a todos.
+    Retorna un resultado por filamento, en el mismo orden. Con metrics, cada resultado incluye las métricas de su filamento.
+    """
+    workers = min(workers, len(filaments))
+    if workers <= 1:
+        tracker = FilamentsTracker(filaments, metrics)
+        for frame in frames:
+            tracker.push(frame)
+        return tracker.results(include_normal_lines)
+
+    # Repartimos los filamentos entre los workers de forma intercalada
+    groups = [list(range(i, len(filaments), workers)) for i in range(workers)]
+    ctx = multiprocessing.get_context()
+    result_queue = ctx.Queue()
+    frame_queues = [ctx.Queue(maxsize=queue_size) for _ in groups]
+    processes = [
+        ctx.Process(target=filaments_worker, args=(worker_idx, frame_queue, result_queue, [filaments[i] for i in group], include_normal_lines, metrics), daemon=True)
+        for worker_idx, (frame_queue, group) in enumerate(zip(frame_queues, groups))
+    ]
+    for process in processes:
+        process.start()
+
+    ret: List[Optional[TrackingResultArrays]] = [None] * len(filaments)
+    errors = []
+    try:
+        for frame in frames:
+            for frame_queue, process in zip(frame_queues, processes):
+                put_to_worker(frame_queue, frame, process)
+
+        # Avisamos que no hay mas frames
+        for frame_queue, process in zip(frame_queues, processes):
+            put_to_worker(frame_queue, None, process)
+
+        pending = set(range(len(groups)))
+        while pending:
+            worker_idx, results, error = get_from_workers(result_queue, [processes[i] for i in pending])
+            pending.discard(worker_idx)
+            if error is not None:
+                errors.append(error)
+                continue
+            for filament_idx, result in zip(groups[worker_idx], results):
+                ret[filament_idx] = result
+    except BaseException:
+        # Si falla la decodificación o muere un worker no vamos a leer los resultados, por lo que no tiene sentido esperar a los workers
+        for process in processes:
+            process.terminate()
+        raise
+
+    for process in processes:
+        process.join()
+
+    if errors:
+        raise ApplicationError('; '.join(errors))
+
+    return ret
+
+def put_to_worker(frame_queue, item, process) -> None:
+    # Si el worker muere, su cola se llena y un put sin timeout bloquearía para siempre
+    while True:
+        try:
+            frame_queue.put(item, timeout=WORKER_POLL_INTERVAL)
+            return
+        except queue.Full:
+            if process.exitcode is not None:
+                raise ApplicationError(f'Filament tracking worker died unexpectedly (exit code {process.exitcode})')
+
+def get_from_workers(result_queue, processes: list):
+    """
+    Espera el resultado de alguno de los workers processes, que todavía no reportaron.
+    Falla si alguno termina sin reportar, ya que su resultado nunca va a llegar.
+    """
+    while True:
+        try:
+            return result_queue.get(timeout=WORKER_POLL_INTERVAL)
+        except queue.Empty:
+            dead = [process for process in processes if process.exitcode is not None]
+            if not dead:
+                continue
+        # Un worker que terminó bien envió su resultado antes de salir: le damos una última oportunidad de llegar
+        try:
+            return result_queue.get(timeout=WORKER_POLL_INTERVAL)
+        except queue.Empty:
+            raise ApplicationError(f'Filament tracking worker died unexpectedly (exit code {dead[0].exitcode})') from None
+
+def filaments_worker(worker_idx: int, frame_queue, result_queue, filaments: List[Filament], include_normal_lines: bool, metrics: bool = False) -> None:
+    results = None
+    error = None
+    tracker = FilamentsTracker(filaments, metrics)
+
+    # Aunque falle el tracking seguimos consumiendo frames, para no bloquear al proceso principal
+    while (frame := frame_queue.get()) is not None:
+        if error is None:
+            try:
+                tracker.push(frame)
+            except Exception as e:
+                traceback.print_exc()
+                error = str(e)
+
+    if error is None:
+        results = tracker.results(include_normal_lines)
+
+    result_queue.put((worker_idx, results, error))
@@ -1,5 +1,11 @@
+import io
+import itertools
 import os
-from typing import List, Iterator
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, List, Iterator, Iterable, Optional, Tuple
 
 import numpy as np
 from PIL import Image, ImageSequence
@@ -41,22 +47,315 @@ def to_bw(data: np.ndarray) -> np.ndarray:
 def img_to_8bit_array(img) -> np.ndarray:
     return normalize(to_bw(np.asarray(img)), np.uint8)
 
-def frames_iterator(files, allowed_ext: List[str]) -> Iterator[np.ndarray]:
+# Tipos que se trackean tal cual en el pipeline nativo. El resto se convierte a float32
+NATIVE_DTYPES = (np.uint8, np.uint16, np.float32)
+
+def to_gray(data: np.ndarray) -> np.ndarray:
+    """
+    Igual que to_bw, pero sin pasar por float64: los enteros se promedian acumulando en uint32 y
+    se mantienen en su tipo original, los floats se promedian en float32.
+    """
+    shape = data.shape
+    if len(shape) == 2:
+        return data
+    elif len(shape) == 3:
+        if shape[2] == 1:
+            return data.squeeze(axis=2)
+        elif shape[2] == 3 or shape[2] == 4:
+            # rgba -> Ignoramos alpha
+            rgb = data[..., :3]
+            if np.issubdtype(data.dtype, np.integer):
+                return (rgb.sum(axis=2, dtype=np.uint32) // 3).astype(data.dtype)
+            return rgb.sum(axis=2, dtype=np.float32) / np.float32(3)
+
+    raise ValueError(f'Unknown image shape: {shape}')
+
+def to_native(data: np.ndarray) -> np.ndarray:
+    if data.dtype in NATIVE_DTYPES:
+        return data
+    if data.dtype == np.bool_:
+        return data.astype(np.uint8)
+    # Mismo tipo con el orden de bytes de la máquina (por ejemplo, TIFF big endian de 16 bits)
+    if (native := data.dtype.newbyteorder('=')) in NATIVE_DTYPES:
+        return data.astype(native)
+    return data.astype(np.float32)
+
+def img_to_native_array(img) -> np.ndarray:
+    """
+    Frame en escala de grises con su profundidad original (8 o 16 bits) o en float32, sin normalizar.
+    """
+    return to_native(to_gray(np.asarray(img)))
+
+def raw_shape(file) -> Tuple[int, int, int, int]:
+    """
+    Forma (frames, height, width, channels) de un archivo .raw (uint8), a partir de su nombre:
+    {name}-{height}_{width}_{channels} para un solo frame, o {name}-{frames}_{height}_{width}_{channels} para un stack.
+    """
+    name = os.path.splitext(file.filename)[0]
+    try:
+        shape = tuple(map(int, name[name.rindex('-') + 1:].split('_')))
+    except ValueError:
+        shape = ()
+    if len(shape) == 3:
+        shape = (1, *shape)
+    if len(shape) != 4 or min(shape) < 1:
+        raise ApplicationError(f'file {file.filename} does not follow the raw naming scheme: {{name}}-[{{frames}}_]{{height}}_{{width}}_{{channels}}.raw')
+    return shape
+
+def frames_count(files, allowed_ext: List[str]) -> int:
+    """
+    Cantidad de frames que va a generar frames_iterator, sin decodificarlos. Deja los archivos al principio.
+    """
+    count = 0
     for file in files:
-        name: str
-        ext: str
-        name, ext = os.path.splitext(file.filename)
-        ext = ext.lower()
+        ext = os.path.splitext(file.filename)[1].lower()
+        if ext not in allowed_ext:
+            raise ApplicationError(f'file {file.filename} extension is not supported')
+
+        if ext == '.raw':
+            count += raw_shape(file)[0]
+        else:
+            with Image.open(file) as img:
+                count += getattr(img, 'n_frames', 1)
+        file.seek(0)
+    return count
+
+def file_buffer(file) -> np.ndarray:
+    """
+    Contenido completo del archivo como un arreglo uint8, evitando copiarlo:
+    si el archivo está en disco se mapea en memoria (np.memmap), y si está en memoria (BytesIO) se usa su buffer.
+    """
+    stream = getattr(file, 'stream', file)
+    try:
+        stream.fileno()
+        stream.seek(0, os.SEEK_END)
+        if stream.tell() == 0:
+            return np.zeros(0, dtype=np.uint8)
+        # asarray: vista como ndarray común, para que no se propague la subclase memmap
+        return np.asarray(np.memmap(stream, dtype=np.uint8, mode='r'))
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        pass
+
+    if isinstance(stream, io.BytesIO):
+        return np.frombuffer(stream.getbuffer(), dtype=np.uint8)
+    stream.seek(0)
+    return np.frombuffer(stream.read(), dtype=np.uint8)
+
+def frames_iterator(files, allowed_ext: List[str], native: bool = False, start: int = 0) -> Iterator[np.ndarray]:
+    """
+    Decodifica los frames de todos los archivos, en orden, a partir del frame start.
+    Por defecto se normalizan a 8 bits. Con native se mantiene la profundidad original (ver img_to_native_array).
+    Los .raw y los TIFF sin comprimir no se decodifican: cada frame es una vista del archivo mapeado en memoria.
+    """
+    for frame in lazy_frames_iterator(files, allowed_ext, native, start):
+        yield frame.read()[0]
+
+# Región (x0, y0, x1, y1) de un frame, sin incluir x1 ni y1
+Region = Tuple[int, int, int, int]
 
+class LazyFrame:
+    """
+    Frame que todavía no fue decodificado. Permite decodificar y convertir solo una región.
+    Tiene que leerse antes de pedir el siguiente frame al iterador que lo generó.
+    """
+    def __init__(self, width: int, height: int, to_array: Callable[[np.ndarray], np.ndarray]):
+        self.width = width
+        self.height = height
+        self.to_array = to_array
+
+    def read(self, region: Optional[Region] = None) -> Tuple[np.ndarray, Tuple[int, int]]:
+        """
+        Retorna la región del frame (recortada a los límites de la imagen) y su posición (x0, y0) en el frame.
+        Sin región se retorna el frame completo.
+        """
+        if region is None:
+            region = (0, 0, self.width, self.height)
+        x0, y0, x1, y1 = region
+        x0, x1 = np.clip((x0, x1), 0, self.width)
+        y0, y1 = np.clip((y0, y1), 0, self.height)
+        return self.to_array(self._read(int(x0), int(y0), int(x1), int(y1))), (int(x0), int(y0))
+
+    def _read(self, x0: int, y0: int, x1: int, y1: int) -> np.ndarray:
+        raise NotImplementedError
+
+class ArrayFrame(LazyFrame):
+    """
+    Frame que ya es un arreglo, normalmente una vista de un archivo mapeado en memoria (.raw).
+    Leer una región no copia nada: solo se acceden las paginas del archivo que la contienen.
+    """
+    def __init__(self, frame: np.ndarray, to_array: Callable[[np.ndarray], np.ndarray]):
+        super().__init__(frame.shape[1], frame.shape[0], to_array)
+        self.frame = frame
+
+    def _read(self, x0: int, y0: int, x1: int, y1: int) -> np.ndarray:
+        return self.frame[y0:y1, x0:x1]
+
+# Modos de PIL que se pueden leer directamente de las tiras de un TIFF sin comprimir: (tipo, canales)
+TIFF_STRIP_MODES = {
+    'L':        ('u1', 1),
+    'RGB':      ('u1', 3),
+    'RGBA':     ('u1', 4),
+    'I;16':     ('u2', 1),
+    'I;16B':    ('u2', 1),
+    'F':        ('f4', 1),
+}
+
+class PilFrame(LazyFrame):
+    """
+    Frame de PIL. Si es un TIFF sin comprimir organizado en tiras, las filas se toman directamente del archivo
+    mapeado en memoria (sin copiar, si las tiras son contiguas). Si no, se decodifica con PIL y solo se convierte la región.
+    """
+    def __init__(self, img, buffer: Optional[np.ndarray], byte_order: Optional[str], to_array: Callable[[np.ndarray], np.ndarray]):
+        super().__init__(img.width, img.height, to_array)
+        self.img = img
+        self.buffer = buffer
+        self.byte_order = byte_order
+
+    def _read(self, x0: int, y0: int, x1: int, y1: int) -> np.ndarray:
+        rows = self._read_tiff_strips(y0, y1) if self.byte_order is not None else None
+        if rows is not None:
+            return rows[:, x0:x1]
+        if (x0, y0, x1, y1) == (0, 0, self.width, self.height):
+            return np.asarray(self.img)
+        return np.asarray(self.img.crop((x0, y0, x1, y1)))
+
+    def _read_tiff_strips(self, y0: int, y1: int) -> Optional[np.ndarray]:
+        tags = self.img.tag_v2
+        # Compresión, configuración planar y tiles
+        if tags.get(259, 1) != 1 or tags.get(284, 1) != 1 or 322 in tags or self.img.mode not in TIFF_STRIP_MODES:
+            return None
+        # Interpretación fotométrica: solo BlackIsZero y RGB se leen tal cual (WhiteIsZero, paletas, etc. los convierte PIL)
+        if tags.get(262) not in (1, 2):
+            return None
+        kind, channels = TIFF_STRIP_MODES[self.img.mode]
+        dtype = np.dtype(self.byte_order + kind)
+        bits = tags.get(258, (8,))
+        if any(b != dtype.itemsize * 8 for b in (bits if isinstance(bits, tuple) else (bits,))):
+            return None
+
+        rows_per_strip = min(tags.get(278, self.height), self.height)
+        offsets, counts = tags[273], tags[279]
+        row_size = self.width * channels * dtype.itemsize
+        first, last = y0 // rows_per_strip, (y1 - 1) // rows_per_strip
+
+        def strips_rows(start: int, end: int) -> np.ndarray:
+            # Filas de las tiras [start, end], que tienen que estar contiguas en el archivo
+            count = min((end + 1) * rows_per_strip, self.height) - start * rows_per_strip
+            data = self.buffer[offsets[start]:offsets[start] + count * row_size]
+            return data.view(dtype).reshape((count, self.width, channels) if channels > 1 else (count, self.width))
+
+        if all(offsets[strip] + counts[strip] == offsets[strip + 1] for strip in range(first, last)):
+            rows = strips_rows(first, last)
+        else:
+            rows = np.concatenate([strips_rows(strip, strip) for strip in range(first, last + 1)])
+
+        start = y0 - first * rows_per_strip
+        return rows[start:start + y1 - y0]
+
+def lazy_frames_iterator(files, allowed_ext: List[str], native: bool = False, start: int = 0) -> Iterator[LazyFrame]:
+    """
+    Igual que frames_iterator, pero los frames se decodifican recién al leerlos (ver LazyFrame), y solo en la región pedida.
+    Los frames anteriores a start se saltean sin decodificarlos.
+    """
+    return itertools.islice(_lazy_frames(files, allowed_ext, native), start, None)
+
+def _lazy_frames(files, allowed_ext: List[str], native: bool) -> Iterator[LazyFrame]:
+    to_array = img_to_native_array if native else img_to_8bit_array
+    for file in files:
+        ext = os.path.splitext(file.filename)[1].lower()
         if ext not in allowed_ext:
             raise ApplicationError(f'file {file.filename} extension is not supported')
 
         if ext == '.raw':
-            # We take shape from name using raw naming scheme: {name}-{height}_{width}_{channels}
-            shape = tuple(map(int, name[name.rindex('-'):].split('_')))
-            img = np.fromfile(file, dtype=np.uint8).reshape(shape)
-            yield img_to_8bit_array(img)
+            shape = raw_shape(file)
+            buffer = file_buffer(file)
+            if buffer.size != np.prod(shape):
+                raise ApplicationError(f'file {file.filename} size ({buffer.size} bytes) does not match its shape {shape}')
+            for frame in buffer.reshape(shape):
+                yield ArrayFrame(frame, to_array)
         else:
+            buffer, byte_order = None, None
+            if ext in ('.tif', '.tiff'):
+                buffer = file_buffer(file)
+                byte_order = {b'II': '<', b'MM': '>'}.get(buffer[:2].tobytes())
+            file.seek(0)
             with Image.open(file) as img:
                 for frame in ImageSequence.Iterator(img):
-                    yield img_to_8bit_array(frame)
+                    yield PilFrame(frame, buffer, byte_order, to_array)
+
+@dataclass
+class PrefetchStats:
+    frames:         int     = 0
+    decode_time:    float   = 0     # Tiempo que el hilo de fondo estuvo decodificando
+    wait_time:      float   = 0     # Tiempo que el consumidor estuvo esperando un frame
+    total_time:     float   = 0     # Tiempo desde el primer pedido hasta el último frame entregado
+
+    @property
+    def overlap(self) -> float:
+        """
+        Proporción de la decodificación que corrió en paralelo con el consumidor (1 = totalmente solapada).
+        """
+        return 1 - self.wait_time / self.decode_time if self.decode_time > 0 else 0
+
+class FramePrefetcher:
+    """
+    Decodifica los frames en un hilo de fondo, adelantandose a lo sumo depth frames al consumidor.
+    De esta forma la decodificación (PIL, to_bw, normalize) corre a la par del tracking.
+    Los errores de la decodificación se relanzan en el consumidor, en el frame en el que ocurrieron.
+    """
+    _END = object()
+
+    def __init__(self, frames: Iterable[np.ndarray], depth: int):
+        self.frames = frames
+        self.queue: queue.Queue = queue.Queue(maxsize=max(depth, 1))
+        self.stop = threading.Event()
+        self.stats = PrefetchStats()
+        self.thread = threading.Thread(target=self._decode, daemon=True)
+
+    def _put(self, item) -> bool:
+        # Esperamos lugar en la cola, salvo que el consumidor haya abandonado la iteración
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _decode(self) -> None:
+        try:
+            frames = iter(self.frames)
+            while True:
+                start = time.perf_counter()
+                frame = next(frames, self._END)
+                self.stats.decode_time += time.perf_counter() - start
+                if frame is self._END or not self._put(frame):
+                    break
+        except BaseException as e:
+            self._put(e)
+            return
+        self._put(self._END)
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        self.thread.start()
+        start = time.perf_counter()
+        try:
+            while True:
+                wait = time.perf_counter()
+                item = self.queue.get()
+                self.stats.wait_time += time.perf_counter() - wait
+                if item is self._END:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                self.stats.frames += 1
+                yield item
+        finally:
+            self.stats.total_time = time.perf_counter() - start
+            self.stop.set()
+
+def prefetch_frames(frames: Iterable[np.ndarray], depth: int) -> Iterable[np.ndarray]:
+    """
+    Si depth es positivo, los frames se decodifican por adelantado en un hilo de fondo (ver FramePrefetcher).
+    """
+    return FramePrefetcher(frames, depth) if depth > 0 else frames
@@ -0,0 +1,267 @@
+import json
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, asdict, field
+from enum import Enum
+from functools import lru_cache
+from typing import List, Optional
+
+import numpy as np
+from werkzeug.datastructures import FileStorage
+
+from .image_utils import frames_iterator, frames_count, lazy_frames_iterator, prefetch_frames
+from .main import track_filament_frames
+from .metrics import MetricsRegistry, TrackingMetrics, timed_frames
+from .models import ApplicationError, Config, TrackingResultArrays
+from .processes import process_alive, process_id
+
+class JobStatus(str, Enum):
+    QUEUED      = 'QUEUED'
+    RUNNING     = 'RUNNING'
+    DONE        = 'DONE'
+    FAILED      = 'FAILED'
+    CANCELLED   = 'CANCELLED'
+
+PENDING_STATUSES = (JobStatus.QUEUED, JobStatus.RUNNING)
+
+@dataclass
+class JobState:
+    id:             str
+    status:         JobStatus   = JobStatus.QUEUED
+    frames_done:    int         = 0
+    frames_total:   Optional[int] = None
+    errors:         List[str]   = field(default_factory=list)
+    created:        float       = field(default_factory=time.time)
+    finished:       Optional[float] = None
+    # Proceso responsable del trabajo pendiente (ver process_id): el worker en cuyo pool está encolado, o el que lo corre
+    owner:          Optional[str] = None
+
+    def to_dict(self) -> dict:
+        # El proceso responsable es interno, y no se expone en la API
+        ret = asdict(self)
+        del ret['owner']
+        return ret
+
+class JobCancelled(Exception):
+    pass
+
+class JobStore:
+    """
+    Trabajos de tracking asincrónicos.
+    Todo el estado vive en el sistema de archivos (un directorio por trabajo), para que cualquier worker de gunicorn
+    pueda consultar un trabajo creado por otro. Cada worker corre sus trabajos en su propio pool de procesos.
+    Solo el proceso que corre el trabajo escribe su estado; la cancelación se comunica mediante un archivo marcador.
+    Si el proceso responsable de un trabajo pendiente muere, cualquier worker lo marca como fallido (ver expire).
+    """
+    STATE_FILE  = 'state.json'
+    CONFIG_FILE = 'config.json'
+    POINTS_FILE = 'points.json'
+    RESULT_FILE = 'result.npz'
+    CANCEL_FILE = 'cancel'
+    IMAGES_DIR  = 'images'
+
+    def __init__(self, root: str, allowed_ext: List[str], workers: int, max_pending: int, ttl: float, prefetch: int = 0, metrics_root: Optional[str] = None):
+        self.root = root
+        self.metrics_root = metrics_root
+        self.prefetch = prefetch
+        self.allowed_ext = allowed_ext
+        self.workers = workers
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self._pool: Optional[ProcessPoolExecutor] = None
+        os.makedirs(root, exist_ok=True)
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        # Se crea recién cuando se necesita, para que cada worker de gunicorn (post fork) tenga el suyo
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def job_dir(self, job_id: str) -> str:
+        # El id es siempre un uuid en hexadecimal. Lo validamos para no salir de root
+        if len(job_id) != 32 or any(c not in '0123456789abcdef' for c in job_id) or not os.path.isdir(path := os.path.join(self.root, job_id)):
+            raise ApplicationError(f'Job {job_id} not found')
+        return path
+
+    def submit(self, images: List[FileStorage], points: np.ndarray, config: Config) -> JobState:
+        self.expire()
+        if self.pending_count() >= self.max_pending:
+            raise ApplicationError(f'Too many pending tracking jobs ({self.max_pending}). Try again later.')
+
+        state = JobState(uuid.uuid4().hex, owner=process_id())
+        job_dir = os.path.join(self.root, state.id)
+        images_dir = os.path.join(job_dir, self.IMAGES_DIR)
+        os.makedirs(images_dir)
+        write_state(job_dir, state)
+
+        # Guardamos las imagenes con su nombre original (prefijado con su orden), ya que la extension define como se leen
+        for i, image in enumerate(images):
+            if os.path.splitext(image.filename)[1].lower() not in self.allowed_ext:
+                shutil.rmtree(job_dir, ignore_errors=True)
+                raise ApplicationError(f'file {image.filename} extension is not supported')
+            image.save(os.path.join(images_dir, f'{i:06d}_{os.path.basename(image.filename)}'))
+        with open(os.path.join(job_dir, self.CONFIG_FILE), 'w') as f:
+            json.dump(asdict(config), f)
+        with open(os.path.join(job_dir, self.POINTS_FILE), 'w') as f:
+            json.dump(np.asarray(points).tolist(), f)
+
+        self.pool.submit(run_job, job_dir, self.allowed_ext, self.prefetch, metrics_root=self.metrics_root)
+        return state
+
+    def state(self, job_id: str) -> JobState:
+        return read_state(self.job_dir(job_id))
+
+    def result(self, job_id: str) -> TrackingResultArrays:
+        job_dir = self.job_dir(job_id)
+        state = read_state(job_dir)
+        if state.status != JobStatus.DONE:
+            raise ApplicationError(f'Job {job_id} has no result. Current status: {state.status.value}')
+        with open(os.path.join(job_dir, self.RESULT_FILE), 'rb') as f:
+            return TrackingResultArrays.from_npz(f)
+
+    def cancel(self, job_id: str) -> JobState:
+        """
+        Cancela un trabajo pendiente. Si el trabajo ya terminó, se elimina junto con su resultado.
+        Un trabajo encolado se marca como cancelado en el momento, para que deje de contar en max_pending.
+        Si justo empezaba a correr, el proceso que lo corre lo cancela al ver el archivo marcador.
+        """
+        job_dir = self.job_dir(job_id)
+        state = read_state(job_dir)
+        if state.status in PENDING_STATUSES:
+            open(os.path.join(job_dir, self.CANCEL_FILE), 'w').close()
+            if state.status == JobStatus.QUEUED:
+                state.status, state.finished = JobStatus.CANCELLED, time.time()
+                write_state(job_dir, state)
+        else:
+            shutil.rmtree(job_dir, ignore_errors=True)
+        return state
+
+    def pending_count(self) -> int:
+        count = 0
+        for job_dir in self.job_dirs():
+            try:
+                count += read_state(job_dir).status in PENDING_STATUSES
+            except FileNotFoundError:
+                # Otro worker lo esta creando o eliminando
+                pass
+        return count
+
+    def job_dirs(self) -> List[str]:
+        return [path for entry in os.listdir(self.root) if os.path.isdir(path := os.path.join(self.root, entry))]
+
+    def expire(self) -> None:
+        """
+        Un trabajo terminado expira cuando su estado no se actualiza por ttl segundos.
+        Un trabajo pendiente no expira (puede esperar en la cola más que ttl), salvo que su proceso responsable haya muerto:
+        en ese caso se marca como fallido, y expira ttl segundos después.
+        """
+        limit = time.time() - self.ttl
+        for job_dir in self.job_dirs():
+            try:
+                state = read_state(job_dir)
+                if state.status in PENDING_STATUSES and state.owner is not None:
+                    if not process_alive(state.owner):
+                        state.status, state.finished = JobStatus.FAILED, time.time()
+                        state.errors = state.errors + ['The process running the job died']
+                        write_state(job_dir, state)
+                elif os.path.getmtime(os.path.join(job_dir, self.STATE_FILE)) < limit:
+                    shutil.rmtree(job_dir, ignore_errors=True)
+            except (FileNotFoundError, ValueError):
+                # Otro worker lo esta creando o eliminando
+                pass
+
+@lru_cache(maxsize=None)
+def job_metrics_registry(root: str) -> MetricsRegistry:
+    # Uno por proceso del pool, ya que acumula los totales de todos los trabajos que corre
+    return MetricsRegistry(root)
+
+def read_state(job_dir: str) -> JobState:
+    with open(os.path.join(job_dir, JobStore.STATE_FILE)) as f:
+        state = json.load(f)
+    state['status'] = JobStatus(state['status'])
+    return JobState(**state)
+
+def write_state(job_dir: str, state: JobState) -> None:
+    # Escritura atómica, para que nunca se lea un estado a medio escribir
+    tmp = os.path.join(job_dir, f'{JobStore.STATE_FILE}.{os.getpid()}.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(asdict(state), f)
+    os.replace(tmp, os.path.join(job_dir, JobStore.STATE_FILE))
+
+def run_job(job_dir: str, allowed_ext: List[str], prefetch: int = 0, progress_interval: float = 0.5, metrics_root: Optional[str] = None) -> None:
+    """
+    Corre el tracking de un trabajo, dentro del pool de procesos. Reporta el progreso cada progress_interval segundos.
+    Con metrics_root, las métricas del trabajo se suman a las del MetricsRegistry de ese directorio.
+    """
+    try:
+        state = read_state(job_dir)
+    except FileNotFoundError:
+        # El trabajo fue eliminado mientras esperaba en la cola
+        return
+    if state.status not in PENDING_STATUSES:
+        # Se canceló o se marcó como fallido mientras esperaba (ver JobStore.cancel y JobStore.expire)
+        shutil.rmtree(os.path.join(job_dir, JobStore.IMAGES_DIR), ignore_errors=True)
+        return
+    cancel_file = os.path.join(job_dir, JobStore.CANCEL_FILE)
+    if os.path.exists(cancel_file):
+        state.status, state.finished = JobStatus.CANCELLED, time.time()
+        write_state(job_dir, state)
+        return
+
+    images_dir = os.path.join(job_dir, JobStore.IMAGES_DIR)
+    paths = [os.path.join(images_dir, name) for name in sorted(os.listdir(images_dir))]
+    # Los archivos se guardaron como {orden}_{nombre original}
+    images = [FileStorage(open(path, 'rb'), filename=os.path.basename(path).split('_', 1)[1]) for path in paths]
+
+    try:
+        with open(os.path.join(job_dir, JobStore.CONFIG_FILE)) as f:
+            config = Config(**json.load(f))
+        with open(os.path.join(job_dir, JobStore.POINTS_FILE)) as f:
+            points = np.array(json.load(f))
+
+        state.status, state.owner = JobStatus.RUNNING, process_id()
+        state.frames_total = frames_count(images, allowed_ext)
+        write_state(job_dir, state)
+
+        def with_progress(frames):
+            last_report = time.monotonic()
+            for frame in frames:
+                if os.path.exists(cancel_file):
+                    raise JobCancelled()
+                yield frame
+                state.frames_done += 1
+                if time.monotonic() - last_report > progress_interval:
+                    last_report = time.monotonic()
+                    write_state(job_dir, state)
+
+        errors = []
+        metrics = TrackingMetrics() if metrics_root is not None else None
+        if config.roi_decoding:
+            frames = lazy_frames_iterator(images, allowed_ext, native=config.native_depth)
+        else:
+            frames = prefetch_frames(timed_frames(frames_iterator(images, allowed_ext, native=config.native_depth), metrics, 'decode'), prefetch)
+        result = TrackingResultArrays.from_frames(with_progress(track_filament_frames(frames, points, config, errors, metrics)), errors)
+        with open(os.path.join(job_dir, JobStore.RESULT_FILE), 'wb') as f:
+            f.write(result.to_npz())
+        if metrics is not None:
+            job_metrics_registry(metrics_root).record(metrics)
+
+        state.status, state.errors = JobStatus.DONE, errors
+    except JobCancelled:
+        state.status = JobStatus.CANCELLED
+    except ApplicationError as e:
+        state.status, state.errors = JobStatus.FAILED, [e.message]
+    except Exception as e:
+        state.status, state.errors = JobStatus.FAILED, [str(e)]
+    finally:
+        for image in images:
+            image.close()
+
+    # Las imagenes ya no son necesarias
+    shutil.rmtree(images_dir, ignore_errors=True)
+    state.finished = time.time()
+    write_state(job_dir, state)
@@ -0,0 +1,158 @@
+import mmap
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+from .main import track_filament_frames
+from .metrics import TrackingMetrics
+from .models import ApplicationError, Config, TrackingResultArrays
+from .tracking import multi_point_linear_interpolation, resample_points
+
+# Un keyframe: el frame y los puntos que marcó el usuario sobre él
+Keyframe = Tuple[int, np.ndarray]
+
+@dataclass
+class MemmapFrames:
+    """
+    Referencia a los frames [start, stop) de un stack mapeado en memoria (ver StackStore).
+    Cada proceso mapea el archivo por su cuenta, en vez de recibir una copia de los frames.
+    """
+    filename:   str
+    offset:     int
+    dtype:      str
+    shape:      Tuple[int, ...]
+    start:      int
+    stop:       int
+
+    def open(self) -> np.ndarray:
+        return np.memmap(self.filename, dtype=self.dtype, mode='r', offset=self.offset, shape=self.shape)[self.start:self.stop]
+
+# Frames de un rango: una referencia al archivo, o el arreglo mismo (que se copia al enviarlo a otro proceso)
+FramesRef = Union[MemmapFrames, np.ndarray]
+
+def share_frames(frames: np.ndarray, start: int, stop: int) -> FramesRef:
+    if isinstance(frames, np.memmap) and isinstance(frames.base, mmap.mmap):
+        return MemmapFrames(frames.filename, frames.offset, frames.dtype.str, frames.shape, start, stop)
+    return frames[start:stop]
+
+@dataclass
+class RangeTask:
+    """
+    Tracking de los frames [start, stop), desde initial_points. Hacia atrás (backward) se trackean de stop - 1 a start.
+    """
+    frames:         FramesRef
+    start:          int
+    stop:           int
+    backward:       bool
+    initial_points: np.ndarray
+
+@dataclass
+class RangeResult:
+    points:         np.ndarray  # (n_frames, n_points, 2) float64, en el orden de los frames (aunque se haya trackeado hacia atrás)
+    status:         np.ndarray
+    normal_lines:   np.ndarray
+    errors:         List[str]
+    metrics:        Optional[TrackingMetrics]
+
+def keyframe_seeds(keyframes: List[Keyframe], config: Config) -> List[Keyframe]:
+    """
+    Puntos iniciales del tracking en cada keyframe. Todos tienen la cantidad de puntos del primero, para que los rangos
+    formen un único resultado: los de los demás keyframes se reparten sobre el filamento por longitud de arco.
+    """
+    first_frame, first_points = keyframes[0]
+    first = multi_point_linear_interpolation(first_points, config.point_density)
+    seeds = [(first_frame, first)]
+    for frame, user_points in keyframes[1:]:
+        points = resample_points(multi_point_linear_interpolation(user_points, config.point_density), len(first))
+        # El usuario puede haber marcado el filamento en el sentido opuesto al del primer keyframe
+        same = np.linalg.norm(points[0] - first[0]) + np.linalg.norm(points[-1] - first[-1])
+        opposite = np.linalg.norm(points[-1] - first[0]) + np.linalg.norm(points[0] - first[-1])
+        seeds.append((frame, points[::-1] if opposite < same else points))
+    return seeds
+
+def track_range(task: RangeTask, config: Config, metrics: bool = False) -> RangeResult:
+    frames = task.frames.open() if isinstance(task.frames, MemmapFrames) else task.frames
+    errors = []
+    range_metrics = TrackingMetrics() if metrics else None
+    results = list(track_filament_frames(frames[::-1] if task.backward else frames, None, config, errors, range_metrics, task.initial_points))
+    if task.backward:
+        results.reverse()
+    return RangeResult(
+        np.stack([frame.points for frame in results]),
+        np.stack([frame.status for frame in results]),
+        np.stack([frame.normal_lines for frame in results]),
+        errors,
+        range_metrics,
+    )
+
+def meeting_frame(forward: RangeResult, backward: RangeResult) -> int:
+    """
+    Frame (relativo al rango) en el que las pasadas hacia adelante y hacia atrás están más cerca. Es donde se unen.
+    """
+    distances = np.nanmean(np.linalg.norm(forward.points - backward.points, axis=-1), axis=-1)
+    return int(np.nanargmin(distances)) if not np.all(np.isnan(distances)) else len(distances) // 2
+
+def track_keyframes(frames: np.ndarray, keyframes: List[Keyframe], config: Config, workers: int = 1, backward: bool = False,
+                    metrics: bool = False) -> TrackingResultArrays:
+    """
+    Trackea el stack por rangos independientes, que se reparten entre workers procesos.
+    Cada rango va de un keyframe al siguiente, y parte de los puntos del usuario en su keyframe (ver keyframe_seeds).
+    Los frames anteriores al primer keyframe se trackean hacia atrás desde él.
+    Con backward, cada rango también se trackea hacia atrás desde el keyframe siguiente, y se usa la pasada hacia adelante
+    hasta el frame en el que ambas están más cerca (ver meeting_frame) y a partir de ahí la pasada hacia atrás.
+    Los frames tienen que poder leerse en cualquier orden: un arreglo (n_frames, height, width), idealmente mapeado en memoria.
+    """
+    frames_total = len(frames)
+    keyframes = sorted(keyframes, key=lambda keyframe: keyframe[0])
+    frames_idx = [frame for frame, _ in keyframes]
+    if len(set(frames_idx)) != len(frames_idx) or frames_idx[0] < 0 or frames_idx[-1] >= frames_total:
+        raise ApplicationError(f'Keyframes must be different frames between 0 and {frames_total - 1}. Got: {frames_idx}')
+
+    seeds = keyframe_seeds(keyframes, config)
+    tasks: List[RangeTask] = []
+    if frames_idx[0] > 0:
+        tasks.append(RangeTask(share_frames(frames, 0, frames_idx[0]), 0, frames_idx[0], True, seeds[0][1]))
+    # Indice de la pasada hacia atrás de cada rango, por el indice de su pasada hacia adelante
+    backward_tasks = {}
+    for i, (start, points) in enumerate(seeds):
+        stop = frames_idx[i + 1] if i + 1 < len(seeds) else frames_total
+        tasks.append(RangeTask(share_frames(frames, start, stop), start, stop, False, points))
+        if backward and i + 1 < len(seeds):
+            backward_tasks[len(tasks) - 1] = len(tasks)
+            tasks.append(RangeTask(share_frames(frames, start, stop), start, stop, True, seeds[i + 1][1]))
+
+    workers = min(workers, len(tasks))
+    if workers <= 1:
+        results = [track_range(task, config, metrics) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context()) as pool:
+            results = list(pool.map(track_range, tasks, [config] * len(tasks), [metrics] * len(tasks)))
+
+    n_points = len(seeds[0][1])
+    points = np.empty((frames_total, n_points, 2), dtype=np.float32)
+    status = np.empty((frames_total, n_points), dtype=np.uint8)
+    normal_lines = np.empty((frames_total, n_points, 2, 2), dtype=np.int32)
+    errors = []
+    total_metrics = TrackingMetrics() if metrics else None
+    for i, (task, result) in enumerate(zip(tasks, results)):
+        errors += result.errors
+        if total_metrics is not None:
+            total_metrics.merge(result.metrics)
+        if i in backward_tasks.values():
+            # Ya se usó al unirla con la pasada hacia adelante de su rango
+            continue
+
+        if (backward_idx := backward_tasks.get(i)) is not None:
+            meet = meeting_frame(result, results[backward_idx]) + 1
+            parts = ((task.start, task.start + meet, result, 0), (task.start + meet, task.stop, results[backward_idx], meet))
+        else:
+            parts = ((task.start, task.stop, result, 0),)
+        for start, stop, part, offset in parts:
+            points[start:stop] = part.points[offset:offset + stop - start]
+            status[start:stop] = part.status[offset:offset + stop - start]
+            normal_lines[start:stop] = part.normal_lines[offset:offset + stop - start]
+
+    return TrackingResultArrays(points, status, normal_lines, errors, total_metrics.to_dict() if total_metrics is not None else None)
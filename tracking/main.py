@@ -1,68 +1,171 @@
-from typing import Iterable
+from typing import Iterable, Iterator, List, Optional
 
 import numpy as np
 
-from .models import Config, TrackingFrameResult, TrackingPoint, TrackingSegment, TrackingResult, TrackingFrameMetadata, \
-    TrackingPointStatus
-from .tracking import interpolate_missing, gauss_fitting, generate_normal_line_bounds, multi_point_linear_interpolation, \
-    points_linear_interpolation, profile_pos_to_point, bezier_fitting, read_line_from_img
+from .image_utils import LazyFrame
+from .metrics import TrackingMetrics, stage, timed_frames
+from .models import Config, TrackingResult, TrackingPointStatus, TrackingFrameArrays, TrackingResultArrays
+from .tracking import interpolate_missing, generate_normal_line_bounds, multi_point_linear_interpolation, \
+    points_linear_interpolation, profile_pos_to_point, bezier_fitting, read_line_from_img, pad_profiles, normal_line_samples, \
+    read_lines_from_img, profile_pos_to_points, invert_profiles, lines_region, PEAK_ESTIMATORS, \
+    gauss_fitting_params_batch, gauss_warm_start, normal_directions, predict_normal_lines, update_motion, screen_profiles, expand_rows
 
 
-def track_filament(frames: Iterable[np.ndarray], user_points: np.ndarray, config: Config) -> TrackingResult:
-    results = []
+def track_filament(frames: Iterable[np.ndarray], user_points: np.ndarray, config: Config, metrics: Optional[TrackingMetrics] = None) -> TrackingResult:
     errors = []
+    results = [frame.to_frame_result() for frame in track_filament_frames(frames, user_points, config, errors, metrics)]
+    return TrackingResult(results, errors)
 
-    # Obtenemos los puntos iniciales del tracking interpolando linealmente los puntos del usuario
-    prev_frame_points = multi_point_linear_interpolation(user_points, config.point_density)
+def track_filament_arrays(frames: Iterable[np.ndarray], user_points: np.ndarray, config: Config, include_normal_lines: bool = True,
+                          metrics: Optional[TrackingMetrics] = None) -> TrackingResultArrays:
+    """
+    Igual que track_filament, pero con los resultados en su representación columnar (arreglos de numpy).
+    """
+    errors = []
+    return TrackingResultArrays.from_frames(track_filament_frames(frames, user_points, config, errors, metrics), errors, include_normal_lines)
+
+def track_filament_frames(frames: Iterable[np.ndarray], user_points: Optional[np.ndarray], config: Config, errors: List[str],
+                          metrics: Optional[TrackingMetrics] = None, initial_points: Optional[np.ndarray] = None,
+                          initial_fit_params: Optional[np.ndarray] = None, initial_motion: Optional[np.ndarray] = None) -> Iterator[TrackingFrameArrays]:
+    """
+    Igual que track_filament, pero retorna los resultados a medida que se procesa cada frame.
+    Los errores no fatales se agregan a la lista errors.
+    Los frames pueden ser LazyFrame (ver lazy_frames_iterator), en cuyo caso solo se decodifica la región que se lee.
+    Si se pasa metrics, se le suman los tiempos de cada etapa y los contadores de cada frame.
+    Para retomar un tracking (ver checkpoints), initial_points son los puntos finales del frame anterior, y reemplazan a user_points.
+    initial_fit_params son los parámetros del ajuste gaussiano del frame anterior (ver Config.warm_start),
+    e initial_motion el estado del modelo de movimiento (ver Config.motion_prediction).
+    """
+    if initial_points is not None:
+        prev_frame_points = initial_points
+    else:
+        # Obtenemos los puntos iniciales del tracking interpolando linealmente los puntos del usuario
+        prev_frame_points = multi_point_linear_interpolation(user_points, config.point_density)
+
+    # Estimador de la posición del pico de cada perfil (ver Config.peak_estimator)
+    peak_estimator = PEAK_ESTIMATORS[config.peak_estimator]
+    # El ajuste gaussiano es el único estimador con parámetros, que se mantienen entre frames para iniciar el siguiente ajuste
+    gauss = config.peak_estimator == 'gauss'
+    fit_params = initial_fit_params if gauss and config.warm_start else None
+    # Estado del modelo de movimiento de cada punto sobre su normal (ver update_motion)
+    motion = initial_motion if config.motion_prediction else None
+    # Filtro de los perfiles previo al ajuste (ver screen_profiles)
+    screening = config.min_profile_contrast > 0 or config.min_profile_snr > 0
+    # Los frames sin ruido estimable se reportan una sola vez, en errors
+    noise_reported = False
 
     # Si no hay suficientes puntos para la tangente configurada, bajamos la cantidad de puntos
     max_tangent_length = min(config.max_tangent_length, len(prev_frame_points) - 1)
 
-    for frame in frames:
-        # En caso de que el filamento sea negro sobre un fondo blanco, debemos invertir la imagen
-        if config.inverted:
-            frame = 255 - frame
-
-        # Calculamos los límites que definen los segmentos de las rectas normales
-        normal_lines_limits = generate_normal_line_bounds(prev_frame_points, max_tangent_length, config.normal_line_length)
-
-        # A partir de los límites obtenemos la lista de píxeles que representan a los segmentos de las rectas normales
-        # No es un ndarray porque no todas salen con la misma longitud (diagonales, etc)
-        normal_lines = [points_linear_interpolation(start, end) for start, end in normal_lines_limits]
-
-        # Obtenemos los perfiles de intensidad de la imagen de cada recta normal
-        intensity_profiles = map(lambda nl, img=frame: read_line_from_img(img, nl), normal_lines)
-
-        # Obtenemos la posición del máximo punto del perfil de intensidad.
-        # Puede retornar None en caso de que no se pueda fittear la curva de intensidad, o si el error es mayor al maximo permitido.
-        points_profile_pos = list(map(lambda ip, img=frame: gauss_fitting(ip, config.max_fitting_error), intensity_profiles))
-
-        # A partir de las posiciones, obtenemos los puntos que representan.
-        # En caso de que el error de la posición fuese muy alto,
-        #  o la posición no estuviese dentro del perfil de intensidad, obtenemos None en vez del punto.
-        raw_points_with_missing = [profile_pos_to_point(pos, nl) if pos else None for pos, nl in zip(points_profile_pos, normal_lines)]
+    for frame in timed_frames(frames, metrics, 'frame_wait'):
+        with stage(metrics, 'normals'):
+            # Con predicción de movimiento, cada recta normal se centra en la posición predicha del punto,
+            # y se acorta según la incertidumbre de la predicción
+            offsets, normal_lengths = predict_normal_lines(motion, config.normal_line_length, config.min_normal_line_length)
+
+            if config.subpixel_sampling:
+                normal_lines_limits = generate_normal_line_bounds(prev_frame_points, max_tangent_length, normal_lengths, offsets)
+                # Muestreamos cada recta normal con un punto por pixel de su longitud mediante interpolación bilineal.
+                # Las más cortas (con predicción de movimiento) se completan con NaN, como sin muestreo subpíxel
+                normal_lines = normal_line_samples(normal_lines_limits, normal_lengths)
+            else:
+                # Calculamos los límites que definen los segmentos de las rectas normales
+                normal_lines_limits = generate_normal_line_bounds(prev_frame_points, max_tangent_length, normal_lengths, offsets)
+                # A partir de los límites obtenemos la lista de píxeles que representan a los segmentos de las rectas normales
+                # No es un ndarray porque no todas salen con la misma longitud (diagonales, etc)
+                normal_lines = [points_linear_interpolation(start, end) for start, end in normal_lines_limits]
+
+        # Si el frame todavía no fue decodificado, decodificamos solo la región que cubren las rectas normales.
+        # El tiempo se cuenta solo en decode: frame_wait ya midió la espera del frame sin decodificar
+        offset = None
+        if isinstance(frame, LazyFrame):
+            with stage(metrics, 'decode'):
+                frame, offset = frame.read(lines_region(normal_lines_limits))
+
+        with stage(metrics, 'sampling'):
+            if config.subpixel_sampling:
+                # Obtenemos los perfiles de intensidad de todas las rectas a la vez, como una matriz (n, L)
+                # Si solo se decodificó una región, llevamos las coordenadas a la región
+                intensity_profiles = read_lines_from_img(frame, normal_lines if offset is None else normal_lines - offset)
+            else:
+                # Obtenemos los perfiles de intensidad de la imagen de cada recta normal
+                # Los juntamos en una matriz (n, L) para ajustarlos todos a la vez
+                region_lines = normal_lines if offset is None else [nl - offset for nl in normal_lines]
+                intensity_profiles = pad_profiles([read_line_from_img(frame, nl) for nl in region_lines])
+
+            # En caso de que el filamento sea negro sobre un fondo blanco, debemos invertir la imagen.
+            # Lo hacemos solo sobre los perfiles, para no copiar el frame. El filtro usa los perfiles sin invertir
+            raw_profiles = intensity_profiles
+            if config.inverted:
+                intensity_profiles = invert_profiles(intensity_profiles, frame.dtype)
+
+        with stage(metrics, 'fitting'):
+            # Obtenemos la posición del máximo punto del perfil de intensidad.
+            # Puede retornar NaN en caso de que no se pueda fittear la curva de intensidad, o si el error es mayor al maximo permitido.
+            # Los perfiles sin contraste suficiente se descartan sin ajustarlos, como si el ajuste hubiese fallado
+            screened = None
+            if screening:
+                # Con muestreo subpíxel los perfiles se interpolan, por lo que el paso de cuantización sale de los perfiles
+                quantization_step = 1 if np.issubdtype(frame.dtype, np.integer) and not config.subpixel_sampling else None
+                screened, noise = screen_profiles(raw_profiles, config.min_profile_contrast, config.min_profile_snr, config.inverted, quantization_step)
+                if config.min_profile_snr > 0 and np.isnan(noise) and not noise_reported:
+                    errors.append('The noise of the intensity profiles could not be estimated in some frames (flat profiles); '
+                                  'all their points were discarded by min_profile_snr')
+                    noise_reported = True
+            profiles = intensity_profiles if screened is None else intensity_profiles[screened]
+            fit_iterations = 0
+            if gauss:
+                initial_params = gauss_warm_start(fit_params, intensity_profiles) if config.warm_start else None
+                if initial_params is not None and screened is not None:
+                    initial_params = initial_params[screened]
+                points_profile_pos, fit_params, iterations = gauss_fitting_params_batch(profiles, config.max_fitting_error, initial_params)
+                fit_iterations = int(np.sum(iterations))
+            else:
+                points_profile_pos = peak_estimator(profiles, config.max_fitting_error)
+
+            fit_skipped = 0
+            if screened is not None:
+                fit_skipped = len(screened) - int(np.count_nonzero(screened))
+                points_profile_pos = expand_rows(points_profile_pos, screened, len(screened))
+                if gauss:
+                    fit_params = expand_rows(fit_params, screened, len(screened))
+
+        with stage(metrics, 'interpolation'):
+            # A partir de las posiciones, obtenemos los puntos que representan.
+            # En caso de que el error de la posición fuese muy alto,
+            #  o la posición no estuviese dentro del perfil de intensidad, obtenemos NaN en vez del punto.
+            if config.subpixel_sampling:
+                raw_points_with_missing = profile_pos_to_points(points_profile_pos, normal_lines)
+            else:
+                raw_points_with_missing = np.array([
+                    point if not np.isnan(pos) and (point := profile_pos_to_point(pos, nl)) is not None else (np.nan, np.nan)
+                    for pos, nl in zip(points_profile_pos, normal_lines)
+                ], dtype=np.float64).reshape((-1, 2))
+
+            # Buscamos llenar los valores faltantes (NaN) mediante una interpolación con los vecinos bien calculados.
+            # En caso de que la interpolación no pueda ser hecha, se descartan los valores.
+            # Se informa la posición de los valores interpolados o descartados.
+            raw_points, interpolated_points, preserved_points = interpolate_missing(raw_points_with_missing, prev_frame_points, config.missing_inter_len)
+
+        with stage(metrics, 'bezier'):
+            # Si fue seleccionado, suavizamos los puntos ajustando los mismos a una curva de bezier
+            smoothed_points = bezier_fitting(raw_points, config.bezier_segment_len) if config.bezier_smoothing else raw_points
 
-        # Buscamos llenar los valores faltantes (None) mediante una interpolación con los vecinos bien calculados.
-        # En caso de que la interpolación no pueda ser hecha, se descartan los valores.
-        # Se informa la posición de los valores interpolados o descartados.
-        raw_points, interpolated_points, preserved_points = interpolate_missing(raw_points_with_missing, prev_frame_points, config.missing_inter_len)
+        if config.motion_prediction:
+            directions = normal_directions(prev_frame_points, max_tangent_length)
+            motion = update_motion(motion, directions, prev_frame_points, smoothed_points, offsets, np.isnan(raw_points_with_missing[:, 0]))
 
-        # Si fue seleccionado, suavizamos los puntos ajustando los mismos a una curva de bezier
-        # Bezier puede fallar por cantidad maxima de puntos
-        try:
-            smoothed_points = bezier_fitting(raw_points, config.bezier_segment_len) if config.bezier_smoothing else raw_points
-        except ValueError as e:
-            config.bezier_smoothing = False
-            errors.append(str(e))
-            smoothed_points = raw_points
+        if metrics is not None:
+            metrics.count_frame(points_profile_pos, interpolated_points, preserved_points, fit_iterations, fit_skipped)
 
         # Ya obtuvimos los puntos finales del frame! Los disponibilizamos como los puntos iniciales del próximo frame
         prev_frame_points = smoothed_points
 
-        # Guardamos el resultado del frame
-        results.append(TrackingFrameResult(
-            TrackingPoint.from_arrays(prev_frame_points, {TrackingPointStatus.INTERPOLATED: interpolated_points, TrackingPointStatus.PRESERVED: preserved_points}),
-            TrackingFrameMetadata(TrackingSegment.from_arrays(normal_lines_limits))
-        ))
-
-    return TrackingResult(results, errors)
+        # Disponibilizamos el resultado del frame
+        yield TrackingFrameArrays.from_arrays(
+            prev_frame_points,
+            {TrackingPointStatus.INTERPOLATED: interpolated_points, TrackingPointStatus.PRESERVED: preserved_points},
+            normal_lines_limits,
+            fit_params if config.warm_start else None,
+            motion,
+        )
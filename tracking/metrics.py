@@ -0,0 +1,247 @@
+import fcntl
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass, field, asdict
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+from .processes import process_alive, process_id
+
+# Etapas medidas. decode corre dentro de frame_wait, salvo que se decodifique por adelantado (en otro hilo)
+# o solo la región de las rectas normales (ver LazyFrame), que se cuenta solo en decode
+STAGES = ('decode', 'frame_wait', 'normals', 'sampling', 'fitting', 'interpolation', 'bezier', 'serialization')
+
+# Etapas que suman al tiempo de tracking (ver TrackingMetrics.tracking_time)
+TRACKING_STAGES = ('frame_wait', 'normals', 'sampling', 'fitting', 'interpolation', 'bezier')
+
+@dataclass
+class TrackingMetrics:
+    """
+    Tiempos (en segundos) de cada etapa y contadores de un pedido de tracking, o la suma de varios.
+    """
+    stages:         Dict[str, float] = field(default_factory=dict)
+    frames:         int = 0
+    points:         int = 0
+    fit_failures:   int = 0
+    interpolated:   int = 0
+    preserved:      int = 0
+    fit_iterations: int = 0
+    fit_skipped:    int = 0
+    # Búsquedas en la cache de resultados (ver ResultCache.get)
+    cache_memory_hits:  int = 0
+    cache_disk_hits:    int = 0
+    cache_misses:       int = 0
+
+    @property
+    def tracking_time(self) -> float:
+        return sum(self.stages.get(stage, 0) for stage in TRACKING_STAGES)
+
+    @property
+    def fps(self) -> float:
+        return self.frames / self.tracking_time if self.tracking_time > 0 else 0
+
+    def add_time(self, stage: str, elapsed: float) -> None:
+        self.stages[stage] = self.stages.get(stage, 0) + elapsed
+
+    def count_frame(self, points_profile_pos: np.ndarray, interpolated: List[int], preserved: List[int], fit_iterations: int = 0,
+                    fit_skipped: int = 0) -> None:
+        self.frames += 1
+        self.points += len(points_profile_pos)
+        self.fit_failures += int(np.count_nonzero(np.isnan(points_profile_pos)))
+        self.interpolated += len(interpolated)
+        self.preserved += len(preserved)
+        self.fit_iterations += fit_iterations
+        self.fit_skipped += fit_skipped
+
+    def merge(self, other: 'TrackingMetrics') -> None:
+        for stage, elapsed in other.stages.items():
+            self.add_time(stage, elapsed)
+        self.frames += other.frames
+        self.points += other.points
+        self.fit_failures += other.fit_failures
+        self.interpolated += other.interpolated
+        self.preserved += other.preserved
+        self.fit_iterations += other.fit_iterations
+        self.fit_skipped += other.fit_skipped
+        self.cache_memory_hits += other.cache_memory_hits
+        self.cache_disk_hits += other.cache_disk_hits
+        self.cache_misses += other.cache_misses
+
+    def to_dict(self) -> dict:
+        return {**asdict(self), 'fps': self.fps}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'TrackingMetrics':
+        return cls(**{k: v for k, v in data.items() if k != 'fps'})
+
+class StageTimer:
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics: TrackingMetrics, stage: str):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.metrics.add_time(self.stage, time.perf_counter() - self.start)
+
+class NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+NULL_TIMER = NullTimer()
+
+def stage(metrics: Optional[TrackingMetrics], name: str):
+    """
+    Context manager que suma el tiempo del bloque a la etapa name. Sin metricas no hace nada.
+    """
+    return NULL_TIMER if metrics is None else StageTimer(metrics, name)
+
+def timed_frames(frames: Iterable[np.ndarray], metrics: Optional[TrackingMetrics], name: str) -> Iterable[np.ndarray]:
+    """
+    Suma a la etapa name el tiempo que tarda en obtenerse cada frame.
+    """
+    if metrics is None:
+        return frames
+
+    def generate() -> Iterator[np.ndarray]:
+        it = iter(frames)
+        while True:
+            start = time.perf_counter()
+            frame = next(it, None)
+            metrics.add_time(name, time.perf_counter() - start)
+            if frame is None:
+                return
+            yield frame
+
+    return generate()
+
+def read_json(path: str) -> Optional[dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def write_json(path: str, data: dict) -> None:
+    # Escritura atómica, ya que otro worker puede estar leyendo
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+class MetricsRegistry:
+    """
+    Métricas acumuladas de todos los pedidos.
+    Cada proceso escribe sus totales en su propio archivo ({pid}-{inicio}.json, ver process_id) y la lectura suma todos
+    los archivos, para que cualquier worker de gunicorn pueda exponer las métricas de todos.
+    Los archivos de procesos muertos se suman a ARCHIVE_FILE, para que los totales nunca disminuyan.
+    """
+    ARCHIVE_FILE = 'archive.json'
+    LOCK_FILE = '.lock'
+
+    def __init__(self, root: str):
+        self.root = root
+        self.pid = os.getpid()
+        self.process = process_id()
+        self.requests = 0
+        self.totals = TrackingMetrics()
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def record(self, metrics: TrackingMetrics) -> None:
+        with self.lock:
+            # En un proceso hijo (fork) los totales heredados son del padre, que ya los escribe en su archivo
+            if self.pid != os.getpid():
+                self.pid, self.process, self.requests, self.totals = os.getpid(), process_id(), 0, TrackingMetrics()
+            self.requests += 1
+            self.totals.merge(metrics)
+            data = {'requests': self.requests, 'metrics': asdict(self.totals)}
+            path = os.path.join(self.root, f'{self.process}.json')
+        write_json(path, data)
+
+    def collect(self):
+        """
+        Retorna la cantidad de pedidos y las métricas sumadas de todos los procesos.
+        """
+        # Exclusivo entre procesos, para no leer un archivo ya sumado al histórico pero todavía no eliminado
+        with open(os.path.join(self.root, self.LOCK_FILE), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            archive_path = os.path.join(self.root, self.ARCHIVE_FILE)
+            archive = read_json(archive_path) or {'requests': 0, 'metrics': asdict(TrackingMetrics()), 'archived': []}
+            archived = set(archive['archived'])
+            archive_totals = TrackingMetrics.from_dict(archive['metrics'])
+            requests, totals = 0, TrackingMetrics()
+            dead = []
+            for entry in os.scandir(self.root):
+                process = entry.name[:-len('.json')]
+                if not entry.name.endswith('.json') or entry.name == self.ARCHIVE_FILE or process in archived:
+                    continue
+                data = read_json(entry.path)
+                if data is None:
+                    continue
+                if process_alive(process):
+                    requests += data['requests']
+                    totals.merge(TrackingMetrics.from_dict(data['metrics']))
+                else:
+                    dead.append(process)
+                    archive['requests'] += data['requests']
+                    archive_totals.merge(TrackingMetrics.from_dict(data['metrics']))
+
+            if dead:
+                # Se registra qué procesos se archivaron, por si se interrumpe antes de eliminar sus archivos
+                archived = {process for process in archived if os.path.exists(os.path.join(self.root, f'{process}.json'))}
+                archive['metrics'], archive['archived'] = asdict(archive_totals), sorted(archived | set(dead))
+                write_json(archive_path, archive)
+                for process in dead:
+                    os.remove(os.path.join(self.root, f'{process}.json'))
+
+        totals.merge(archive_totals)
+        return requests + archive['requests'], totals
+
+    def prometheus(self) -> str:
+        """
+        Métricas acumuladas en el formato de texto de Prometheus.
+        """
+        requests, totals = self.collect()
+        lines = [
+            '# HELP pipo_tracking_requests_total Tracking requests processed.',
+            '# TYPE pipo_tracking_requests_total counter',
+            f'pipo_tracking_requests_total {requests}',
+            '# HELP pipo_tracking_stage_seconds_total Time spent in each tracking stage.',
+            '# TYPE pipo_tracking_stage_seconds_total counter',
+            *(f'pipo_tracking_stage_seconds_total{{stage="{name}"}} {totals.stages.get(name, 0):.6f}' for name in STAGES),
+        ]
+        for name, help_text in (
+            ('frames',       'Frames tracked.'),
+            ('points',       'Points fitted.'),
+            ('fit_failures', 'Points whose gaussian fitting failed or was rejected.'),
+            ('interpolated', 'Points interpolated from their neighbours.'),
+            ('preserved',    'Points preserved from the previous frame.'),
+            ('fit_iterations', 'Levenberg-Marquardt iterations of the gaussian fittings.'),
+            ('fit_skipped',  'Points whose profile was discarded before fitting, for its low contrast or SNR.'),
+            ('cache_memory_hits', 'Tracking results served from the in-memory result cache.'),
+            ('cache_disk_hits',   'Tracking results served from the on-disk result cache.'),
+            ('cache_misses',      'Result cache lookups that found no result.'),
+        ):
+            lines += [
+                f'# HELP pipo_tracking_{name}_total {help_text}',
+                f'# TYPE pipo_tracking_{name}_total counter',
+                f'pipo_tracking_{name}_total {getattr(totals, name)}',
+            ]
+        lines += [
+            '# HELP pipo_tracking_frames_per_second Frames tracked per second of tracking time, over all requests.',
+            '# TYPE pipo_tracking_frames_per_second gauge',
+            f'pipo_tracking_frames_per_second {totals.fps:.3f}',
+        ]
+        return '\n'.join(lines) + '\n'
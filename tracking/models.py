@@ -1,4 +1,6 @@
-from dataclasses import dataclass, fields, field, Field
+import io
+import json
+from dataclasses import dataclass, fields, field, Field, replace
 from enum import Enum
 from typing import List, Optional, Dict, Iterable
 
@@ -18,16 +20,42 @@ def int_config_field(default: int, name: str, desc: str, min_: int, max_: int) -
 def float_config_field(default: float, name: str, desc: str, step: float, min_: float, max_: float) -> float:
     return field(default=default, metadata={'step': step, 'min': min_, 'max': max_, 'name': name, 'desc': desc})
 
+def choice_config_field(default: str, name: str, desc: str, choices: Dict[str, str]) -> str:
+    # choices: valor => nombre a mostrar
+    return field(default=default, metadata={'choices': choices, 'name': name, 'desc': desc})
+
+# Estimadores de la posición del pico de cada perfil de intensidad (ver PEAK_ESTIMATORS)
+PEAK_ESTIMATOR_CHOICES = {
+    'gauss':            'Ajuste gaussiano',
+    'log_parabolic':    'Parábola logarítmica (3 puntos)',
+    'parabolic':        'Parábola (3 puntos)',
+    'centroid':         'Centroide',
+}
+
 @dataclass
 class Config:
-    max_fitting_error: float    = float_config_field(0.6, 'Tolerancia de error', 'Limite de tolerancia en el error del ajuste gaussiano del perfil de intensidad', step=1e-10, min_=0, max_=100)
+    max_fitting_error: float    = float_config_field(0.6, 'Tolerancia de error', 'Limite de tolerancia en el error de la posición del pico del perfil de intensidad (ver el estimador del pico)', step=1e-10, min_=0, max_=100)
     normal_line_length: int     = int_config_field(10, 'Ancho del perfil de intensidad', 'Ancho en pixeles del perfil de intensidad a tomar perpendicularmente a cada punto', min_=2, max_=1000)
     point_density: int          = int_config_field(1, 'Densidad de puntos', 'Proporción de puntos a usar durante la interpolación por pixel (1/n). La máxima densidad es 1. Reducir la densidad reduce la precisión, pero aumenta la velocidad del algoritmo', min_=1, max_=100)
     missing_inter_len: int      = int_config_field(3, 'Cantidad de puntos para interpolar', 'Cantidad de puntos vecinos a tomar hacia ambos lados para interpolar los puntos considerados inválidos (rojos)', min_=1, max_=100)
     max_tangent_length: int     = int_config_field(15, 'Puntos para calcular tangente', 'Cantidad de puntos vecinos tomados para calcular la pendiente de cada punto', min_=1, max_=1000)
-    bezier_segment_len: int     = int_config_field(100, 'Longitud del segmento de suavizado', 'Longitud por el que se parte el filamento, para luego ajustar a una curva de Bezier cada uno', min_=2, max_=1000)
+    bezier_segment_len: int     = int_config_field(100, 'Longitud del segmento de suavizado', 'Longitud por el que se parte el filamento, para luego ajustar a una curva de Bezier cada uno', min_=2, max_=2000)
     bezier_smoothing: bool      = bool_config_field(True, 'Suavizado final', 'Post-procesamiento de suavizado del filamento ajustando a una curva de Bezier por segmento')
     inverted: bool              = bool_config_field(False, 'Imágenes invertidas', 'Indica que el filamento es negro y el fondo blanco')
+    subpixel_sampling: bool     = bool_config_field(False, 'Muestreo subpíxel', 'Lee los perfiles de intensidad con interpolación bilineal y una cantidad fija de muestras por recta normal, en vez de rasterizar cada recta')
+    native_depth: bool          = bool_config_field(False, 'Profundidad nativa', 'Trackea sobre los valores originales de la imagen (8 o 16 bits, o float32), sin normalizarlos a 8 bits')
+    roi_decoding: bool          = bool_config_field(False, 'Decodificar solo la región del filamento', 'Decodifica de cada frame solo la región que cubren las rectas normales. En TIFF sin comprimir y .raw solo se leen esas filas del archivo. Con normalización a 8 bits, la normalización se calcula sobre la región')
+    warm_start: bool            = bool_config_field(True, 'Ajuste a partir del frame anterior', 'Inicia el ajuste gaussiano de cada punto con el ancho, la amplitud y el fondo ajustados en el frame anterior, en vez de estimarlos del perfil. Reduce las iteraciones del ajuste cuando el filamento se mueve poco')
+    peak_estimator: str         = choice_config_field('gauss', 'Estimador del pico', 'Método para obtener la posición del filamento en cada perfil de intensidad. El ajuste gaussiano es el más robusto al ruido. Los demás son mucho más rápidos, y con buena relación señal/ruido igual de precisos. Con todos, los picos cuyo error estimado supera la tolerancia de error se descartan', PEAK_ESTIMATOR_CHOICES)
+    motion_prediction: bool     = bool_config_field(False, 'Predicción de movimiento', 'Centra cada recta normal en la posición del punto predicha a partir de su velocidad en los frames anteriores, y acorta el perfil de intensidad según la incertidumbre de la predicción. Para filamentos que se mueven rápido, en vez de aumentar el ancho del perfil')
+    min_normal_line_length: int = int_config_field(6, 'Ancho mínimo del perfil de intensidad', 'Ancho en pixeles al que se puede acortar el perfil de intensidad con predicción de movimiento. Tiene que abarcar el ancho del filamento y algo de fondo', min_=2, max_=1000)
+    min_profile_contrast: float = float_config_field(0, 'Contraste mínimo del perfil', 'Los perfiles de intensidad con menor contraste (cuánto sobresale el filamento del fondo, relativo al rango del perfil: entre 0 y 1, y alrededor de 0.5 si el perfil es solo ruido) se consideran inválidos (rojos) sin ajustarlos. 0 lo deshabilita', step=0.01, min_=0, max_=1)
+    min_profile_snr: float      = float_config_field(0, 'Relación señal/ruido mínima del perfil', 'Los perfiles de intensidad cuyo máximo sobresale del fondo menos que esta cantidad de desvíos del ruido se consideran inválidos (rojos) sin ajustarlos. 0 lo deshabilita', step=0.1, min_=0, max_=1000)
+
+    def __post_init__(self):
+        for f in fields(self):
+            if 'choices' in f.metadata and getattr(self, f.name) not in f.metadata['choices']:
+                raise ApplicationError(f'Invalid {f.name}: {getattr(self, f.name)}. Valid values: {", ".join(f.metadata["choices"])}')
 
     @classmethod
     def from_dict(cls, env):
@@ -38,6 +66,14 @@ class Config:
                 env[k] = k in env
         return cls(**{k: fields_dict[k].type(v) for k, v in env.items() if k in fields_dict})
 
+    def with_overrides(self, overrides: dict) -> 'Config':
+        """
+        Copia de la configuración con los valores de overrides reemplazados. A diferencia de from_dict,
+        los campos booleanos ausentes mantienen su valor.
+        """
+        fields_dict = {f.name: f for f in fields(self)}
+        return replace(self, **{k: fields_dict[k].type(v) for k, v in overrides.items() if k in fields_dict})
+
 # Encode tracking point extraordinary statuses
 class TrackingPointStatus(str, Enum):
     INTERPOLATED    = 'INTERPOLATED'
@@ -64,6 +100,13 @@ class TrackingPoint:
     def from_array(cls, point: np.ndarray, status: Optional[TrackingPointStatus] = None) -> 'TrackingPoint':
         return cls(float(point[0]), float(point[1]), status)
 
+# Codificación de los status en la representación columnar (uint8). 0 indica que el punto no tiene status
+STATUS_CODES: Dict[TrackingPointStatus, int] = {
+    TrackingPointStatus.INTERPOLATED:   1,
+    TrackingPointStatus.PRESERVED:      2,
+}
+STATUS_BY_CODE: List[Optional[TrackingPointStatus]] = [None, *STATUS_CODES]
+
 # Un segmento se define por sus 2 extremos
 @dataclass
 class TrackingSegment:
@@ -91,3 +134,127 @@ class TrackingFrameResult:
 class TrackingResult:
     frames: List[TrackingFrameResult]
     errors: List[str] = field(default_factory=list)
+
+# Representación columnar de los resultados: en vez de un objeto por punto, arreglos de numpy por frame.
+# Las clases de arriba (TrackingResult) se construyen como una vista de estos arreglos.
+@dataclass
+class TrackingFrameArrays:
+    points:         np.ndarray  # (n_points, 2)
+    status:         np.ndarray  # (n_points,) uint8, ver STATUS_CODES
+    normal_lines:   np.ndarray  # (n_points, 2, 2)
+    # (n_points, 4) parámetros del ajuste gaussiano de cada punto, para iniciar el del frame siguiente (ver Config.warm_start).
+    # No forman parte del resultado
+    fit_params:     Optional[np.ndarray] = None
+    # (n_points, 2) estado del modelo de movimiento de cada punto (ver Config.motion_prediction). Tampoco forma parte del resultado
+    motion:         Optional[np.ndarray] = None
+
+    @classmethod
+    def from_arrays(cls, points: np.ndarray, status_map: Dict[TrackingPointStatus, Iterable[int]], normal_lines: np.ndarray,
+                    fit_params: Optional[np.ndarray] = None, motion: Optional[np.ndarray] = None) -> 'TrackingFrameArrays':
+        status = np.zeros(len(points), dtype=np.uint8)
+        for point_status, points_idx in status_map.items():
+            status[list(points_idx)] = STATUS_CODES[point_status]
+        return cls(points, status, normal_lines, fit_params, motion)
+
+    def to_frame_result(self) -> TrackingFrameResult:
+        points = [TrackingPoint(x, y, STATUS_BY_CODE[code]) for (x, y), code in zip(self.points.tolist(), self.status.tolist())]
+        return TrackingFrameResult(points, TrackingFrameMetadata(TrackingSegment.from_arrays(self.normal_lines)))
+
+    def to_dict(self) -> dict:
+        """
+        Misma forma que dataclasses.asdict(self.to_frame_result()), pero sin construir los objetos intermedios.
+        """
+        points = [{'x': x, 'y': y, 'status': STATUS_BY_CODE[code]} for (x, y), code in zip(self.points.tolist(), self.status.tolist())]
+        normal_lines = [
+            {'start': {'x': x0, 'y': y0, 'status': None}, 'end': {'x': x1, 'y': y1, 'status': None}}
+            for (x0, y0), (x1, y1) in self.normal_lines.astype(np.float64).tolist()
+        ]
+        return {'points': points, 'metadata': {'normal_lines': normal_lines}}
+
+@dataclass
+class TrackingResultArrays:
+    points:         np.ndarray              # (n_frames, n_points, 2) float32
+    status:         np.ndarray              # (n_frames, n_points) uint8, ver STATUS_CODES
+    normal_lines:   Optional[np.ndarray]    # (n_frames, n_points, 2, 2) int32
+    errors:         List[str] = field(default_factory=list)
+    # Métricas del pedido (ver tracking.metrics.TrackingMetrics.to_dict). Solo se incluyen si se piden
+    metrics:        Optional[dict] = None
+    # Frame del stack al que corresponde el primer frame del resultado (distinto de 0 si se retomó un checkpoint)
+    start_frame:    int = 0
+    # Distancia entre frames consecutivos del resultado en el stack (distinta de 1 en una vista previa)
+    frame_step:     int = 1
+
+    @classmethod
+    def from_frames(cls, frames: Iterable[TrackingFrameArrays], errors: List[str], include_normal_lines: bool = True) -> 'TrackingResultArrays':
+        # Vamos convirtiendo a los tipos compactos a medida que llegan los frames, para no acumular los float64
+        points, status, normal_lines = [], [], []
+        for frame in frames:
+            points.append(frame.points.astype(np.float32))
+            status.append(frame.status)
+            if include_normal_lines:
+                normal_lines.append(frame.normal_lines.astype(np.int32))
+
+        if not points:
+            return cls(np.zeros((0, 0, 2), np.float32), np.zeros((0, 0), np.uint8), np.zeros((0, 0, 2, 2), np.int32) if include_normal_lines else None, errors)
+
+        return cls(np.stack(points), np.stack(status), np.stack(normal_lines) if include_normal_lines else None, errors)
+
+    def frames(self) -> Iterable[TrackingFrameArrays]:
+        normal_lines = self.normal_lines if self.normal_lines is not None else np.zeros((len(self.status), 0, 2, 2), np.int32)
+        return map(TrackingFrameArrays, self.points, self.status, normal_lines)
+
+    def to_result(self) -> TrackingResult:
+        return TrackingResult([frame.to_frame_result() for frame in self.frames()], self.errors)
+
+    def to_dict(self) -> dict:
+        """
+        Misma forma que dataclasses.asdict(self.to_result()), lista para serializar como JSON.
+        """
+        ret = {'frames': [frame.to_dict() for frame in self.frames()], 'errors': self.errors}
+        if self.metrics is not None:
+            ret['metrics'] = self.metrics
+        if self.start_frame:
+            ret['start_frame'] = self.start_frame
+        if self.frame_step != 1:
+            ret['frame_step'] = self.frame_step
+        return ret
+
+    @classmethod
+    def from_npz(cls, file) -> 'TrackingResultArrays':
+        with np.load(file) as data:
+            normal_lines = data['normal_lines'] if 'normal_lines' in data.files else None
+            metrics = json.loads(data['metrics'].item()) if 'metrics' in data.files else None
+            start_frame = int(data['start_frame']) if 'start_frame' in data.files else 0
+            frame_step = int(data['frame_step']) if 'frame_step' in data.files else 1
+            return cls(data['points'], data['status'], normal_lines, data['errors'].tolist(), metrics, start_frame, frame_step)
+
+    def npz_arrays(self, prefix: str = '') -> Dict[str, np.ndarray]:
+        arrays = {
+            'points':           self.points,
+            'status':           self.status,
+            'status_labels':    np.array([status.value if status else '' for status in STATUS_BY_CODE]),
+            'errors':           np.array(self.errors, dtype=str),
+        }
+        if self.normal_lines is not None:
+            arrays['normal_lines'] = self.normal_lines
+        if self.metrics is not None:
+            arrays['metrics'] = np.array(json.dumps(self.metrics))
+        if self.start_frame:
+            arrays['start_frame'] = np.array(self.start_frame)
+        if self.frame_step != 1:
+            arrays['frame_step'] = np.array(self.frame_step)
+        return {prefix + k: v for k, v in arrays.items()}
+
+    def to_npz(self) -> bytes:
+        buffer = io.BytesIO()
+        np.savez(buffer, **self.npz_arrays())
+        return buffer.getvalue()
+
+    @staticmethod
+    def multiple_to_npz(results: List['TrackingResultArrays']) -> bytes:
+        """
+        Varios resultados en un mismo archivo. Los arreglos del resultado i se prefijan con filament_{i}_.
+        """
+        buffer = io.BytesIO()
+        np.savez(buffer, **{k: v for i, result in enumerate(results) for k, v in result.npz_arrays(f'filament_{i}_').items()})
+        return buffer.getvalue()
@@ -0,0 +1,63 @@
+import itertools
+import math
+import time
+from dataclasses import replace
+from typing import Iterator, Optional
+
+import numpy as np
+
+from .filaments import FrameFeed
+from .image_utils import LazyFrame
+from .main import track_filament_frames
+from .metrics import TrackingMetrics
+from .models import Config, TrackingResultArrays
+
+# Densidad de puntos mínima de la vista previa (ver Config.point_density)
+PREVIEW_POINT_DENSITY = 4
+
+# Estimador del pico de la vista previa, si la configuración usa el ajuste gaussiano (ver Config.peak_estimator)
+PREVIEW_PEAK_ESTIMATOR = 'log_parabolic'
+
+def preview_config(config: Config) -> Config:
+    peak_estimator = PREVIEW_PEAK_ESTIMATOR if config.peak_estimator == 'gauss' else config.peak_estimator
+    return replace(config, point_density=max(config.point_density, PREVIEW_POINT_DENSITY), peak_estimator=peak_estimator)
+
+def track_preview(frames: Iterator, frames_total: int, user_points: np.ndarray, config: Config, budget: float,
+                  stride: Optional[int] = None, metrics: Optional[TrackingMetrics] = None) -> TrackingResultArrays:
+    """
+    Vista previa del tracking, para ajustar la configuración rápidamente: se trackea uno de cada stride frames, con menos
+    puntos (ver preview_config) y sin el ajuste gaussiano, que es el estimador del pico más lento.
+    Sin stride, se elige a partir del tiempo del primer frame para que todo el stack entre en budget segundos.
+    Si aun así se excede budget, se retornan los frames trackeados hasta ese momento.
+    Los frames que no se trackean se saltean sin decodificarlos, por lo que conviene que sean LazyFrame (ver lazy_frames_iterator).
+    Sin config.roi_decoding, los LazyFrame se decodifican completos.
+    """
+    start = time.perf_counter()
+    deadline = start + budget
+    config = preview_config(config)
+    errors = []
+
+    # Los frames se entregan de a uno, para poder elegir el stride luego del primero
+    feed = FrameFeed()
+    tracker = track_filament_frames(feed, user_points, config, errors, metrics)
+    frames = iter(frames)
+    results = []
+
+    def push(frame) -> None:
+        if isinstance(frame, LazyFrame) and not config.roi_decoding:
+            frame = frame.read()[0]
+        feed.frame = frame
+        results.append(next(tracker))
+
+    for frame in itertools.islice(frames, 1):
+        push(frame)
+
+    if stride is None:
+        stride = max(1, math.ceil(frames_total * (time.perf_counter() - start) / budget))
+    for frame in itertools.islice(frames, stride - 1, None, stride):
+        push(frame)
+        if time.perf_counter() >= deadline:
+            break
+
+    result = TrackingResultArrays.from_frames(results, errors)
+    return replace(result, frame_step=stride)
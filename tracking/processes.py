@@ -0,0 +1,38 @@
+import os
+from typing import Optional
+
+def process_start(pid: int) -> Optional[str]:
+    """
+    Momento de inicio del proceso pid (en ticks desde el arranque del sistema, de /proc), o None si no se puede saber.
+    Junto con el pid identifica al proceso aunque el pid se reutilice.
+    """
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # El nombre del proceso (campo 2) puede tener espacios y paréntesis, por lo que se cuenta desde el último ')'
+    return stat[stat.rindex(')') + 2:].split()[19]
+
+def process_id() -> str:
+    """
+    Identificador único del proceso actual: {pid}-{inicio}. Se calcula en cada llamada, ya que cambia con cada fork.
+    """
+    pid = os.getpid()
+    return f'{pid}-{process_start(pid) or 0}'
+
+def process_alive(process: str) -> bool:
+    """
+    Si el proceso con el identificador process (ver process_id) sigue corriendo.
+    Sin /proc (o sin el inicio en el identificador) solo se puede verificar el pid, por lo que un pid reutilizado se considera vivo.
+    """
+    pid, _, start = process.partition('-')
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Existe, pero es de otro usuario
+        pass
+    current = process_start(int(pid))
+    return current is None or start in ('', '0') or current == start
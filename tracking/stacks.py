@@ -0,0 +1,160 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from dataclasses import dataclass, asdict, replace
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from .cache import files_digest
+from .image_utils import frames_count, frames_iterator
+from .models import ApplicationError, Config
+
+@dataclass
+class StackInfo:
+    id:         str
+    frames:     int
+    height:     int
+    width:      int
+    dtype:      str
+    native:     bool    # Profundidad nativa (ver Config.native_depth). Si no, los frames están normalizados a 8 bits
+    digest:     str     # Hash de los archivos originales (ver files_digest), para compartir la cache de resultados
+    created:    float
+
+    def tracking_config(self, config: Config) -> Config:
+        """
+        Configuración equivalente a la de trackear los archivos originales. La decodificación ya la definió
+        el stack: su profundidad es la elegida al subirlo y los frames están decodificados completos.
+        """
+        return replace(config, native_depth=self.native, roi_decoding=False)
+
+class StackStore:
+    """
+    Stacks subidos una sola vez y trackeados muchas veces.
+    Cada stack se decodifica al subirlo a un único arreglo .npy (frames, height, width), que luego se lee mapeado en
+    memoria: trackear un stack guardado no decodifica nada y solo lee las paginas del archivo que toca el tracking.
+    Todo vive en el sistema de archivos (un directorio por stack), para que cualquier worker de gunicorn pueda usar
+    un stack subido a otro. El tamaño total está limitado, y se eliminan primero los stacks usados hace más tiempo
+    (el orden LRU se lleva con la fecha de modificación del archivo de información).
+    """
+    INFO_FILE   = 'stack.json'
+    FRAMES_FILE = 'frames.npy'
+
+    def __init__(self, root: str, disk_limit: int):
+        self.root = root
+        self.disk_limit = disk_limit
+        if disk_limit > 0:
+            os.makedirs(root, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.disk_limit > 0
+
+    def stack_dir(self, stack_id: str) -> str:
+        # El id es siempre un sha256 en hexadecimal. Lo validamos para no salir de root
+        if len(stack_id) != 64 or any(c not in '0123456789abcdef' for c in stack_id) or not os.path.isdir(path := os.path.join(self.root, stack_id)):
+            raise ApplicationError(f'Stack {stack_id} not found')
+        return path
+
+    def create(self, images, allowed_ext: List[str], native: bool = False) -> StackInfo:
+        """
+        Decodifica y guarda los frames de las imagenes. Si el mismo stack ya estaba guardado, no se decodifica de nuevo.
+        """
+        if not self.enabled:
+            raise ApplicationError('The stack store is disabled')
+
+        digest = files_digest(images)
+        # El id depende del contenido y de la decodificación, así subir 2 veces el mismo stack no ocupa el doble
+        stack_id = hashlib.sha256(digest + f'native={native}'.encode()).hexdigest()
+        try:
+            return self.info(stack_id)
+        except ApplicationError:
+            pass
+
+        count = frames_count(images, allowed_ext)
+        # Se escribe en un directorio temporal, que se renombra recién cuando está completo
+        tmp_dir = os.path.join(self.root, f'.{stack_id}.{uuid.uuid4().hex}.tmp')
+        os.makedirs(tmp_dir)
+        try:
+            stack = None
+            for i, frame in enumerate(frames_iterator(images, allowed_ext, native)):
+                if stack is None:
+                    size = count * frame.nbytes
+                    if size > self.disk_limit:
+                        raise ApplicationError(f'Stack is too large ({size} bytes). Max size: {self.disk_limit} bytes')
+                    stack = np.lib.format.open_memmap(os.path.join(tmp_dir, self.FRAMES_FILE), mode='w+', dtype=frame.dtype, shape=(count, *frame.shape))
+                elif frame.shape != stack.shape[1:] or frame.dtype != stack.dtype:
+                    raise ApplicationError(f'Every frame of a stack must have the same size and depth. Frame {i} is {frame.shape} {frame.dtype}, expected {stack.shape[1:]} {stack.dtype}')
+                stack[i] = frame
+            stack.flush()
+
+            info = StackInfo(stack_id, *stack.shape, stack.dtype.name, native, digest.hex(), time.time())
+            del stack
+            with open(os.path.join(tmp_dir, self.INFO_FILE), 'w') as f:
+                json.dump(asdict(info), f)
+
+            try:
+                os.rename(tmp_dir, os.path.join(self.root, stack_id))
+            except OSError:
+                # Otro worker guardo el mismo stack mientras lo decodificabamos
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        self.evict(keep=stack_id)
+        return info
+
+    def info(self, stack_id: str) -> StackInfo:
+        path = os.path.join(self.stack_dir(stack_id), self.INFO_FILE)
+        try:
+            with open(path) as f:
+                info = StackInfo(**json.load(f))
+            os.utime(path)
+        except FileNotFoundError:
+            # Otro worker lo esta eliminando
+            raise ApplicationError(f'Stack {stack_id} not found')
+        return info
+
+    def load(self, stack_id: str) -> Tuple[StackInfo, np.ndarray]:
+        """
+        Información y frames del stack. Los frames se mapean en memoria, por lo que siguen siendo válidos
+        aunque el stack se elimine mientras se trackea.
+        """
+        info = self.info(stack_id)
+        try:
+            frames = np.load(os.path.join(self.stack_dir(stack_id), self.FRAMES_FILE), mmap_mode='r')
+        except FileNotFoundError:
+            raise ApplicationError(f'Stack {stack_id} not found')
+        return info, frames
+
+    def delete(self, stack_id: str) -> StackInfo:
+        info = self.info(stack_id)
+        shutil.rmtree(self.stack_dir(stack_id), ignore_errors=True)
+        return info
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        stacks = []
+        for entry in os.scandir(self.root):
+            # Los directorios temporales son stacks que se estan guardando
+            if entry.name.startswith('.') or not entry.is_dir():
+                continue
+            try:
+                mtime = os.path.getmtime(os.path.join(entry.path, self.INFO_FILE))
+                size = os.path.getsize(os.path.join(entry.path, self.FRAMES_FILE))
+                stacks.append((mtime, size, entry.name))
+            except FileNotFoundError:
+                # Otro worker lo esta eliminando
+                pass
+
+        total = sum(size for _, size, _ in stacks)
+        for _, size, stack_id in sorted(stacks):
+            if total <= self.disk_limit:
+                break
+            if stack_id == keep:
+                continue
+            shutil.rmtree(os.path.join(self.root, stack_id), ignore_errors=True)
+            total -= size
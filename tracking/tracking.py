@@ -1,10 +1,12 @@
-from typing import List, Optional, Tuple
+import threading
+import warnings
+from collections import OrderedDict
+from functools import partial
+from typing import Callable, Dict, List, Optional, Tuple
 
 import numpy as np
 import skimage
-from scipy import stats
-from scipy.optimize import curve_fit
-from scipy.special import comb
+from scipy.special import gammaln, xlogy
 
 def multi_point_linear_interpolation(points: np.ndarray, density: int = 1) -> np.ndarray:
     """
@@ -12,105 +14,142 @@ def multi_point_linear_interpolation(points: np.ndarray, density: int = 1) -> np
     """
     return np.append(np.concatenate([points_linear_interpolation(start, end)[:-1][::density] for start, end in zip(points, points[1:])]), [points[-1]], axis=0)
 
+def resample_points(points: np.ndarray, count: int) -> np.ndarray:
+    """
+    Reparte count puntos equiespaciados (por longitud de arco) sobre la poligonal que definen los puntos (n, 2).
+    """
+    arc = np.concatenate(([0], np.cumsum(np.linalg.norm(np.diff(points, axis=0), axis=1))))
+    if arc[-1] == 0:
+        return np.repeat(points[:1].astype(np.float64), count, axis=0)
+    positions = np.linspace(0, arc[-1], count)
+    return np.stack((np.interp(positions, arc, points[:, 0]), np.interp(positions, arc, points[:, 1])), axis=1)
+
 def points_linear_interpolation(start: np.ndarray, end: np.ndarray) -> np.ndarray:
     # line returns the pixels of the line described by the 2 points
     # https://scikit-image.org/docs/stable/api/skimage.draw.html#line
     return np.stack(skimage.draw.line(*start.astype(int), *end.astype(int)), axis=-1)
 
-def project_to_line(point: Tuple[float, float], m1: float, b1: float) -> Tuple[float, float]:
-    if m1 == 0:
-        # Proyección a línea horizontal
-        return point[0], b1
-    m2 = -1 / m1
-    b2 = point[1] - m2 * point[0]
-    x = (b2 - b1) / (m1 - m2)
-    y = m1*x + b1
-    return x, y
-
-def interpolate_points(interpolation_points: List[Tuple[float, float]], none_points: int, leftmost_point: Tuple[float, float], rightmost_point: Tuple[float, float]) -> np.ndarray:
-    interpolation_points = np.asarray(interpolation_points)
-    try:
-        res = stats.linregress(interpolation_points)
-    except ValueError:
-        return np.asarray([interpolation_points[0] for _ in range(none_points)])
-
-    first_point = project_to_line(leftmost_point, res.slope, res.intercept)
-    last_point = project_to_line(rightmost_point, res.slope, res.intercept)
-
-    xs = np.linspace(first_point[0], last_point[0], none_points + 2, endpoint=True)[1:-1]
-    points = np.repeat(xs[:, None], 2, axis=1)
-    points[:, 1] = points[:, 1] * res.slope + res.intercept
-
-    return points
+def ranges_indices(starts: np.ndarray, ends: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Concatena los rangos [start, end) y retorna los indices junto con el número de rango al que pertenece cada uno.
+    """
+    lengths = ends - starts
+    owner = np.repeat(np.arange(len(starts)), lengths)
+    indices = np.arange(np.sum(lengths)) - np.repeat(np.cumsum(lengths) - lengths, lengths) + starts[owner]
+    return indices, owner
 
-def interpolate_missing(points: List[Optional[Tuple[float, float]]], previous_points: np.ndarray, inter_len: int) -> Tuple[np.ndarray, List[int], List[int]]:
+def interpolate_gaps(result: np.ndarray, points: np.ndarray, valid: np.ndarray, first_valid: int, gap_start: np.ndarray, gap_end: np.ndarray, inter_len: int):
+    """
+    Rellena en result los huecos [gap_start, gap_end) mediante una regresión lineal (de y sobre x) de a lo sumo inter_len
+    puntos hacia cada lado, todos a la vez. Los puntos de la izquierda se toman de result (pueden haber sido interpolados),
+    los de la derecha son los puntos validos originales.
+    Los extremos del hueco se proyectan sobre la recta y los puntos interpolados se distribuyen uniformemente entre ellos.
+    """
+    offsets = np.arange(inter_len)
+
+    # Ventana izquierda: los inter_len puntos anteriores al hueco (sin ir antes del primer punto valido)
+    left_idx = gap_start[:, None] - inter_len + offsets
+    left_mask = left_idx >= first_valid
+    left_idx = np.maximum(left_idx, first_valid)
+
+    # Ventana derecha: el punto que cierra el hueco y los validos de los inter_len - 1 siguientes
+    right_idx = gap_end[:, None] + offsets
+    right_mask = right_idx < len(points)
+    right_idx = np.minimum(right_idx, len(points) - 1)
+    right_mask &= valid[right_idx]
+
+    window = np.concatenate((result[left_idx], points[right_idx]), axis=1)
+    mask = np.concatenate((left_mask, right_mask), axis=1)
+    count = np.count_nonzero(mask, axis=1)
+
+    x = np.where(mask, window[..., 0], 0)
+    y = np.where(mask, window[..., 1], 0)
+    x_mean = np.sum(x, axis=1) / count
+    y_mean = np.sum(y, axis=1) / count
+    ssxm = np.sum(np.where(mask, np.square(x - x_mean[:, None]), 0), axis=1) / count
+    ssxym = np.sum(np.where(mask, (x - x_mean[:, None]) * (y - y_mean[:, None]), 0), axis=1) / count
+
+    # No se puede hacer la regresión si todos los x son iguales. En ese caso repetimos el primer punto de la ventana
+    x_min = np.min(np.where(mask, window[..., 0], np.inf), axis=1)
+    x_max = np.max(np.where(mask, window[..., 0], -np.inf), axis=1)
+    degenerate = x_min == x_max
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = ssxym / ssxm
+        intercept = y_mean - slope * x_mean
+
+        # Proyectamos los extremos del hueco sobre la recta (solo necesitamos su x)
+        def project_x(point: np.ndarray) -> np.ndarray:
+            normal_slope = -1 / slope
+            normal_intercept = point[:, 1] - normal_slope * point[:, 0]
+            return np.where(slope == 0, point[:, 0], (normal_intercept - intercept) / (slope - normal_slope))
+
+        first_x = project_x(result[gap_start - 1])
+        last_x = project_x(points[gap_end])
+
+    # Posición de cada punto faltante dentro de su hueco
+    missing, gap_of = ranges_indices(gap_start, gap_end)
+    pos = missing - gap_start[gap_of] + 1
+    lengths = (gap_end - gap_start)[gap_of]
+
+    xs = first_x[gap_of] + pos * (last_x[gap_of] - first_x[gap_of]) / (lengths + 1)
+    result[missing] = np.stack((xs, xs * slope[gap_of] + intercept[gap_of]), axis=1)
+
+    fallback = degenerate[gap_of]
+    result[missing[fallback]] = window[gap_of[fallback], np.argmax(mask[gap_of[fallback]], axis=1)]
+
+def interpolate_missing(points: np.ndarray, previous_points: np.ndarray, inter_len: int) -> Tuple[np.ndarray, List[int], List[int]]:
     """
     Returns results with interpolated points included, or previous points if interpolation couldn't be done.
+    Missing points are represented as NaN in the (n, 2) points array.
     Also, a list of the indices of the interpolated/preserved points is provided.
     """
-    valid_points: List[Tuple[float, float]] = []
-    interpolated_points_idx: List[int]      = []
-    preserved_points_idx: List[int]         = []
-    initial_to_be_preserved                 = 0
-
-    none_flag = False
-    previous_index = 0
-    interpolation_points: List[Tuple[float, float]] = []
-    leftmost_point: Tuple[float, float]
-    rightmost_point: Tuple[float, float]
-
-    for i, point in enumerate(points):
-        if point:
-            if none_flag:
-                if i + 1 != len(points) and not (i + 1 < len(points) and points[i + 1]):
-                    continue
-
-                interpolation_points.append(point)
-                rightmost_point = point
-                for j in range(1, inter_len):
-                    new_pos = i + j
-                    if new_pos < len(points) and points[new_pos]:
-                        interpolation_points.append(points[new_pos])
-
-                # interpolo entre previous_point y next_point, pero elimino lo que me corri, osea saco los primeros l_pos
-                point_amount = i - previous_index - 1
-                interpolation = interpolate_points(interpolation_points, point_amount, leftmost_point, rightmost_point)
-
-                valid_points.extend(interpolation)
-                interpolated_points_idx.extend(range(previous_index + 1, i))  # Le agregamos los indices de los puntos interpolados
-                interpolation_points = []
-                none_flag = False
-            # else:
-            #   # dejo el punto en converted como esta y lo appendeo a los valores validos
-            valid_points.append(point)
-        else:
-            # no es valido el punto y vengo de uno valido
-            if not none_flag:
-                # busco el indice del punto mas lejos que tenga para atras
-                if len(valid_points) > 0:
-                    left_pos = min(len(valid_points), inter_len)
-
-                    interpolation_points.extend(valid_points[-left_pos:])
-                    leftmost_point = interpolation_points[-1]
-                    # indice previo
-                    previous_index = i - 1
-                    none_flag = True
-                else:
-                    initial_to_be_preserved += 1
-
-    # Calculamos los puntos que no pudimos interpolar al principio y les asignamos el punto previo (los "preservamos")
-    if initial_to_be_preserved > 0:
-        valid_points = list(previous_points[:initial_to_be_preserved]) + valid_points
-        preserved_points_idx.extend(range(initial_to_be_preserved))
-
-    # Lo mismo pero al final
-    points_count = len(points)
-    valid_count = len(valid_points)
-    if points_count - valid_count > 0:
-        valid_points.extend(previous_points[valid_count:])
-        preserved_points_idx.extend(range(valid_count, points_count))
-
-    return np.array(valid_points), interpolated_points_idx, preserved_points_idx
+    n = len(points)
+    valid = ~np.isnan(points[:, 0])
+    if not np.any(valid):
+        return previous_points.copy(), [], list(range(n))
+
+    result = points.copy()
+
+    # Buscamos las corridas de puntos validos
+    edges = np.diff(np.concatenate(([False], valid, [False])).astype(np.int8))
+    run_start = np.flatnonzero(edges == 1)
+    run_end = np.flatnonzero(edges == -1)  # Exclusivo
+    first_valid = run_start[0]
+
+    # Un hueco solo se cierra con una corrida de al menos 2 puntos, o que llega al final.
+    # Las corridas de un solo punto en medio de un hueco son descartadas e interpoladas junto con el hueco.
+    # La primera corrida siempre se conserva.
+    closing = (run_end - run_start >= 2) | (run_end == n)
+    closing[0] = True
+    kept_start = run_start[closing]
+    kept_end = run_end[closing]
+
+    # Los huecos van desde el final de una corrida conservada hasta el inicio de la siguiente
+    gap_start = kept_end[:-1]
+    gap_end = kept_start[1:]
+
+    # La ventana izquierda de un hueco puede incluir puntos interpolados de huecos anteriores,
+    # por lo que interpolamos por tandas, cada vez todos los huecos que ya no dependen de uno pendiente
+    missing, gap_of = ranges_indices(gap_start, gap_end)
+    pending = np.zeros(n, dtype=bool)
+    pending[missing] = True
+    window_start = np.maximum(gap_start - inter_len, first_valid)
+    remaining = np.ones(len(gap_start), dtype=bool)
+    while np.any(remaining):
+        pending_count = np.concatenate(([0], np.cumsum(pending)))
+        ready = remaining & (pending_count[gap_start] == pending_count[window_start])
+        interpolate_gaps(result, points, valid, first_valid, gap_start[ready], gap_end[ready], inter_len)
+        pending[missing[ready[gap_of]]] = False
+        remaining &= ~ready
+
+    interpolated_points_idx = missing.tolist()
+
+    # Los puntos que no pudimos interpolar al principio y al final les asignamos el punto previo (los "preservamos")
+    preserved_points_idx = list(range(first_valid)) + list(range(kept_end[-1], n))
+    result[preserved_points_idx] = previous_points[preserved_points_idx]
+
+    return result, interpolated_points_idx, preserved_points_idx
 
 def profile_pos_to_point(pos: float, points: np.ndarray) -> Optional[Tuple[float, float]]:
     """
@@ -130,36 +169,296 @@ def profile_pos_to_point(pos: float, points: np.ndarray) -> Optional[Tuple[float
 
     return new_x, new_y
 
-def gauss_fitting(intensity_profile: np.ndarray, max_error: float) -> Optional[float]:
+def profile_pos_to_points(positions: np.ndarray, coords: np.ndarray) -> np.ndarray:
     """
-    Ajusta los puntos a una distribución gaussiana y retorna su maximo (la media).
-    En caso de no encontrarse, o que el error supere el límite establecido, se retorna None
+    Version vectorizada de profile_pos_to_point para la grilla densa (n, L, 2) de normal_line_samples.
+    Las posiciones (n,) que sean NaN o no se encuentren en la recta resultan en un punto NaN.
     """
-    profile_len = len(intensity_profile)
-    xdata = np.arange(profile_len)
-    max_c = np.max(intensity_profile)
-    max_idx = np.argmax(intensity_profile)
-    try:
-        # Hay veces que curve_fit no logra establecer la covarianza de los parametros, lanza un warning y retorna error infinito
-        # Estos casos los estamos manejando bien (con el threshold), por lo que queremos suprimir el warning
-        import warnings
-        with warnings.catch_warnings():
-            from scipy.optimize import OptimizeWarning
-            warnings.simplefilter("ignore", category=OptimizeWarning)
-
-            popt, pcov = curve_fit(
-                lambda x, mu, sig, a, y0: y0 + a * np.exp(-np.power((x - mu) / sig, 2.) / 2),
-                xdata,
-                intensity_profile,
-                p0=([max_idx, 1, max_c, max_c/4]),
-            )
-        p_error = np.square(np.diag(pcov))
-        return popt[0] if p_error[0] < max_error else None
-    except RuntimeError:
-        # Intensity profile failed to be fitted by a gaussian curve
+    n, length, _ = coords.shape
+    ret = np.full((n, 2), np.nan)
+    with np.errstate(invalid='ignore'):
+        valid = (positions >= 0) & (positions < length - 1)
+    rows = np.flatnonzero(valid)
+    idx = positions[rows].astype(np.int64)
+    delta = (positions[rows] - idx)[:, None]
+    start = coords[rows, idx]
+    end = coords[rows, idx + 1]
+    ret[rows] = start + delta * (end - start)
+    return ret
+
+def pad_profiles(intensity_profiles: List[np.ndarray]) -> np.ndarray:
+    """
+    Arma una matriz (n, L) con los perfiles de intensidad, rellenando con NaN los perfiles mas cortos que L.
+    """
+    length = max(map(len, intensity_profiles), default=0)
+    ret = np.full((len(intensity_profiles), length), np.nan)
+    for i, profile in enumerate(intensity_profiles):
+        ret[i, :len(profile)] = profile
+    return ret
+
+def gauss_batch_model(xdata: np.ndarray, params: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Evalua y0 + a * exp(-((x - mu) / sig)^2 / 2) para cada fila de parametros (mu, sig, a, y0).
+    Retorna los valores (n, L) y el jacobiano respecto de los parametros (n, L, 4).
+    """
+    mu, sig, a, y0 = (params[:, i, None] for i in range(4))
+    z = (xdata - mu) / sig
+    e = np.exp(-np.square(z) / 2)
+    values = y0 + a * e
+    jac = np.stack((a * e * z / sig, a * e * np.square(z) / sig, e, np.ones_like(e)), axis=-1)
+    return values, jac
+
+def gauss_fitting_batch(intensity_profiles: np.ndarray, max_error: float, max_iter: int = 100, tol: float = 1.5e-8) -> np.ndarray:
+    """
+    Ajusta todos los perfiles (n, L) de un frame a una gaussiana a la vez, mediante iteraciones de Levenberg-Marquardt,
+    con el mismo criterio que el ajuste de scipy (curve_fit) que reemplaza. Los valores NaN del perfil son ignorados (perfiles de distinta longitud).
+    Retorna la media de cada perfil, o NaN en caso de no converger o que el error supere el límite establecido.
+    La decisión de aceptar un ajuste puede diferir de curve_fit en los ajustes mal condicionados (ancho menor a medio pixel
+    o mayor al perfil), donde cada método se detiene en otro punto del valle. Ver validation/fitting_benchmark.py.
+    """
+    return gauss_fitting_params_batch(intensity_profiles, max_error, max_iter=max_iter, tol=tol)[0]
+
+def gauss_fitting_params_batch(intensity_profiles: np.ndarray, max_error: float, initial_params: Optional[np.ndarray] = None,
+                               max_iter: int = 100, tol: float = 1.5e-8) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Igual que gauss_fitting_batch, pero los parámetros (mu, sig, a, y0) de cada perfil pueden partir de initial_params (n, 4)
+    en vez de estimarse del perfil (ver gauss_warm_start). Los valores NaN de initial_params usan la estimación de siempre.
+    Retorna la media de cada perfil, los parámetros ajustados (n, 4) (NaN si el ajuste falló o fue rechazado),
+    y la cantidad de iteraciones de cada perfil.
+    """
+    profiles = np.asarray(intensity_profiles, dtype=np.float64)
+    n, length = profiles.shape
+    xdata = np.arange(length, dtype=np.float64)
+    mask = ~np.isnan(profiles)
+    weights = mask.astype(np.float64)
+    ydata = np.where(mask, profiles, 0)
+    count = np.count_nonzero(mask, axis=1)
+
+    # Mismo punto de partida que el ajuste con curve_fit: [argmax, 1, max, max/4]
+    max_idx = np.argmax(np.where(mask, profiles, -np.inf), axis=1) if length > 0 else np.zeros(n, dtype=np.int64)
+    max_c = ydata[np.arange(n), max_idx] if length > 0 else np.zeros(n)
+    params = np.stack((max_idx.astype(np.float64), np.ones(n), max_c, max_c / 4), axis=1)
+    if initial_params is not None:
+        params = np.where(np.isfinite(initial_params), initial_params, params)
+
+    def residuals(rows: np.ndarray, p: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        values, jac = gauss_batch_model(xdata, p)
+        r = (ydata[rows] - values) * weights[rows]
+        return r, jac * weights[rows, :, None]
+
+    # Como en curve_fit, necesitamos mas puntos que parametros para poder estimar la covarianza
+    active = count > 4
+    converged = np.zeros(n, dtype=bool)
+    damping = np.full(n, 1e-3)
+    damping_growth = np.full(n, 2.)
+    cost = np.full(n, np.inf)
+    iterations = np.zeros(n, dtype=np.int64)
+    with np.errstate(all='ignore'):
+        rows = np.flatnonzero(active)
+        cost[rows] = np.sum(np.square(residuals(rows, params[rows])[0]), axis=1)
+
+        for _ in range(max_iter):
+            rows = np.flatnonzero(active)
+            if len(rows) == 0:
+                break
+            iterations[rows] += 1
+
+            r, jac = residuals(rows, params[rows])
+            jtj = np.einsum('nli,nlj->nij', jac, jac)
+            grad = np.einsum('nli,nl->ni', jac, r)
+            diag = np.maximum(np.diagonal(jtj, axis1=1, axis2=2), 1e-12)
+            lhs = jtj + damping[rows, None, None] * diag[:, :, None] * np.eye(4)
+            lhs[~np.isfinite(lhs)] = 0
+            grad[~np.isfinite(grad)] = 0
+            delta = _batch_solve(lhs, grad)
+
+            new_params = params[rows] + delta
+            new_cost = np.sum(np.square(residuals(rows, new_params)[0]), axis=1)
+
+            # Actualizamos el amortiguamiento segun la ganancia real vs la predicha por el modelo lineal (Nielsen)
+            predicted = np.einsum('ni,ni->n', delta, damping[rows, None] * diag * delta + grad)
+            gain = (cost[rows] - new_cost) / predicted
+            improved = np.isfinite(new_cost) & (gain > 0)
+
+            small_gain = improved & ((cost[rows] - new_cost) <= tol * cost[rows])
+            small_step = np.linalg.norm(delta, axis=1) <= tol * (np.linalg.norm(params[rows], axis=1) + tol)
+            params[rows[improved]] = new_params[improved]
+            cost[rows[improved]] = new_cost[improved]
+            damping[rows] *= np.where(improved, np.maximum(1 / 3, 1 - np.power(2 * gain - 1, 3)), damping_growth[rows])
+            damping_growth[rows] = np.where(improved, 2, damping_growth[rows] * 2)
+
+            done = small_gain | small_step
+            converged[rows[done]] = True
+            active[rows[done]] = False
+
+        # Los que no convergieron son equivalentes al RuntimeError de curve_fit
+        ret = np.full(n, np.nan)
+        fitted = np.full((n, 4), np.nan)
+        rows = np.flatnonzero(converged)
+        if len(rows) == 0:
+            return ret, fitted, iterations
+
+        # Covarianza estimada igual que curve_fit: pinv(J^T J) * s_sq, a partir de la SVD del jacobiano
+        _, jac = residuals(rows, params[rows])
+        finite = np.all(np.isfinite(jac), axis=(1, 2))
+        var_mu = np.full(len(rows), np.inf)
+        _, sv, vt = np.linalg.svd(jac[finite], full_matrices=False)
+        threshold = np.finfo(np.float64).eps * length * sv[:, :1]
+        inv_sq = np.where(sv > threshold, 1 / np.square(sv), 0)
+        var_mu[finite] = np.sum(np.square(vt[:, :, 0]) * inv_sq, axis=1) * cost[rows[finite]] / (count[rows[finite]] - 4)
+        p_error = np.square(var_mu)
+
+    accepted = np.isfinite(p_error) & (p_error < max_error)
+    ret[rows[accepted]] = params[rows[accepted], 0]
+    fitted[rows[accepted]] = params[rows[accepted]]
+    return ret, fitted, iterations
+
+def gauss_warm_start(fit_params: Optional[np.ndarray], intensity_profiles: np.ndarray) -> Optional[np.ndarray]:
+    """
+    Parámetros iniciales del ajuste gaussiano (ver gauss_fitting_params_batch) a partir de los ajustados en el frame anterior:
+    el ancho, la amplitud y el fondo se mantienen. La media parte siempre del máximo del perfil, ya que el filamento se mueve,
+    y lejos del pico el ajuste no converge. Los puntos cuyo ajuste anterior falló parten de la estimación de siempre (NaN).
+    """
+    if fit_params is None or len(fit_params) != len(intensity_profiles):
         return None
+    return np.column_stack((np.full(len(fit_params), np.nan), np.abs(fit_params[:, 1]), fit_params[:, 2], fit_params[:, 3]))
 
-def generate_normal_line_bounds(points: np.ndarray, tangent_length: int, normal_len: float) -> np.ndarray:
+def parabolic_peak_batch(intensity_profiles: np.ndarray, max_error: Optional[float] = None, log: bool = True) -> np.ndarray:
+    """
+    Estimador barato del pico de cada perfil (n, L): interpola una parábola por el máximo y sus 2 vecinos.
+    Con log se interpola el logaritmo del perfil (descontando su mínimo), lo que es exacto para una gaussiana.
+    Mismo formato que gauss_fitting_batch: el error es el cuadrado de la varianza de la posición, propagando a la
+    parábola el ruido del frame (ver estimate_profile_noise). Sin max_error no se rechaza ningún pico.
+    Retorna NaN si el máximo no es un pico (está en un borde del perfil o no es mayor que sus vecinos), o si el error supera max_error.
+    """
+    profiles = np.asarray(intensity_profiles, dtype=np.float64)
+    n, length = profiles.shape
+    if length < 3:
+        return np.full(n, np.nan)
+    with np.errstate(all='ignore'):
+        mask = ~np.isnan(profiles)
+        peak = np.argmax(np.where(mask, profiles, -np.inf), axis=1)
+        center = np.clip(peak, 1, length - 2)
+        rows = np.arange(n)
+        left, mid, right = profiles[rows, center - 1], profiles[rows, center], profiles[rows, center + 1]
+        noise = estimate_profile_noise(profiles) if max_error is not None else np.nan
+        if log:
+            base = np.min(np.where(mask, profiles, np.inf), axis=1) - 1
+            # El ruido de cada muestra en el logaritmo es noise / (valor - base)
+            noise_left, noise_mid, noise_right = noise / (left - base), noise / (mid - base), noise / (right - base)
+            left, mid, right = np.log(left - base), np.log(mid - base), np.log(right - base)
+        else:
+            noise_left = noise_mid = noise_right = noise
+        curvature = left - 2 * mid + right
+        slope = left - right
+        offset = 0.5 * slope / curvature
+        valid = (curvature < 0) & (np.abs(offset) <= 1)
+        if max_error is not None:
+            # Varianza del desplazamiento, a partir de sus derivadas respecto de cada muestra
+            var = (np.square(0.5 * (curvature - slope) * noise_left) + np.square(slope * noise_mid)
+                   + np.square(0.5 * (curvature + slope) * noise_right)) / np.power(curvature, 4)
+            valid &= np.square(var) < max_error
+    return np.where(valid, center + offset, np.nan)
+
+def centroid_peak_batch(intensity_profiles: np.ndarray, max_error: Optional[float] = None) -> np.ndarray:
+    """
+    Estimador del pico de cada perfil (n, L) por su centroide: el promedio de las posiciones pesado por la intensidad
+    por encima de la mitad del máximo (descontando el mínimo del perfil, como fondo).
+    Mismo formato que gauss_fitting_batch: el error es el cuadrado de la varianza del centroide, que por el ruido del frame
+    (ver estimate_profile_noise) es noise^2 * el segundo momento de las posiciones que pesan / el peso total^2.
+    Sin max_error no se rechaza ningún pico. Retorna NaN si el perfil es constante, o si el error supera max_error.
+    """
+    profiles = np.asarray(intensity_profiles, dtype=np.float64)
+    n, length = profiles.shape
+    with np.errstate(all='ignore'):
+        mask = ~np.isnan(profiles)
+        low = np.min(np.where(mask, profiles, np.inf), axis=1, initial=np.inf)
+        high = np.max(np.where(mask, profiles, -np.inf), axis=1, initial=-np.inf)
+        weights = np.where(mask, np.maximum(profiles - ((low + high) / 2)[:, None], 0), 0)
+        total = np.sum(weights, axis=1)
+        xdata = np.arange(length, dtype=np.float64)
+        centroid = weights @ xdata / total
+        valid = total > 0
+        if max_error is not None:
+            second_moment = np.sum(np.where(weights > 0, np.square(xdata - centroid[:, None]), 0), axis=1)
+            var = np.square(estimate_profile_noise(profiles)) * second_moment / np.square(total)
+            valid &= np.square(var) < max_error
+    return np.where(valid, centroid, np.nan)
+
+def estimate_profile_noise(intensity_profiles: np.ndarray, quantization_step: Optional[float] = None) -> float:
+    """
+    Desvío del ruido de un frame, a partir de las diferencias entre muestras consecutivas de todos sus perfiles (n, L):
+    se usa el cuartil inferior, ya que las diferencias grandes son los bordes del filamento y no ruido.
+    En frames cuantizados con poco ruido el cuartil es 0, por lo que el resultado nunca es menor al ruido de cuantización
+    (paso / sqrt(12)). Sin quantization_step, el paso es la menor diferencia no nula.
+    Retorna NaN si no se puede estimar (no hay diferencias no nulas).
+    """
+    diffs = np.abs(np.diff(intensity_profiles, axis=1))
+    diffs = diffs[~np.isnan(diffs)]
+    nonzero = diffs[diffs > 0]
+    if not len(nonzero):
+        return np.nan
+    step = quantization_step if quantization_step is not None else nonzero.min()
+    # Para ruido gaussiano de desvío sigma, el cuartil inferior de |x_i+1 - x_i| es 0.3186 * sqrt(2) * sigma
+    return max(np.quantile(diffs, 0.25) / (0.3186 * np.sqrt(2)), step / np.sqrt(12))
+
+def screen_profiles(intensity_profiles: np.ndarray, min_contrast: float, min_snr: float, inverted: bool = False,
+                    quantization_step: Optional[float] = None) -> Tuple[np.ndarray, float]:
+    """
+    Filtro previo al ajuste: retorna qué perfiles (n, L) tienen contraste y relación señal/ruido suficientes para ajustarlos,
+    y el ruido estimado del frame (ver estimate_profile_noise).
+    La señal es la prominencia del filamento sobre el fondo (la mediana del perfil): max - mediana, o mediana - min si el
+    filamento es oscuro (inverted). El contraste es la prominencia sobre el rango del perfil (max - min), entre 0 y 1:
+    cercano a 1 cuando el pico sobresale de un fondo plano, y alrededor de 0.5 cuando el perfil es solo ruido.
+    Ambos son independientes del offset de la intensidad, y el contraste también de su escala.
+    Si el ruido no se puede estimar, ningún perfil pasa el filtro de min_snr.
+    Los valores NaN del perfil son ignorados. Los perfiles con menos de 3 muestras nunca pasan el filtro.
+    """
+    profiles = np.asarray(intensity_profiles, dtype=np.float64)
+    if profiles.shape[1] < 3:
+        return np.zeros(len(profiles), dtype=bool), np.nan
+    with warnings.catch_warnings(), np.errstate(all='ignore'):
+        # Las filas sin muestras generan warnings de nanmedian, y quedan descartadas de todas formas
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        mask = ~np.isnan(profiles)
+        high = np.max(np.where(mask, profiles, -np.inf), axis=1)
+        low = np.min(np.where(mask, profiles, np.inf), axis=1)
+        background = np.nanmedian(profiles, axis=1)
+        prominence = background - low if inverted else high - background
+        contrast = prominence / (high - low)
+        noise = estimate_profile_noise(profiles, quantization_step)
+        snr = prominence / noise
+        ok = (np.count_nonzero(mask, axis=1) >= 3) & (np.nan_to_num(contrast) >= min_contrast) & (np.nan_to_num(snr) >= min_snr)
+        return ok, noise
+
+def expand_rows(values: np.ndarray, rows: np.ndarray, n: int) -> np.ndarray:
+    """
+    Arreglo de n filas con values en las filas rows (índices o máscara) y NaN en el resto.
+    """
+    ret = np.full((n, *values.shape[1:]), np.nan)
+    ret[rows] = values
+    return ret
+
+# Estimadores de la posición del pico de cada perfil de intensidad, por nombre (ver Config.peak_estimator).
+# Todos reciben los perfiles (n, L) y max_error, y retornan la posición de cada pico, o NaN si no se pudo estimar o su error supera max_error
+PEAK_ESTIMATORS: Dict[str, Callable[[np.ndarray, float], np.ndarray]] = {
+    'gauss':            gauss_fitting_batch,
+    'log_parabolic':    parabolic_peak_batch,
+    'parabolic':        partial(parabolic_peak_batch, log=False),
+    'centroid':         centroid_peak_batch,
+}
+
+def _batch_solve(lhs: np.ndarray, rhs: np.ndarray) -> np.ndarray:
+    try:
+        return np.linalg.solve(lhs, rhs[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        # Algun sistema es singular (ej: amplitud nula), lo resolvemos fila por fila por cuadrados minimos
+        return np.stack([np.linalg.lstsq(a, b, rcond=None)[0] for a, b in zip(lhs, rhs)])
+
+def normal_directions(points: np.ndarray, tangent_length: int) -> np.ndarray:
+    """
+    Vector unitario (n, 2) normal al filamento en cada punto, a partir de la pendiente entre los vecinos a tangent_length puntos.
+    """
     d = tangent_length
 
     start = points[:-d]
@@ -173,23 +472,178 @@ def generate_normal_line_bounds(points: np.ndarray, tangent_length: int, normal_
     normal_angle[-d//2:] = normal_angle[-d//2 - 1]
 
     # Seno y coseno de la normal. Usados para generar los limites de la misma 
-    component_multiplier = np.stack((np.cos(normal_angle), np.sin(normal_angle)), axis=1)
-    upper = points + component_multiplier * normal_len / 2
-    lower = points - component_multiplier * normal_len / 2
+    return np.stack((np.cos(normal_angle), np.sin(normal_angle)), axis=1)
+
+def generate_normal_line_bounds(points: np.ndarray, tangent_length: int, normal_len, offsets: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Límites (n, 2, 2) de las rectas normales a cada punto, de longitud normal_len (un valor para todas, o uno por punto).
+    offsets (n,) desplaza el centro de cada recta sobre su normal (ver predict_normal_lines).
+    """
+    component_multiplier = normal_directions(points, tangent_length)
+    centers = points if offsets is None else points + component_multiplier * offsets[:, None]
+    half_len = np.asarray(normal_len)[..., None] / 2
+    upper = centers + component_multiplier * half_len
+    lower = centers - component_multiplier * half_len
 
     bounds = np.stack((upper, lower), axis=1)
 
     return np.rint(bounds).astype(np.int64)
 
+# Modelo de movimiento de cada punto sobre su normal (ver Config.motion_prediction): velocidad constante, corregida en cada
+# frame con una fracción del error de la predicción, como un filtro alfa-beta
+MOTION_VELOCITY_GAIN    = 0.5
+# Peso de cada frame en el promedio (exponencial) del cuadrado del error de la predicción
+MOTION_SPREAD_GAIN      = 0.3
+# Desvíos del error de la predicción que cubre la recta normal hacia cada lado
+MOTION_SIGMAS           = 3
+
+def predict_normal_lines(motion: Optional[np.ndarray], normal_len: int, min_normal_len: int) -> Tuple[Optional[np.ndarray], np.ndarray]:
+    """
+    Desplazamiento sobre la normal y longitud de la recta normal de cada punto, según su estado de movimiento (n, 2)
+    (velocidad, promedio del cuadrado del error de la predicción; ver update_motion).
+    La recta se acorta hasta min_normal_len según la incertidumbre de la predicción. Sin incertidumbre conocida (NaN),
+    o sin estado, se usa la longitud completa. El desplazamiento nunca saca al punto anterior de la recta de longitud completa.
+    """
+    if motion is None:
+        return None, np.asarray(normal_len)
+    velocity, spread = motion[:, 0], motion[:, 1]
+    with np.errstate(invalid='ignore'):
+        lengths = np.ceil(min_normal_len + 2 * MOTION_SIGMAS * np.sqrt(spread))
+    lengths = np.where(np.isnan(lengths), normal_len, np.clip(lengths, min_normal_len, normal_len)).astype(np.int64)
+    return np.clip(velocity, -normal_len / 2, normal_len / 2), lengths
+
+def update_motion(motion: Optional[np.ndarray], directions: np.ndarray, prev_points: np.ndarray, points: np.ndarray,
+                  offsets: Optional[np.ndarray], failed: np.ndarray) -> np.ndarray:
+    """
+    Estado de movimiento (n, 2) luego de un frame (ver predict_normal_lines), a partir del desplazamiento de cada punto
+    sobre su normal (directions). Sin estado previo, el desplazamiento es respecto de los puntos del usuario y no de un frame
+    anterior, por lo que no se mide: la velocidad parte de 0 y la incertidumbre es desconocida.
+    Los puntos cuyo ajuste falló (failed) vuelven a tener incertidumbre desconocida, para buscarlos en la recta completa.
+    """
+    if motion is None or len(motion) != len(points):
+        return np.column_stack((np.zeros(len(points)), np.full(len(points), np.nan)))
+
+    displacement = np.einsum('ni,ni->n', points - prev_points, directions)
+    predicted = offsets if offsets is not None else np.zeros(len(points))
+    residual = displacement - predicted
+    velocity = predicted + MOTION_VELOCITY_GAIN * residual
+    spread = motion[:, 1]
+    spread = np.where(np.isnan(spread), np.square(residual), (1 - MOTION_SPREAD_GAIN) * spread + MOTION_SPREAD_GAIN * np.square(residual))
+    spread[failed] = np.nan
+    return np.column_stack((velocity, spread))
+
+def lines_region(bounds: np.ndarray, margin: int = 2) -> Tuple[int, int, int, int]:
+    """
+    Región (x0, y0, x1, y1), sin incluir x1 ni y1, que contiene todos los pixeles que se leen de las rectas normales (n, 2, 2).
+    El margen cubre el vecino de la interpolación bilineal, y evita que un pixel leído quede en el borde de la región
+    (read_line_from_img descarta el indice 0).
+    """
+    x0, y0 = np.floor(bounds.min(axis=(0, 1))).astype(int) - margin
+    x1, y1 = np.ceil(bounds.max(axis=(0, 1))).astype(int) + 1 + margin
+    return int(x0), int(y0), int(x1), int(y1)
+
+def invert_profiles(intensity_profiles: np.ndarray, dtype: np.dtype) -> np.ndarray:
+    """
+    Invierte los perfiles de intensidad como si se hubiese invertido la imagen, sin copiar el frame.
+    Para uint8 se invierte respecto de 255, como siempre. Para el resto de los tipos se invierte respecto del máximo
+    de los perfiles del frame: los valores invertidos quedan en el rango de los datos, del que dependen la estimación
+    inicial del ajuste y el filtrado por contraste.
+    """
+    if dtype == np.uint8 or intensity_profiles.size == 0:
+        return 255 - intensity_profiles if dtype == np.uint8 else intensity_profiles
+    with warnings.catch_warnings():
+        # Perfiles todos NaN (rectas fuera de la imagen)
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmax(intensity_profiles) - intensity_profiles
+
 # indices (n, 2) de la forma (x, y)
 def read_line_from_img(img: np.ndarray, ind: np.ndarray) -> np.ndarray:
     indices = ind[(ind[:,0] > 0) & (ind[:,0] < img.shape[1]) & (ind[:,1] > 0) & (ind[:,1] < img.shape[0])]
     return img[indices[:,1], indices[:,0]]
 
-def bezier_fitting(points: np.ndarray, segment_len: int):
-    if np.isinf(comb(segment_len, segment_len // 2)):
-        raise ValueError('Bezier segment is too long. Try lowering it\'s length')
+def normal_line_samples(bounds: np.ndarray, lengths) -> np.ndarray:
+    """
+    A partir de los limites (n, 2, 2) de las rectas normales, genera una grilla (n, L, 2) de puntos (x, y)
+    equiespaciados sobre cada recta, uno por pixel de su longitud (lengths, una para todas o una por recta).
+    L es la mayor longitud más uno: las rectas más cortas se completan con NaN, como en pad_profiles.
+    """
+    index = np.arange(int(np.max(lengths, initial=0)) + 1)[None, :]
+    lengths = np.broadcast_to(np.asarray(lengths), (len(bounds),))[:, None]
+    # Igual que np.linspace(0, 1, length + 1) en cada recta
+    t = np.where(index < lengths, index * (1 / lengths), np.where(index == lengths, 1.0, np.nan))[..., None]
+    start = bounds[:, None, 0].astype(np.float64)
+    end = bounds[:, None, 1].astype(np.float64)
+    return start + t * (end - start)
+
+# coords (n, L, 2) de la forma (x, y)
+def read_lines_from_img(img: np.ndarray, coords: np.ndarray) -> np.ndarray:
+    """
+    Lee todos los perfiles de intensidad a la vez mediante interpolación bilineal.
+    Retorna una matriz (n, L), con NaN en las muestras que caen fuera de la imagen o cuyas coordenadas son NaN.
+    """
+    height, width = img.shape
+    x = coords[..., 0]
+    y = coords[..., 1]
+    inside = (x >= 0) & (x <= width - 1) & (y >= 0) & (y <= height - 1)
+
+    # fmin/fmax (a diferencia de clip) llevan las coordenadas NaN a un pixel válido, que luego se descarta
+    x = np.fmin(np.fmax(x, 0), width - 1)
+    y = np.fmin(np.fmax(y, 0), height - 1)
+    x0 = np.minimum(x.astype(np.int64), width - 2) if width > 1 else np.zeros(x.shape, dtype=np.int64)
+    y0 = np.minimum(y.astype(np.int64), height - 2) if height > 1 else np.zeros(y.shape, dtype=np.int64)
+    x1 = np.minimum(x0 + 1, width - 1)
+    y1 = np.minimum(y0 + 1, height - 1)
+    dx = x - x0
+    dy = y - y0
+
+    top = img[y0, x0] * (1 - dx) + img[y0, x1] * dx
+    bottom = img[y1, x0] * (1 - dx) + img[y1, x1] * dx
+    ret = top * (1 - dy) + bottom * dy
+    ret[~inside] = np.nan
+    return ret
+
+# Bytes máximos de matrices de Bernstein cacheadas, por proceso. Cada matriz ocupa count^2 * 8 bytes
+# (con segmentos de 2000 puntos son 32 MB), por lo que el límite es en bytes y no en cantidad de matrices
+BERNSTEIN_CACHE_BYTES = 64 * 2**20
+
+_bernstein_cache: 'OrderedDict[int, np.ndarray]' = OrderedDict()
+_bernstein_cache_lock = threading.Lock()
 
+def compute_bernstein_basis(count: int) -> np.ndarray:
+    """
+    Matriz (count, count) con los polinomios de Bernstein de grado count-1 evaluados en count valores de t equiespaciados.
+    Se calcula en espacio logaritmico para que no se desborde comb(n, k) con segmentos largos.
+    """
+    n = count - 1
+    t = np.linspace(0, 1, num=count)[:, None]
+    k = np.arange(count)[None, :]
+    log_comb = gammaln(n + 1) - gammaln(k + 1) - gammaln(n - k + 1)
+    return np.exp(log_comb + xlogy(k, t) + xlogy(n - k, 1 - t))
+
+def bernstein_basis(count: int) -> np.ndarray:
+    """
+    Igual que compute_bernstein_basis, pero cacheada (LRU, hasta BERNSTEIN_CACHE_BYTES).
+    La matriz es compartida por el cache, por lo que es de solo lectura.
+    """
+    with _bernstein_cache_lock:
+        basis = _bernstein_cache.get(count)
+        if basis is not None:
+            _bernstein_cache.move_to_end(count)
+            return basis
+
+    basis = compute_bernstein_basis(count)
+    basis.setflags(write=False)
+    if basis.nbytes > BERNSTEIN_CACHE_BYTES:
+        return basis
+    with _bernstein_cache_lock:
+        _bernstein_cache[count] = basis
+        total = sum(cached.nbytes for cached in _bernstein_cache.values())
+        while total > BERNSTEIN_CACHE_BYTES:
+            _, evicted = _bernstein_cache.popitem(last=False)
+            total -= evicted.nbytes
+    return basis
+
+def bezier_fitting(points: np.ndarray, segment_len: int) -> np.ndarray:
     total_points = len(points)
     bezier_segments = [points[i: i + segment_len] for i in range(0, total_points, segment_len-1)]
     total_segments = len(bezier_segments)
@@ -200,16 +654,13 @@ def bezier_fitting(points: np.ndarray, segment_len: int):
         # It could be a parameter, but we always want the same amount of points as the input
         count = len(segment)
 
-        size = count
-        n = size - 1
-
-        # We make it of shape (count, 1) so it can later be broadcast to 2
-        idx = np.arange(size).reshape((-1, 1))
         # We want the last value to not be present, except on the last iteration
-        ts = np.linspace(0, 1, num=count)[:count-1 if seg_idx < total_segments-1 else count]
+        out_count = count-1 if seg_idx < total_segments-1 else count
+        start = seg_idx*(segment_len-1)
 
-        for i, t in enumerate(ts):
-            # Sum of points multiplied by the corresponding Bernstein polynomial
-            ret[seg_idx*(segment_len-1) + i, :] = np.sum(segment * comb(n, idx) * (t**idx) * ((1 - t)**(n - idx)), axis=0)
+        # Sum of points multiplied by the corresponding Bernstein polynomial, for every t at once
+        # Solo se cachea la matriz de los segmentos completos: el resto tiene una longitud distinta en cada filamento
+        basis = bernstein_basis(count) if count == segment_len else compute_bernstein_basis(count)
+        ret[start:start + out_count] = basis[:out_count] @ segment
 
     return ret
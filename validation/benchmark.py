@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+import sys
+sys.path.insert(1, '../')
+
+import argparse
+import dataclasses
+import itertools
+import json
+import platform
+
+import numpy as np
+
+from tracking.image_utils import normalize
+from tracking.main import track_filament_arrays
+from tracking.metrics import TrackingMetrics, stage
+from tracking.models import Config
+
+from validation_utils import set_seed, gauss_convolution, gauss_noise_batch
+
+# Usage:
+#   ./benchmark.py                              -> runs every case and prints the timings
+#   ./benchmark.py --save baseline.json         -> also saves them as the baseline
+#   ./benchmark.py --compare baseline.json      -> compares against the baseline and reports regressions (exit code 1)
+
+# --- Benchmark Config --- #
+
+# Seed (fixed, so every run benchmarks exactly the same stacks)
+seed = 42
+
+# Cases: every combination is benchmarked
+frame_sizes     = ((166, 96), (512, 256), (1024, 1024))    # (width, height)
+filament_lens   = (0.5, 0.9)                                # Fraction of the frame width covered by the filament
+frame_counts    = (10, 50)
+noise_sigmas    = (0.0010, 0.0060)
+
+# Timing repetitions (the minimum is kept, as it is the least affected by other processes)
+repeats = 3
+
+# Filament properties
+thickness = 3
+max_value = 150
+drift     = 0.3     # Vertical displacement per frame [px]
+
+# Filament softening (gaussian convolution) properties
+conv_sigma          = 10
+conv_kernel_size    = 3
+
+# Noise (gaussian) properties
+noise_percentage    = 85
+
+# Point selection
+point_density = 15
+
+# Tracking config
+config = Config(
+    max_fitting_error   = 0.6,
+    normal_line_length  = 10,
+    point_density       = 1,
+    missing_inter_len   = 3,
+    max_tangent_length  = 15,
+    bezier_segment_len  = 500,
+    bezier_smoothing    = True,
+)
+
+# Comparison: a stage regresses when it is slower than the baseline by more than the tolerance (and the minimum absolute difference)
+regression_tolerance    = 0.25
+regression_min_diff_ms  = 0.05
+
+STAGES = ('normals', 'sampling', 'fitting', 'interpolation', 'bezier', 'serialization')
+
+# --- Benchmark --- #
+
+def build_stack(width: int, height: int, filament_len: float, frame_count: int, noise_sigma: float):
+    """
+    Stack sintético: un filamento lineal que se desplaza verticalmente drift píxeles por frame.
+    Retorna los frames y los puntos que seleccionaría el usuario sobre el primero.
+    """
+    trim_len = int(width * (1 - filament_len) / 2)
+    x = np.arange(trim_len, width - trim_len)
+    thick = (thickness - thickness % 2) // 2
+
+    # Todo el stack se genera junto, en float32
+    stack = np.zeros((frame_count, height, width), dtype=np.float32)
+    for frame_idx in range(frame_count):
+        y = np.round(height / 4 + height / (2 * width) * x + drift * frame_idx).astype(int)
+        for offset in range(-thick, thick + 1):
+            stack[frame_idx, np.clip(y + offset, 0, height - 1), x] = max_value
+    stack = gauss_convolution(stack, conv_sigma, conv_kernel_size)
+    stack = gauss_noise_batch(stack, noise_sigma, noise_percentage)
+    frames = [normalize(img) for img in stack]
+
+    y = np.round(height / 4 + height / (2 * width) * x).astype(int)
+    selected_points = np.dstack((x[::point_density], y[::point_density])).squeeze()
+    return frames, selected_points
+
+def track_stages(frames, user_points: np.ndarray, config: Config) -> dict:
+    """
+    Trackea el stack midiendo el tiempo de cada etapa con las métricas del tracking.
+    Retorna el tiempo total de cada etapa en segundos.
+    """
+    metrics = TrackingMetrics()
+    result = track_filament_arrays(frames, user_points, config, metrics=metrics)
+    with stage(metrics, 'serialization'):
+        json.dumps(result.to_dict())
+        result.to_npz()
+    return {name: metrics.stages.get(name, 0.0) for name in STAGES}
+
+def case_name(width: int, height: int, filament_len: float, frame_count: int, noise_sigma: float) -> str:
+    return f'{width}x{height}_len{filament_len}_frames{frame_count}_sigma{noise_sigma}'
+
+def run_benchmark() -> dict:
+    set_seed(seed)
+    cases = {}
+    for (width, height), filament_len, frame_count, noise_sigma in itertools.product(frame_sizes, filament_lens, frame_counts, noise_sigmas):
+        frames, selected_points = build_stack(width, height, filament_len, frame_count, noise_sigma)
+        runs = [track_stages(frames, selected_points, config) for _ in range(repeats)]
+
+        # Tiempo por frame en ms
+        stages = {stage_name: 1000 * min(run[stage_name] for run in runs) / frame_count for stage_name in STAGES}
+        name = case_name(width, height, filament_len, frame_count, noise_sigma)
+        cases[name] = stages
+
+        # Console output
+        print(f'| {name:<42} ' + ''.join(f'| {stage_name}: {stages[stage_name]:>8.3f} ' for stage_name in STAGES) + f'| total: {sum(stages.values()):>8.3f} ms/frame |')
+
+    return {
+        'seed':     seed,
+        'repeats':  repeats,
+        'config':   dataclasses.asdict(config),
+        'python':   platform.python_version(),
+        'numpy':    np.__version__,
+        'machine':  platform.machine(),
+        'cases':    cases,
+    }
+
+def compare(current: dict, baseline: dict) -> int:
+    """
+    Compara el tiempo por frame de cada etapa contra el baseline. Retorna la cantidad de regresiones.
+    """
+    if current['config'] != baseline['config'] or current['seed'] != baseline['seed']:
+        print('WARNING: baseline was generated with a different config or seed')
+
+    regressions = 0
+    for name, stages in current['cases'].items():
+        if name not in baseline['cases']:
+            print(f'| {name:<42} | not in baseline |')
+            continue
+        for stage_name, value in stages.items():
+            base = baseline['cases'][name].get(stage_name)
+            if base is None:
+                continue
+            diff = value - base
+            regressed = diff > regression_min_diff_ms and value > base * (1 + regression_tolerance)
+            regressions += regressed
+            print(
+                f'| {name:<42} '
+                f'| {stage_name:<13} '
+                f'| baseline: {base:>8.3f} '
+                f'| current: {value:>8.3f} '
+                f'| change: {diff / base if base > 0 else 0:>+7.1%} '
+                f'| {"REGRESSION" if regressed else "ok":<10} '
+                f'|'
+            )
+
+    print(f'{regressions} regressions')
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per stage tracking benchmark over synthetic stacks')
+    parser.add_argument('--save', metavar='FILE', help='save the results as baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results against a baseline')
+    args = parser.parse_args()
+
+    results = run_benchmark()
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            sys.exit(1 if compare(results, json.load(f)) else 0)
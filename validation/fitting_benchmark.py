@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+import sys
+sys.path.insert(1, '../')
+
+import time
+import warnings
+
+import numpy as np
+from scipy.optimize import curve_fit, OptimizeWarning
+
+from tracking.image_utils import normalize
+from tracking.tracking import multi_point_linear_interpolation, generate_normal_line_bounds, points_linear_interpolation, \
+    read_line_from_img, gauss_fitting_params_batch, pad_profiles
+
+from validation_utils import set_seed, gauss_convolution, gauss_noise
+
+# --- Benchmark Config --- #
+
+# Seed
+seed = time.time_ns()
+
+# Image properties
+width   = 166
+height  = 96
+
+# Global sampling
+runs = 20
+
+# Filament properties
+thickness = 3
+max_value = 150
+
+# Filament function
+def f(x):
+    return np.round(height/width * x).astype(np.uint8)  # Linear
+
+# Filament softening (gaussian convolution) properties
+conv_sigma          = 10
+conv_kernel_size    = 3
+
+# Noise (gaussian) properties
+noise_percentage    = 85
+noise_sigmas        = (0.0010, 0.0030, 0.0060)
+
+# Point selection
+trim_len        = 20
+point_density   = 15
+
+# Fitting config
+max_fitting_error   = 0.6
+normal_line_length  = 10
+max_tangent_length  = 15
+
+# Fits whose width is below this many pixels, or above the profile length, are ill-posed (the width and amplitude are not identifiable)
+min_fit_width = 0.5
+
+# Reference: the per-profile curve_fit the tracker used before gauss_fitting_params_batch
+def curve_fit_gauss(intensity_profile: np.ndarray, max_error: float):
+    """
+    Returns the fitted mean (NaN if the fit failed or its error is above max_error) and the fitted parameters (None if it failed).
+    """
+    xdata = np.arange(len(intensity_profile))
+    max_c = np.max(intensity_profile)
+    max_idx = np.argmax(intensity_profile)
+    try:
+        # curve_fit warns when it can't estimate the covariance, and returns an infinite error, which the threshold rejects
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=OptimizeWarning)
+            popt, pcov = curve_fit(
+                lambda x, mu, sig, a, y0: y0 + a * np.exp(-np.power((x - mu) / sig, 2.) / 2),
+                xdata,
+                intensity_profile,
+                p0=([max_idx, 1, max_c, max_c/4]),
+            )
+    except RuntimeError:
+        return np.nan, None
+    p_error = np.square(np.diag(pcov))
+    return (popt[0] if p_error[0] < max_error else np.nan), popt
+
+def ill_posed(width: float, profile_len: int) -> bool:
+    return not min_fit_width <= abs(width) <= profile_len
+
+# --- Start Benchmark --- #
+
+set_seed(seed)
+
+# Calculate starting conditions
+x = np.arange(width - thickness)
+y = f(x)
+thick = (thickness - thickness % 2) // 2
+selected_points = np.dstack((x[trim_len:-trim_len:point_density], y[trim_len:-trim_len:point_density])).squeeze()
+
+# Same normal lines the tracker uses on the first frame
+points          = multi_point_linear_interpolation(selected_points)
+normal_lines    = [points_linear_interpolation(start, end) for start, end in generate_normal_line_bounds(points, max_tangent_length, normal_line_length)]
+
+# For each noise sigma
+for noise_sigma in noise_sigmas:
+    loop_time   = 0
+    batch_time  = 0
+    mismatches  = 0
+    loop_only   = 0
+    batch_only  = 0
+    ill_posed_mismatches = 0
+    max_diff    = 0
+    total       = 0
+
+    # For each run
+    for run in range(runs):
+        # Build image
+        img = np.zeros((height, width))
+        for offset in range(-thick, thick + 1):
+            img[y + offset, x] = max_value
+        img = gauss_convolution(img, conv_sigma, conv_kernel_size)
+        img = gauss_noise(img, noise_sigma, noise_percentage)
+        img = normalize(img)
+
+        profiles = [read_line_from_img(img, nl) for nl in normal_lines]
+
+        # Before: one curve_fit per profile
+        runtime = time.perf_counter()
+        loop_pos, loop_params = zip(*(curve_fit_gauss(profile, max_fitting_error) for profile in profiles))
+        loop_pos = np.array(loop_pos)
+        loop_time += time.perf_counter() - runtime
+
+        # After: every profile of the frame at once
+        runtime = time.perf_counter()
+        batch_pos, _, _ = gauss_fitting_params_batch(pad_profiles(profiles), max_fitting_error)
+        batch_time += time.perf_counter() - runtime
+
+        # Accept/reject disagreements, in each direction, and how many of them involve an ill-posed fit
+        both        = ~np.isnan(loop_pos) & ~np.isnan(batch_pos)
+        mismatched  = np.isnan(loop_pos) != np.isnan(batch_pos)
+        mismatches  += np.count_nonzero(mismatched)
+        loop_only   += np.count_nonzero(mismatched & ~np.isnan(loop_pos))
+        batch_only  += np.count_nonzero(mismatched & ~np.isnan(batch_pos))
+        unrejected  = gauss_fitting_params_batch(pad_profiles(profiles), np.inf)[1]
+        for i in np.flatnonzero(mismatched):
+            loop_width  = loop_params[i][1] if loop_params[i] is not None else np.nan
+            batch_width = unrejected[i, 1]
+            ill_posed_mismatches += any(np.isnan(w) or ill_posed(w, len(profiles[i])) for w in (loop_width, batch_width))
+        max_diff    = max(max_diff, np.max(np.abs(loop_pos[both] - batch_pos[both]), initial=0))
+        total       += len(profiles)
+
+    # Console output
+    print(
+        f'| sigma: {noise_sigma:<8.4f} '
+        f'| loop: {total / loop_time:>9.1f} points/s '
+        f'| batch: {total / batch_time:>9.1f} points/s '
+        f'| speedup: {loop_time / batch_time:>5.1f}x '
+        f'| rejection mismatches: {mismatches:>4}/{total:<5} ({100 * mismatches / total:4.1f}%, '
+        f'only curve_fit accepts: {loop_only:>3}, only batch accepts: {batch_only:>3}, ill-posed: {ill_posed_mismatches:>3}) '
+        f'| max position diff: {max_diff:<10.3e} '
+        f'|'
+    )
+
+print(f'{seed=}')
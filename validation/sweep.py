@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+import sys
+sys.path.insert(1, '../')
+
+import argparse
+import dataclasses
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from PIL import Image as PImage
+from sklearn.metrics import mean_squared_error
+
+from tracking.image_utils import normalize
+from tracking.main import track_filament
+from tracking.models import Config, PEAK_ESTIMATOR_CHOICES
+
+from validation_utils import synthetic_frames, save_as_tsv
+
+# Usage:
+#   ./sweep.py linear                       -> same sweep as track.py, on every core
+#   ./sweep.py sin --workers 4
+#   ./sweep.py inter --seed 1234            -> same sweep as intersection.py
+#   ./sweep.py linear --estimator centroid  -> same sweep with another peak estimator (output in linear-centroid/)
+# An interrupted sweep resumes from its checkpoints when run again with the same arguments.
+# Output goes to {target}/, in the same layout track.py and intersection.py use, so track_plot*.py keep working.
+
+# --- Sweep Config --- #
+
+# Image properties
+width   = 166
+height  = 96
+
+# Global sampling
+runs = 50
+
+# Filament properties
+thickness = 3
+max_value = 150
+
+# Filament softening (gaussian convolution) properties
+conv_sigma          = 10
+conv_kernel_size    = 3
+
+# Noise (gaussian) properties
+noise_percentage    = 85
+noise_sigma_start   = 0.0001
+noise_sigma_end     = 0.0060
+noise_sigma_step    = 0.0001
+
+# Intersection properties
+inter_noise_sigma   = 0.001
+angle_start         = 10
+angle_end           = 60
+
+# Image background limits (for SNR)
+bg_y_start    = 50
+bg_y_end      = 70
+bg_x_start    = 10
+bg_x_end      = 30
+
+# Point selection
+trim_len        = 20
+point_density   = 15
+
+# Tracking config
+config = Config(
+    max_fitting_error   = 0.6,
+    normal_line_length  = 10,
+    point_density       = 1,
+    missing_inter_len   = 3,
+    max_tangent_length  = 15,
+    bezier_segment_len  = 500,
+    bezier_smoothing    = True,
+)
+
+CHECKPOINT_DIR  = 'checkpoints'
+SWEEP_FILE      = 'sweep.json'
+
+# --- Scenarios --- #
+
+def filament_img(ys, x):
+    thick = (thickness - thickness % 2) // 2
+    img = np.zeros((height, width), dtype=np.float32)
+    for y in ys:
+        for offset in range(-thick, thick + 1):
+            img[y + offset, x] = max_value
+    return img
+
+def signal_to_noise(img, y, x):
+    thick = (thickness - thickness % 2) // 2
+    bg      = img[bg_y_start:bg_y_end, bg_x_start:bg_x_end]
+    signal  = np.mean(np.stack([img[y + offset, x] for offset in range(-thick, thick + 1)])) - np.mean(bg)
+    return signal / np.std(bg)
+
+def track_run(img, f, x, y, config):
+    """
+    Trackea un frame y retorna el RMSE respecto de f y el tiempo del tracking [ms].
+    """
+    selected_points = np.dstack((x[trim_len:-trim_len:point_density], y[trim_len:-trim_len:point_density])).squeeze()
+    runtime = time.perf_counter()
+    result = track_filament((img,), selected_points, config).frames[0]
+    runtime = 1000 * (time.perf_counter() - runtime)
+    result_x = np.asarray([point.x for point in result.points])
+    result_y = np.asarray([point.y for point in result.points])
+    return np.sqrt(mean_squared_error(f(result_x), result_y)), runtime
+
+def linear_f(x):
+    return np.round(height/width * x).astype(np.uint8)
+
+def sin_f(x):
+    return (height/4 * np.sin(10/width * x) + height/2).astype(np.uint8)
+
+def noise_scene(f, noise_sigma):
+    x = np.arange(width - thickness)
+    y = f(x)
+    return filament_img((y,), x), noise_sigma, f, x, y
+
+def linear_scene(noise_sigma):
+    return noise_scene(linear_f, noise_sigma)
+
+def sin_scene(noise_sigma):
+    return noise_scene(sin_f, noise_sigma)
+
+def inter_scene(angle):
+    # Filament function slope (m) and offset(off)
+    m       = np.tan(np.deg2rad(angle / 2))
+    off     = height / 2 - m * width / 2
+
+    def f(x):
+        return np.round(m * x + off).astype(np.uint8)
+
+    def g(x):
+        return height - 1 - np.round(m * x + off).astype(np.uint8)
+
+    x = np.arange(thickness, width - thickness)
+    y = f(x)
+    return filament_img((y, g(x)), x), inter_noise_sigma, f, x, y
+
+def noise_sigmas():
+    return np.linspace(noise_sigma_start, noise_sigma_end, num=int((noise_sigma_end - noise_sigma_start) // noise_sigma_step))
+
+def angles():
+    return np.linspace(angle_start, angle_end, num=angle_end - angle_start + 1)
+
+def save_noise_data(target, grid, cells):
+    snrs    = np.array([cell['snr']   for cell in cells])
+    errors  = np.array([cell['error'] for cell in cells])
+    times   = np.array([cell['time']  for cell in cells])
+    save_as_tsv((grid,), f'{target}/sigma_data.tsv', ('sigma',))
+    save_as_tsv((np.mean(snrs,   axis=1), np.std(snrs,   axis=1)), f'{target}/snr_data.tsv',   ('mean', 'std'))
+    save_as_tsv((np.mean(errors, axis=1), np.std(errors, axis=1)), f'{target}/error_data.tsv', ('mean', 'std'))
+    save_as_tsv((np.mean(times,  axis=1), np.std(times,  axis=1)), f'{target}/time_data.tsv',  ('mean', 'std'))
+
+def save_inter_data(target, grid, cells):
+    errors = np.array([cell['error'] for cell in cells])
+    save_as_tsv((grid,), f'{target}/angle_data.tsv', ('angle',))
+    save_as_tsv((np.mean(errors, axis=1), np.std(errors, axis=1)), f'{target}/error_data.tsv', ('mean', 'std'))
+
+# Escenario: (imagen sin ruido, ruido, función del filamento y sus puntos de cada valor de la grilla, grilla de parámetros, nombre de la imagen de cada celda, guardado de los TSV, target por defecto)
+SCENARIOS = {
+    'linear':   (linear_scene,   noise_sigmas,   lambda sigma: f'{sigma:.4f}',   save_noise_data,    'linear'),
+    'sin':      (sin_scene,      noise_sigmas,   lambda sigma: f'{sigma:.4f}',   save_noise_data,    'sin'),
+    'inter':    (inter_scene,    angles,         lambda angle: f'{int(angle)}',  save_inter_data,    'inter'),
+}
+
+# --- Sweep Engine --- #
+
+def run_cell(scenario: str, target: str, seed: int, estimator: str, cell_idx: int, value: float) -> dict:
+    """
+    Corre todas las corridas de una celda de la grilla y guarda su checkpoint.
+    El generador se deriva de (seed, cell_idx), por lo que el resultado no depende del worker ni del orden.
+    """
+    scene, _, img_name, _, _ = SCENARIOS[scenario]
+    cell_config = dataclasses.replace(config, peak_estimator=estimator)
+    generator = np.random.default_rng((seed, cell_idx))
+
+    # Las imagenes de todas las corridas se generan juntas
+    img, noise_sigma, f, x, y = scene(value)
+    frames = synthetic_frames(img, runs, conv_sigma, conv_kernel_size, noise_sigma, noise_percentage, generator)
+
+    cell = {'snr': [], 'error': [], 'time': []}
+    for frame in frames:
+        img = normalize(frame)
+        rmse, runtime = track_run(img, f, x, y, cell_config)
+        cell['snr'].append(float(signal_to_noise(img, y, x)))
+        cell['error'].append(float(rmse))
+        cell['time'].append(runtime)
+
+    # Save image representing current cell
+    PImage.fromarray(img).save(f'{target}/imgs/{img_name(value)}.png')
+
+    # Escritura atómica: un checkpoint existe solo si la celda terminó
+    path = os.path.join(target, CHECKPOINT_DIR, f'{cell_idx}.json')
+    with open(f'{path}.tmp', 'w') as fh:
+        json.dump(cell, fh)
+    os.replace(f'{path}.tmp', path)
+    return cell
+
+def load_checkpoints(target: str, sweep: dict) -> dict:
+    """
+    Celdas ya terminadas de un sweep anterior con los mismos parámetros.
+    """
+    sweep_path = os.path.join(target, SWEEP_FILE)
+    if os.path.exists(sweep_path):
+        with open(sweep_path) as fh:
+            previous = json.load(fh)
+        if previous != sweep:
+            raise ValueError(f'{target} has checkpoints of a different sweep ({previous}). Delete {CHECKPOINT_DIR}/ and {SWEEP_FILE} to start over.')
+    else:
+        with open(sweep_path, 'w') as fh:
+            json.dump(sweep, fh)
+
+    cells = {}
+    checkpoint_dir = os.path.join(target, CHECKPOINT_DIR)
+    for name in os.listdir(checkpoint_dir):
+        if name.endswith('.json'):
+            with open(os.path.join(checkpoint_dir, name)) as fh:
+                cells[int(name[:-len('.json')])] = json.load(fh)
+    return cells
+
+def run_sweep(scenario: str, target: str, seed: int, estimator: str, workers: int) -> None:
+    _, grid_fn, img_name, save_data, _ = SCENARIOS[scenario]
+    grid = grid_fn()
+
+    os.makedirs(os.path.join(target, CHECKPOINT_DIR), exist_ok=True)
+    os.makedirs(os.path.join(target, 'imgs'), exist_ok=True)
+
+    sweep = {'scenario': scenario, 'seed': seed, 'runs': runs, 'grid': grid.tolist(), 'config': dataclasses.asdict(dataclasses.replace(config, peak_estimator=estimator))}
+    cells = load_checkpoints(target, sweep)
+    pending = [i for i in range(len(grid)) if i not in cells]
+    print(f'{scenario}: {len(cells)}/{len(grid)} cells already done, {len(pending)} pending')
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_cell, scenario, target, seed, estimator, i, grid[i]): i for i in pending}
+        for future in as_completed(futures):
+            i = futures[future]
+            cells[i] = cell = future.result()
+
+            # Console output
+            print(
+                f'| {img_name(grid[i]):<7} '
+                f'| SNR: {np.mean(cell["snr"]):<8.4f} '
+                f'| RMSE: {np.mean(cell["error"]):<13.10f} '
+                f'| time: {np.mean(cell["time"]):<7.2f} '
+                f'| done: {len(cells):>3}/{len(grid):<3} '
+                f'|'
+            )
+
+    # Resumen de toda la grilla, para comparar estimadores del pico
+    errors  = [error for cell in cells.values() for error in cell['error']]
+    times   = [runtime for cell in cells.values() for runtime in cell['time']]
+    print(f'{estimator}: RMSE: {np.mean(errors):.10f} | time: {np.mean(times):.2f} ms')
+    print(f'{seed=}')
+    save_data(target, grid, [cells[i] for i in range(len(grid))])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parallel, resumable validation sweep')
+    parser.add_argument('scenario', choices=SCENARIOS.keys())
+    parser.add_argument('--target', help='output directory (default: the scenario name)')
+    parser.add_argument('--seed', type=int, default=None, help='default: reuse the checkpointed seed, or a new one')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--estimator', choices=PEAK_ESTIMATOR_CHOICES.keys(), default=config.peak_estimator, help='peak estimator (see Config.peak_estimator)')
+    args = parser.parse_args()
+
+    # Cada estimador del pico tiene su propio directorio, salvo el de la configuración, para que track_plot*.py los puedan comparar
+    target = args.target or SCENARIOS[args.scenario][4] + ('' if args.estimator == config.peak_estimator else f'-{args.estimator}')
+    seed = args.seed
+    if seed is None:
+        # Al retomar un sweep usamos su seed, así no hace falta recordarla
+        sweep_path = os.path.join(target, SWEEP_FILE)
+        if os.path.exists(sweep_path):
+            with open(sweep_path) as fh:
+                seed = json.load(fh)['seed']
+        else:
+            seed = time.time_ns()
+
+    run_sweep(args.scenario, target, seed, args.estimator, args.workers)
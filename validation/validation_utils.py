@@ -1,4 +1,4 @@
-from typing import Tuple, Union
+from typing import Optional, Tuple, Union
 
 import numpy as np
 from numpy.lib.stride_tricks import sliding_window_view
@@ -9,39 +9,74 @@ def set_seed(seed: int):
     global rng
     rng = np.random.default_rng(seed=seed)
 
-def index_matrix(x: int, y: int) -> np.ndarray:
-    return np.array(list(np.ndindex(x, y))).reshape((x, y, 2))
+def gauss_kernel(kernel_size: int, sigma: float) -> np.ndarray:
+    # Factor 1D del kernel gaussiano: exp(-(i² + j²) / σ²) = exp(-i² / σ²) * exp(-j² / σ²)
+    indices = np.arange(kernel_size) - kernel_size//2
+    return np.exp(-indices**2 / sigma**2)
 
-def gauss_kernel(kernel_size:int, sigma: float) -> np.ndarray:
-    indices = index_matrix(kernel_size, kernel_size) - kernel_size//2
-    indices = np.sum(indices**2, axis=2)
-    indices = np.exp(-indices / sigma**2)
-    return indices / (2 * np.pi * sigma**2)
-
-def sliding_window(matrix: np.ndarray, shape: Tuple[int, ...]) -> np.ndarray:
-    return sliding_window_view(np.pad(matrix, (shape[0] - 1) // 2, mode='constant', constant_values=0), shape)
+def gauss_convolution(img: np.ndarray, sigma: float, kernel_size: int) -> np.ndarray:
+    """
+    Convolución con un kernel gaussiano de kernel_size x kernel_size, con bordes en 0.
+    Como el kernel es separable, se convoluciona por columnas y luego por filas (O(k) por pixel en vez de O(k²)).
+    Opera sobre los 2 últimos ejes, por lo que acepta un stack de imagenes (n, H, W). Preserva float32.
+    """
+    dtype = img.dtype if np.issubdtype(img.dtype, np.floating) else np.float64
+    kernel = gauss_kernel(kernel_size, sigma).astype(dtype)
+    pad = (kernel_size - 1) // 2
 
-def weighted_sum(channel: np.ndarray, kernel: np.ndarray) -> np.ndarray:
-    sw = sliding_window(channel, kernel.shape)
-    return np.sum(sw[:, :] * kernel, axis=(2, 3))
+    ret = img.astype(dtype, copy=False)
+    for axis in (-2, -1):
+        padding = [(0, 0)] * ret.ndim
+        padding[axis] = (pad, pad)
+        ret = sliding_window_view(np.pad(ret, padding), kernel_size, axis=axis) @ kernel
 
-def gauss_convolution(img: np.ndarray, sigma: float, kernel_size: int) -> np.ndarray:
-    return weighted_sum(img, gauss_kernel(kernel_size, sigma))
+    return ret / dtype.type(2 * np.pi * sigma**2)
 
 # \frac{1}{\sqrt{ 2 \pi \sigma^2 }}e^{ - \frac{ (x - \mu)^2 } {2 \sigma^2} }
-def gaussian(mu: float, sigma: float, size: int) -> Union[float, np.ndarray]:
-    return rng.normal(mu, sigma, size)
+# Sin generator se usa el rng global (ver set_seed)
+def gaussian(mu: float, sigma: float, size: int, generator: Optional[np.random.Generator] = None) -> Union[float, np.ndarray]:
+    return (generator or rng).normal(mu, sigma, size)
 
-def gauss_noise(img: np.ndarray, sigma: float, percentage: int) -> np.ndarray:
+def gauss_noise(img: np.ndarray, sigma: float, percentage: int, generator: Optional[np.random.Generator] = None) -> np.ndarray:
     p = percentage / 100
     n = int(img.size * p)
     shape = np.shape(img)
-    indices = rng.choice(img.size, n, replace=False)
+    indices = (generator or rng).choice(img.size, n, replace=False)
     ret = img.flatten()
-    noise = gaussian(0, sigma, n)
+    noise = gaussian(0, sigma, n, generator)
     ret[indices] = ret[indices] + noise * 255
     return np.reshape(ret, shape)
 
+def gauss_noise_batch(imgs: np.ndarray, sigma: float, percentage: int, generator: Optional[np.random.Generator] = None) -> np.ndarray:
+    """
+    Igual que gauss_noise, pero para un stack (n, H, W), generando el ruido de todas las imagenes a la vez.
+    Misma distribución que aplicar gauss_noise a cada imagen: en cada una se elige, sin reemplazo, el mismo porcentaje de pixeles.
+    Preserva float32.
+    """
+    generator = generator or rng
+    runs = len(imgs)
+    size = imgs[0].size
+    n = int(size * percentage / 100)
+    dtype = imgs.dtype if np.issubdtype(imgs.dtype, np.floating) else np.float64
+
+    # Los n menores de size claves uniformes son un subconjunto uniforme de tamaño n (sin reemplazo)
+    indices = np.argpartition(generator.random((runs, size), dtype=np.float32), n - 1, axis=1)[:, :n] if 0 < n < size else \
+        np.broadcast_to(np.arange(n), (runs, n))
+    noise = generator.standard_normal((runs, n), dtype=np.float32) * np.float32(sigma * 255)
+
+    ret = imgs.astype(dtype).reshape((runs, size))
+    ret[np.arange(runs)[:, None], indices] += noise
+    return ret.reshape(imgs.shape)
+
+def synthetic_frames(img: np.ndarray, runs: int, conv_sigma: float, conv_kernel_size: int, noise_sigma: float, noise_percentage: int,
+                     generator: Optional[np.random.Generator] = None) -> np.ndarray:
+    """
+    Stack (runs, H, W) float32 de versiones ruidosas de img (sin normalizar): la convolución se calcula una sola vez
+    y el ruido de todas las corridas a la vez (ver gauss_noise_batch).
+    """
+    softened = gauss_convolution(img.astype(np.float32), conv_sigma, conv_kernel_size)
+    return gauss_noise_batch(np.broadcast_to(softened, (runs, *softened.shape)), noise_sigma, noise_percentage, generator)
+
 def save_as_tsv(data, filename, headers):
     np.savetxt(filename, np.dstack(data).squeeze(), header='\t'.join(headers), delimiter='\t', comments='')
 